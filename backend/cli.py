@@ -0,0 +1,90 @@
+"""
+Launcher for the student tracking API
+
+Runs server:app under uvicorn with N worker processes, uvloop and httptools.
+The app is passed as an import string and never imported here, so each worker
+imports it on its own and the lifespan creates that worker's Motor client.
+No client or socket to Mongo is ever shared across processes.
+
+Usage:
+  python backend/cli.py --workers 4
+  python backend/cli.py --port 8001 --workers 1 --keep-alive 30
+"""
+
+import os
+import sys
+from pathlib import Path
+from typing import Optional
+
+import typer
+import uvicorn
+
+BACKEND_DIR = Path(__file__).resolve().parent
+
+cli = typer.Typer(add_completion=False)
+
+
+def default_workers() -> int:
+    return len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+
+
+def available(module: str) -> bool:
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+
+@cli.command()
+def serve(
+    host: str = typer.Option("0.0.0.0", envvar="HOST"),
+    port: int = typer.Option(8001, envvar="PORT"),
+    workers: int = typer.Option(
+        0, envvar="WEB_CONCURRENCY", help="worker processes, 0 for one per available core"
+    ),
+    backlog: int = typer.Option(2048, envvar="BACKLOG", help="listen backlog for pending connections"),
+    keep_alive: int = typer.Option(
+        15, envvar="KEEP_ALIVE", help="seconds to keep idle connections open; above the proxy's idle timeout"
+    ),
+    graceful_timeout: int = typer.Option(
+        30, envvar="GRACEFUL_TIMEOUT", help="seconds to drain in-flight requests on shutdown"
+    ),
+    limit_concurrency: Optional[int] = typer.Option(
+        None, envvar="LIMIT_CONCURRENCY", help="answer 503 above this many connections per worker"
+    ),
+    proxy_headers: bool = typer.Option(True, envvar="PROXY_HEADERS"),
+    forwarded_allow_ips: str = typer.Option(
+        "127.0.0.1", envvar="FORWARDED_ALLOW_IPS", help="proxies trusted to set the client address in X-Forwarded-For"
+    ),
+    access_log: bool = typer.Option(False, envvar="ACCESS_LOG"),
+    log_level: str = typer.Option("info", envvar="LOG_LEVEL"),
+):
+    """Serve the API with tuned worker, event loop and HTTP parser settings"""
+    workers = workers or default_workers()
+    loop = "uvloop" if available("uvloop") else "asyncio"
+    http = "httptools" if available("httptools") else "h11"
+    typer.echo(f"Serving on {host}:{port} with {workers} workers ({loop}, {http})", err=True)
+
+    uvicorn.run(
+        "server:app",
+        app_dir=str(BACKEND_DIR),
+        host=host,
+        port=port,
+        workers=workers,
+        loop=loop,
+        http=http,
+        lifespan="on",
+        backlog=backlog,
+        timeout_keep_alive=keep_alive,
+        timeout_graceful_shutdown=graceful_timeout,
+        limit_concurrency=limit_concurrency,
+        proxy_headers=proxy_headers,
+        forwarded_allow_ips=forwarded_allow_ips,
+        access_log=access_log,
+        log_level=log_level,
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
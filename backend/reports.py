@@ -0,0 +1,204 @@
+"""
+Class roster and emergency contact reports
+
+Rendered in the report process pool of server.py. This module only imports
+the standard library, so worker processes start quickly and never load the
+web app or Motor. Each call renders one class; PdfDocument then assembles
+the rendered pages in the server process, one class at a time, so a report
+of the whole school can be streamed while later classes are still rendering.
+"""
+
+import csv
+import io
+import textwrap
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+# (student field, column title, column width in points)
+ROSTER_COLUMNS = [
+    ("first_and_last_name", "Nombre y Apellidos", 160),
+    ("allergies", "Alergias", 175),
+    ("mother_name", "Nombre de la Madre", 115),
+    ("mother_phone", "Teléfono de la Madre", 88),
+    ("father_name", "Nombre del Padre", 115),
+    ("father_phone", "Teléfono del Padre", 88),
+]
+ROSTER_FIELDS = [field for field, _, _ in ROSTER_COLUMNS]
+
+# A4 landscape
+PAGE_WIDTH = 842
+PAGE_HEIGHT = 595
+MARGIN = 36
+FONT_SIZE = 8
+LINE_HEIGHT = 10
+CELL_PADDING = 4
+BAND_HEIGHT = 28
+# Helvetica glyphs average about half the font size; this errs on the wide side
+CHAR_WIDTH = 0.55 * FONT_SIZE
+DEFAULT_BAND_COLOR = "#6B7280"
+
+FONT_OBJECTS = {3: b"Helvetica", 4: b"Helvetica-Bold"}
+FIRST_PAGE_OBJECT = 5
+
+
+def csv_header() -> bytes:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(["Clase", "Profesor/a"] + [title for _, title, _ in ROSTER_COLUMNS])
+    # The byte order mark makes spreadsheet programs read the accents as UTF-8
+    return b"\xef\xbb\xbf" + buffer.getvalue().encode()
+
+
+def render_csv_section(class_settings: dict, students: List[dict]) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for student in students:
+        writer.writerow(
+            [class_settings["class_name"], class_settings.get("teacher_name", "")]
+            + [student.get(field) or "" for field in ROSTER_FIELDS]
+        )
+    return buffer.getvalue().encode()
+
+
+def pdf_text(text: str) -> bytes:
+    """A PDF string literal in WinAnsiEncoding, which covers Spanish accents, ñ and º"""
+    encoded = text.encode("cp1252", errors="replace")
+    return b"(" + encoded.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)") + b")"
+
+
+def wrap(text: str, width: float) -> List[str]:
+    return textwrap.wrap(text, max(1, int((width - 2 * CELL_PADDING) / CHAR_WIDTH)), break_long_words=True) or [""]
+
+
+def hex_color(color: Optional[str]) -> Tuple[float, float, float]:
+    color = (color or DEFAULT_BAND_COLOR).lstrip("#")
+    try:
+        return tuple(int(color[i:i + 2], 16) / 255 for i in (0, 2, 4))
+    except (ValueError, IndexError):
+        return hex_color(DEFAULT_BAND_COLOR)
+
+
+class PageContent:
+    def __init__(self):
+        self.operators: List[bytes] = []
+
+    def text(self, x: float, y: float, text: str, font: str = "F1", size: float = FONT_SIZE):
+        self.operators.append(b"BT /%s %g Tf %.2f %.2f Td %s Tj ET" % (font.encode(), size, x, y, pdf_text(text)))
+
+    def fill_color(self, red: float, green: float, blue: float):
+        self.operators.append(b"%.3f %.3f %.3f rg" % (red, green, blue))
+
+    def rectangle(self, x: float, y: float, width: float, height: float):
+        self.operators.append(b"%.2f %.2f %.2f %.2f re f" % (x, y, width, height))
+
+    def rule(self, y: float):
+        self.operators.append(b"0.8 G 0.5 w %d %.2f m %d %.2f l S" % (MARGIN, y, PAGE_WIDTH - MARGIN, y))
+
+    def compressed(self) -> bytes:
+        return zlib.compress(b"\n".join(self.operators))
+
+
+def render_pdf_pages(school_name: str, class_settings: dict, students: List[dict]) -> List[bytes]:
+    """Compressed content streams of the pages listing one class"""
+    pages: List[PageContent] = []
+    band = hex_color(class_settings.get("background_color"))
+    # White text on dark class colors, black on light ones
+    band_text = (1, 1, 1) if 0.299 * band[0] + 0.587 * band[1] + 0.114 * band[2] < 0.6 else (0, 0, 0)
+    title = class_settings["class_name"]
+    count = f"{len(students)} alumno" if len(students) == 1 else f"{len(students)} alumnos"
+    subtitle = " · ".join(part for part in (class_settings.get("teacher_name"), count) if part)
+    headers = [wrap(column_title, width) for _, column_title, width in ROSTER_COLUMNS]
+    header_height = max(len(lines) for lines in headers) * LINE_HEIGHT + CELL_PADDING
+
+    def new_page() -> Tuple[PageContent, float]:
+        page = PageContent()
+        pages.append(page)
+        y = PAGE_HEIGHT - MARGIN
+        page.fill_color(0.3, 0.3, 0.3)
+        page.text(MARGIN, y - 10, school_name, size=10)
+        page.text(PAGE_WIDTH - MARGIN - 60, MARGIN - 16, f"Página {len(pages)}")
+        y -= 16 + BAND_HEIGHT
+        page.fill_color(*band)
+        page.rectangle(MARGIN, y, PAGE_WIDTH - 2 * MARGIN, BAND_HEIGHT)
+        page.fill_color(*band_text)
+        page.text(MARGIN + 8, y + 9, title, font="F2", size=14)
+        page.text(PAGE_WIDTH - MARGIN - 260, y + 10, subtitle, size=10)
+        page.fill_color(0, 0, 0)
+        y -= CELL_PADDING
+        x = MARGIN
+        for lines, (_, _, width) in zip(headers, ROSTER_COLUMNS):
+            for line_number, line in enumerate(lines):
+                page.text(x + CELL_PADDING, y - LINE_HEIGHT * (line_number + 1) + 2, line, font="F2")
+            x += width
+        y -= header_height
+        page.rule(y)
+        return page, y
+
+    page, y = new_page()
+    if not students:
+        page.text(MARGIN + CELL_PADDING, y - LINE_HEIGHT, "Sin alumnos")
+    for student in students:
+        cells = [wrap(student.get(field) or "", width) for field, _, width in ROSTER_COLUMNS]
+        row_height = max(len(lines) for lines in cells) * LINE_HEIGHT + CELL_PADDING
+        if y - row_height < MARGIN:
+            page, y = new_page()
+        x = MARGIN
+        for lines, (_, _, width) in zip(cells, ROSTER_COLUMNS):
+            for line_number, line in enumerate(lines):
+                page.text(x + CELL_PADDING, y - LINE_HEIGHT * (line_number + 1) + 2, line)
+            x += width
+        y -= row_height
+        page.rule(y)
+    return [page.compressed() for page in pages]
+
+
+class PdfDocument:
+    """Writes a PDF in order: the bytes of each page can be sent before later pages exist.
+
+    Objects 1 and 2, the catalog and the page tree, are only written by
+    finish(), once every page is known; the cross-reference table at the end
+    lets readers find them anyway.
+    """
+
+    def __init__(self):
+        self.offset = 0
+        self.offsets: Dict[int, int] = {}
+        self.page_ids: List[int] = []
+        self.next_id = FIRST_PAGE_OBJECT
+
+    def _object(self, object_id: int, body: bytes) -> bytes:
+        data = b"%d 0 obj\n%s\nendobj\n" % (object_id, body)
+        self.offsets[object_id] = self.offset
+        self.offset += len(data)
+        return data
+
+    def start(self) -> bytes:
+        header = b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"
+        self.offset = len(header)
+        return header + b"".join(
+            self._object(object_id, b"<< /Type /Font /Subtype /Type1 /BaseFont /%s /Encoding /WinAnsiEncoding >>" % name)
+            for object_id, name in FONT_OBJECTS.items()
+        )
+
+    def add_page(self, content: bytes) -> bytes:
+        content_id, page_id = self.next_id, self.next_id + 1
+        self.next_id += 2
+        self.page_ids.append(page_id)
+        return self._object(
+            content_id, b"<< /Length %d /Filter /FlateDecode >>\nstream\n%s\nendstream" % (len(content), content)
+        ) + self._object(
+            page_id,
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Resources << /Font << /F1 3 0 R /F2 4 0 R >> >> "
+            b"/Contents %d 0 R >>" % (PAGE_WIDTH, PAGE_HEIGHT, content_id),
+        )
+
+    def finish(self) -> bytes:
+        # A document needs at least one page
+        data = b"" if self.page_ids else self.add_page(zlib.compress(b""))
+        kids = b" ".join(b"%d 0 R" % page_id for page_id in self.page_ids)
+        data += self._object(2, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self.page_ids)))
+        data += self._object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        xref_offset = self.offset
+        data += b"xref\n0 %d\n0000000000 65535 f \n" % self.next_id
+        data += b"".join(b"%010d 00000 n \n" % self.offsets[object_id] for object_id in range(1, self.next_id))
+        data += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (self.next_id, xref_offset)
+        return data
@@ -1,32 +1,870 @@
-from fastapi import FastAPI, APIRouter, HTTPException
-from dotenv import load_dotenv
+from fastapi import FastAPI, APIRouter, Depends, Header, HTTPException, Query, Request, Response, UploadFile
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, DeleteOne, InsertOne, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError
+from pydantic import ValidationError
 import os
+import asyncio
+import base64
+import binascii
+import codecs
+import csv
+import io
+import re
+import unicodedata
+import hashlib
 import logging
+import sys
+import threading
+import time
+import orjson
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Any, Awaitable, Callable, Dict, List, Literal, Optional, Sequence, Tuple, Union
 import uuid
 from datetime import datetime, timezone
 
+import reports
+
 ROOT_DIR = Path(__file__).parent
-load_dotenv(ROOT_DIR / '.env')
+# Deployments set the environment directly, dotenv is only loaded for a local .env
+if (ROOT_DIR / '.env').exists():
+    from dotenv import load_dotenv
+    load_dotenv(ROOT_DIR / '.env')
+
+def env_int(name: str, default: Optional[int]) -> Optional[int]:
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+class Histogram:
+    """Thread-safe cumulative histogram of durations in milliseconds"""
+
+    BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS_MS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value_ms: float):
+        index = next((i for i, bound in enumerate(self.BUCKETS_MS) if value_ms <= bound), len(self.BUCKETS_MS))
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value_ms
+            self.max = max(self.max, value_ms)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "count": self.count,
+                "mean_ms": round(self.sum / self.count, 3) if self.count else 0.0,
+                "max_ms": round(self.max, 3),
+            }
+
+class PoolCheckoutMonitor(monitoring.ConnectionPoolListener):
+    """Records how long requests wait to check a connection out of the Motor pool.
+
+    Pymongo publishes these events synchronously on the thread doing the
+    checkout, so the start time is kept in a thread-local.
+    """
+
+    def __init__(self):
+        self.wait_ms = Histogram()
+        self.failed_checkouts = 0
+        self.open_connections = 0
+        self.checked_out = 0
+        self._started = threading.local()
+
+    def connection_check_out_started(self, event):
+        self._started.at = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        self.checked_out += 1
+        started = getattr(self._started, "at", None)
+        if started is not None:
+            self.wait_ms.observe((time.perf_counter() - started) * 1000)
+
+    def connection_check_out_failed(self, event):
+        self.failed_checkouts += 1
+
+    def connection_checked_in(self, event):
+        self.checked_out -= 1
+
+    def connection_created(self, event):
+        self.open_connections += 1
+
+    def connection_closed(self, event):
+        self.open_connections -= 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def stats(self) -> dict:
+        return {
+            "checkout_wait": self.wait_ms.stats(),
+            "failed_checkouts": self.failed_checkouts,
+            "open_connections": self.open_connections,
+            "checked_out_connections": self.checked_out,
+        }
+
+pool_monitor = PoolCheckoutMonitor()
+
+class CommandMonitor(monitoring.CommandListener):
+    """Records Mongo command durations and returned documents per collection and operation"""
+
+    def __init__(self):
+        self.durations: Dict[Tuple[str, str], Histogram] = defaultdict(Histogram)
+        self.documents: Dict[Tuple[str, str], int] = defaultdict(int)
+        self.failures: Dict[Tuple[str, str], int] = defaultdict(int)
+        self._pending: Dict[Tuple[Any, int], Tuple[str, str]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _collection(event) -> str:
+        if event.command_name == "getMore":
+            return event.command.get("collection", "")
+        collection = event.command.get(event.command_name)
+        return collection if isinstance(collection, str) else event.database_name
+
+    @staticmethod
+    def _document_count(reply: dict) -> int:
+        cursor = reply.get("cursor")
+        if cursor:
+            return len(cursor.get("firstBatch", cursor.get("nextBatch", [])))
+        return int(reply.get("n", 0))
+
+    def started(self, event):
+        with self._lock:
+            self._pending[(event.connection_id, event.request_id)] = (self._collection(event), event.command_name)
+
+    def succeeded(self, event):
+        with self._lock:
+            key = self._pending.pop((event.connection_id, event.request_id), None)
+            if key:
+                self.documents[key] += self._document_count(event.reply)
+        if key:
+            self.durations[key].observe(event.duration_micros / 1000)
+
+    def failed(self, event):
+        with self._lock:
+            key = self._pending.pop((event.connection_id, event.request_id), None)
+            if key:
+                self.failures[key] += 1
+        if key:
+            self.durations[key].observe(event.duration_micros / 1000)
+
+command_monitor = CommandMonitor()
+
+def create_mongo_client(**overrides) -> AsyncIOMotorClient:
+    """Build the Motor client from the MONGO_* environment variables.
+
+    Called from the lifespan, so every uvicorn worker creates its own pool
+    after the fork. Keyword arguments override individual pool options.
+    """
+    options = {
+        "maxPoolSize": env_int('MONGO_MAX_POOL_SIZE', 100),
+        "minPoolSize": env_int('MONGO_MIN_POOL_SIZE', 10),
+        "maxIdleTimeMS": env_int('MONGO_MAX_IDLE_TIME_MS', 300000),
+        "waitQueueTimeoutMS": env_int('MONGO_WAIT_QUEUE_TIMEOUT_MS', None),
+        "serverSelectionTimeoutMS": env_int('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000),
+        "connectTimeoutMS": env_int('MONGO_CONNECT_TIMEOUT_MS', 5000),
+        "socketTimeoutMS": env_int('MONGO_SOCKET_TIMEOUT_MS', 30000),
+    }
+    # e.g. MONGO_COMPRESSORS=zstd,snappy,zlib (zstd and snappy need their python packages)
+    compressors = os.environ.get('MONGO_COMPRESSORS')
+    if compressors:
+        options["compressors"] = compressors
+    options.update(overrides)
+    return AsyncIOMotorClient(
+        os.environ['MONGO_URL'],
+        event_listeners=[pool_monitor, command_monitor],
+        **{name: value for name, value in options.items() if value is not None},
+    )
+
+# MongoDB connection, created per worker in the lifespan
+client: Optional[AsyncIOMotorClient] = None
+db = None
+
+# Tenants
+# Every school is a tenant, picked per request by the X-Tenant-ID header, or
+# the tenant= query parameter where headers cannot be set (EventSource, <img>).
+# Tenants share the main database, with tenant_id leading every index, unless
+# TENANT_DATABASES gives them a database of their own, which is then reached
+# through a separate, smaller connection pool. Only configured tenants are
+# served: a school is provisioned by adding it to TENANTS or TENANT_DATABASES,
+# and its indexes and default classes are created when a worker starts.
+TENANT_HEADER = "X-Tenant-ID"
+DEFAULT_TENANT = os.environ.get('DEFAULT_TENANT', 'default')
+TENANT_ID_RE = re.compile(r"[a-z0-9][a-z0-9_-]{0,62}")
+# Tenants in the shared database besides the default one
+KNOWN_TENANTS = {tenant for tenant in os.environ.get('TENANTS', '').split(',') if tenant}
+# e.g. TENANT_DATABASES=ceip-grande:school_ceip_grande,cp-norte:school_cp_norte
+TENANT_DATABASES = dict(
+    entry.split(':', 1) for entry in os.environ.get('TENANT_DATABASES', '').split(',') if ':' in entry
+)
+SERVED_TENANTS = {DEFAULT_TENANT, *KNOWN_TENANTS, *TENANT_DATABASES}
+TENANT_MAX_POOL_SIZE = env_int('TENANT_MAX_POOL_SIZE', 20)
+# Requests of one tenant a worker runs at once, and how long extra ones wait for a slot
+TENANT_MAX_CONCURRENCY = env_int('TENANT_MAX_CONCURRENCY', 50)
+TENANT_QUEUE_TIMEOUT = float(os.environ.get('TENANT_QUEUE_TIMEOUT', '2'))
+
+current_tenant: ContextVar[str] = ContextVar("current_tenant", default=DEFAULT_TENANT)
+
+def tenant_key(name: str) -> str:
+    """Scope a cache key or version counter name to the current tenant"""
+    return f"{current_tenant.get()}:{name}"
+
+class Tenant:
+    """A school: the database holding its documents and its per-worker request budget"""
+
+    def __init__(self, tenant_id: str, database):
+        self.id = tenant_id
+        self.db = database
+        self.budget = asyncio.Semaphore(TENANT_MAX_CONCURRENCY)
+        self.in_flight = 0
+        self.rejected = 0
+
+    def scope(self, query: Optional[dict] = None) -> dict:
+        """Restrict a Mongo filter to this tenant's documents"""
+        return {"tenant_id": self.id, **(query or {})}
+
+    def stats(self) -> dict:
+        return {"database": self.db.name, "in_flight": self.in_flight, "rejected": self.rejected}
+
+tenants: Dict[str, Tenant] = {}
+tenant_clients: Dict[str, AsyncIOMotorClient] = {}
+
+def get_tenant(tenant_id: Optional[str] = None) -> Tenant:
+    tenant_id = tenant_id or current_tenant.get()
+    tenant = tenants.get(tenant_id)
+    if tenant is None:
+        database = db
+        if tenant_id in TENANT_DATABASES:
+            tenant_clients[tenant_id] = create_mongo_client(maxPoolSize=TENANT_MAX_POOL_SIZE, minPoolSize=0)
+            database = tenant_clients[tenant_id][TENANT_DATABASES[tenant_id]]
+        tenant = tenants[tenant_id] = Tenant(tenant_id, database)
+    return tenant
+
+def requested_tenant_id(x_tenant_id: Optional[str], tenant: Optional[str]) -> str:
+    tenant_id = x_tenant_id or tenant or DEFAULT_TENANT
+    if not TENANT_ID_RE.fullmatch(tenant_id):
+        raise HTTPException(status_code=400, detail="Invalid tenant id")
+    if tenant_id not in SERVED_TENANTS:
+        raise HTTPException(status_code=404, detail="Unknown tenant")
+    return tenant_id
+
+async def tenant_scope(
+    x_tenant_id: Optional[str] = Header(None, alias=TENANT_HEADER),
+    tenant: Optional[str] = Query(None, include_in_schema=False),
+) -> Tenant:
+    """Resolve the request's tenant; its concurrency slot is held by TenantBudgetMiddleware"""
+    tenant_id = requested_tenant_id(x_tenant_id, tenant)
+    current_tenant.set(tenant_id)
+    return get_tenant(tenant_id)
+
+# Server-sent event streams stay open for hours and would pin a request slot each
+LONG_LIVED_PATHS = ("/api/events",)
+
+def holds_request_slot(scope) -> bool:
+    """Whether a request takes the concurrency slots held until its response body is sent.
+
+    A yield dependency would release them as soon as the endpoint returns,
+    while a StreamingResponse body (exports, unpaginated lists, reports) still
+    runs, so the slots are taken by ASGI middlewares instead.
+    """
+    path = scope.get("path", "")
+    return scope["type"] == "http" and path.startswith("/api/") and path not in LONG_LIVED_PATHS
+
+class TenantBudgetMiddleware:
+    """Holds one of the tenant's concurrency slots until the whole response is sent.
+
+    Requests with an invalid tenant pass through and tenant_scope refuses them.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not holds_request_slot(scope):
+            await self.app(scope, receive, send)
+            return
+        request = Request(scope)
+        try:
+            tenant_id = requested_tenant_id(request.headers.get(TENANT_HEADER), request.query_params.get("tenant"))
+        except HTTPException:
+            await self.app(scope, receive, send)
+            return
+        scoped = get_tenant(tenant_id)
+        try:
+            await asyncio.wait_for(scoped.budget.acquire(), TENANT_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            scoped.rejected += 1
+            response = ORJSONResponse(
+                {"detail": "Too many concurrent requests for this school"}, status_code=503, headers={"Retry-After": "1"}
+            )
+            await response(scope, receive, send)
+            return
+        scoped.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            scoped.in_flight -= 1
+            scoped.budget.release()
+
+# Audit log
+# Mutating routes record who changed what in the tenant's audit_log. Records
+# are queued in memory and written in batches by a background task, so no
+# request waits on the insert. When the queue is full a request waits up to
+# AUDIT_ENQUEUE_TIMEOUT for room and the record is dropped after that; both
+# are counted.
+AUDIT_QUEUE_SIZE = env_int('AUDIT_QUEUE_SIZE', 10000)
+AUDIT_BATCH_SIZE = env_int('AUDIT_BATCH_SIZE', 500)
+AUDIT_FLUSH_INTERVAL = float(os.environ.get('AUDIT_FLUSH_INTERVAL', '1'))
+AUDIT_ENQUEUE_TIMEOUT = float(os.environ.get('AUDIT_ENQUEUE_TIMEOUT', '5'))
+AUDIT_SHUTDOWN_TIMEOUT = 10
+AUDIT_WRITE_RETRIES = 3
+AUDIT_ACTOR_HEADER = "X-User"
+# Bookkeeping fields that change on every write and say nothing about the edit
+AUDIT_IGNORED_FIELDS = ("tenant_id", "updated_seq", "first_and_last_name_lower", "search_name", "search_field_tokens", "search_tokens")
+
+current_actor: ContextVar[dict] = ContextVar("current_actor", default={})
+
+async def audit_actor(request: Request, x_user: Optional[str] = Header(None, alias=AUDIT_ACTOR_HEADER)):
+    """Remember who is making the request for the audit records it produces"""
+    current_actor.set({
+        "user": x_user,
+        "ip": request.client.host if request.client else None,
+        "user_agent": request.headers.get("user-agent"),
+    })
+
+def audit_changes(before: Optional[dict], after: Optional[dict]) -> Tuple[dict, dict]:
+    """The fields that differ between two versions of a document, as (before, after)"""
+    before, after = before or {}, after or {}
+    fields = [
+        field for field in {**before, **after}
+        if field not in AUDIT_IGNORED_FIELDS and field != "_id" and before.get(field) != after.get(field)
+    ]
+    return (
+        {field: before[field] for field in fields if field in before},
+        {field: after[field] for field in fields if field in after},
+    )
+
+class AuditLog:
+    """Bounded write-behind queue of audit records, flushed with insert_many"""
+
+    def __init__(self, max_size: int, batch_size: int, flush_interval: float):
+        self.queue: asyncio.Queue = asyncio.Queue(max_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enqueued = 0
+        self.written = 0
+        self.failed = 0
+        self.dropped = 0
+        self.backpressure_waits = 0
+        self.backpressure_wait_ms = Histogram()
+        self.flush_ms = Histogram()
+        self._task: Optional[asyncio.Task] = None
+
+    async def record(
+        self,
+        action: str,
+        collection: str,
+        document_id: Optional[str] = None,
+        before: Optional[dict] = None,
+        after: Optional[dict] = None,
+        details: Optional[dict] = None,
+    ):
+        before, after = audit_changes(before, after)
+        entry = {
+            "tenant_id": current_tenant.get(),
+            "at": datetime.now(timezone.utc),
+            "actor": current_actor.get(),
+            "action": action,
+            "collection": collection,
+            "document_id": document_id,
+            "before": before,
+            "after": after,
+        }
+        if details:
+            entry["details"] = details
+        try:
+            self.queue.put_nowait(entry)
+        except asyncio.QueueFull:
+            self.backpressure_waits += 1
+            started = time.perf_counter()
+            try:
+                await asyncio.wait_for(self.queue.put(entry), AUDIT_ENQUEUE_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.dropped += 1
+                logger.error(f"Audit queue full, dropped {action} of {collection} {document_id}")
+                return
+            finally:
+                self.backpressure_wait_ms.observe((time.perf_counter() - started) * 1000)
+        self.enqueued += 1
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Write every queued record; called on shutdown before the Mongo clients close"""
+        if self._task and not self._task.done():
+            await self.queue.put(None)
+            try:
+                await asyncio.wait_for(self._task, AUDIT_SHUTDOWN_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.error(f"Audit flush did not finish in {AUDIT_SHUTDOWN_TIMEOUT}s, {self.queue.qsize()} records left")
+            self._task = None
+        # Records from requests that finished after the stop marker
+        remaining = [entry for entry in (self.queue.get_nowait() for _ in range(self.queue.qsize())) if entry]
+        for start in range(0, len(remaining), self.batch_size):
+            await self.write(remaining[start:start + self.batch_size])
+
+    async def run(self):
+        while True:
+            entry = await self.queue.get()
+            if entry is None:
+                return
+            batch = [entry]
+            deadline = time.monotonic() + self.flush_interval
+            stopping = False
+            while len(batch) < self.batch_size:
+                if self.queue.empty():
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        entry = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    entry = self.queue.get_nowait()
+                if entry is None:
+                    stopping = True
+                    break
+                batch.append(entry)
+            await self.write(batch)
+            if stopping:
+                # Everything queued before the stop marker has been taken
+                return
+
+    async def write(self, batch: List[dict]):
+        started = time.perf_counter()
+        by_tenant: Dict[str, List[dict]] = defaultdict(list)
+        for entry in batch:
+            by_tenant[entry["tenant_id"]].append(entry)
+        for tenant_id, entries in by_tenant.items():
+            for attempt in range(AUDIT_WRITE_RETRIES):
+                try:
+                    await get_tenant(tenant_id).db.audit_log.insert_many(entries, ordered=False)
+                    self.written += len(entries)
+                    break
+                except BulkWriteError as e:
+                    # A retry after a lost reply finds its records already there
+                    errors = e.details.get("writeErrors", [])
+                    duplicates = sum(1 for error in errors if error.get("code") == 11000)
+                    self.written += e.details.get("nInserted", 0) + duplicates
+                    self.failed += len(errors) - duplicates
+                    if len(errors) > duplicates:
+                        logger.error(f"Failed to write {len(errors) - duplicates} audit records for {tenant_id}")
+                    break
+                except PyMongoError as e:
+                    if attempt == AUDIT_WRITE_RETRIES - 1:
+                        self.failed += len(entries)
+                        logger.error(f"Failed to write {len(entries)} audit records for {tenant_id}: {e}")
+                    else:
+                        await asyncio.sleep(0.5 * 2 ** attempt)
+        self.flush_ms.observe((time.perf_counter() - started) * 1000)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "queue_size": self.queue.maxsize,
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "backpressure_waits": self.backpressure_waits,
+            "backpressure_wait": self.backpressure_wait_ms.stats(),
+            "flush": self.flush_ms.stats(),
+        }
+
+audit_log = AuditLog(AUDIT_QUEUE_SIZE, AUDIT_BATCH_SIZE, AUDIT_FLUSH_INTERVAL)
+
+# Admission control
+# Write, bulk and report routes are rate limited with token buckets, one per
+# route class and client address, answering 429 when a client's bucket is
+# empty. The address is the one uvicorn takes from X-Forwarded-For when the
+# proxy is listed in FORWARDED_ALLOW_IPS; headers the client picks itself
+# (X-User, X-Tenant-ID) are not part of the key, or every request could
+# claim a fresh bucket. The buckets live in this process, or with
+# RATE_LIMIT_BACKEND=mongo in the rate_limits collection shared by every
+# worker, falling back to the local buckets when Mongo cannot be reached.
+# Independently, at most ADMISSION_MAX_CONCURRENCY requests run at once per
+# worker, each until its response body is sent; a request that cannot start
+# within ADMISSION_QUEUE_TIMEOUT, or finds ADMISSION_MAX_QUEUE requests
+# already waiting, is answered 503 instead of queueing for a pool connection.
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+# Route class: (tokens refilled per second, bucket size); a rate of 0 disables the limit
+RATE_LIMITS = {
+    "write": (float(os.environ.get('RATE_LIMIT_WRITE_PER_SECOND', '10')), env_int('RATE_LIMIT_WRITE_BURST', 30)),
+    "bulk": (float(os.environ.get('RATE_LIMIT_BULK_PER_SECOND', '0.2')), env_int('RATE_LIMIT_BULK_BURST', 3)),
+    # Reports are rendered in the report pool and cached, so a teacher can print a few in a row
+    "report": (float(os.environ.get('RATE_LIMIT_REPORT_PER_SECOND', '1')), env_int('RATE_LIMIT_REPORT_BURST', 10)),
+}
+# Routes that write many documents in one request
+BULK_ROUTES = ("/api/students/bulk", "/api/students/batch", "/api/classes/reset-colors")
+REPORT_ROUTES = ("/api/reports/roster",)
+RATE_LIMIT_MAX_BUCKETS = 100000
+ADMISSION_MAX_CONCURRENCY = env_int('ADMISSION_MAX_CONCURRENCY', 2 * env_int('MONGO_MAX_POOL_SIZE', 100))
+ADMISSION_MAX_QUEUE = env_int('ADMISSION_MAX_QUEUE', ADMISSION_MAX_CONCURRENCY)
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', '0.5'))
+
+class TokenBucketLimiter:
+    """In-process token buckets, keyed by client and route class"""
+
+    def __init__(self, limits: Dict[str, Tuple[float, int]]):
+        self.limits = limits
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+
+    async def take(self, key: str, route_class: str) -> float:
+        """Take a token; returns 0 when admitted, else the seconds until a token is available"""
+        rate, burst = self.limits[route_class]
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        admitted = tokens >= 1
+        self._buckets[key] = (tokens - 1 if admitted else tokens, now)
+        if len(self._buckets) > RATE_LIMIT_MAX_BUCKETS:
+            self.prune(now)
+        return 0 if admitted else (1 - tokens) / rate
+
+    def prune(self, now: float):
+        # A bucket that has refilled completely is the same as no bucket
+        slowest_refill = max(burst / rate for rate, burst in self.limits.values() if rate > 0)
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if now - bucket[1] < slowest_refill}
+
+class MongoTokenBucketLimiter(TokenBucketLimiter):
+    """Token buckets shared by every worker in the rate_limits collection"""
+
+    def __init__(self, limits: Dict[str, Tuple[float, int]]):
+        super().__init__(limits)
+        self.fallbacks = 0
+
+    async def take(self, key: str, route_class: str) -> float:
+        rate, burst = self.limits[route_class]
+        now = time.time()
+        try:
+            # Refill and take in one pipeline update, so concurrent requests never share a token
+            bucket = await db.rate_limits.find_one_and_update(
+                {"_id": key},
+                [
+                    {"$set": {
+                        "tokens": {"$min": [burst, {"$add": [
+                            {"$ifNull": ["$tokens", burst]},
+                            {"$multiply": [{"$subtract": [now, {"$ifNull": ["$at", now]}]}, rate]},
+                        ]}]},
+                        "at": now,
+                        # Removed by the TTL index once it would have refilled anyway
+                        "expires_at": {"$add": ["$$NOW", int(burst / rate * 1000)]},
+                    }},
+                    {"$set": {
+                        "admitted": {"$gte": ["$tokens", 1]},
+                        "tokens": {"$cond": [{"$gte": ["$tokens", 1]}, {"$subtract": ["$tokens", 1]}, "$tokens"]},
+                    }},
+                ],
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except PyMongoError as e:
+            self.fallbacks += 1
+            logger.warning(f"Shared rate limit unavailable, using local buckets: {e}")
+            return await super().take(key, route_class)
+        return 0 if bucket["admitted"] else (1 - bucket["tokens"]) / rate
+
+rate_limiter = (MongoTokenBucketLimiter if RATE_LIMIT_BACKEND == "mongo" else TokenBucketLimiter)(RATE_LIMITS)
+
+class AdmissionControl:
+    """Caps the requests running at once and counts admitted and rejected requests per route class"""
+
+    def __init__(self, max_concurrency: int, max_queue: int, queue_timeout: float):
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted: Dict[str, int] = defaultdict(int)
+        # (route class, "rate_limited" or "overloaded")
+        self.rejected: Dict[Tuple[str, str], int] = defaultdict(int)
+
+    async def acquire(self, route_class: str):
+        if self.slots.locked() and self.waiting >= self.max_queue:
+            self.reject(route_class, "overloaded", 1)
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.reject(route_class, "overloaded", 1)
+        finally:
+            self.waiting -= 1
+        self.admitted[route_class] += 1
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self.slots.release()
+
+    def reject(self, route_class: str, reason: str, retry_after: float):
+        self.rejected[(route_class, reason)] += 1
+        if reason == "rate_limited":
+            raise HTTPException(status_code=429, detail="Too many requests, slow down",
+                                headers={"Retry-After": str(max(1, round(retry_after + 0.5)))})
+        raise HTTPException(status_code=503, detail="Server busy, try again shortly",
+                            headers={"Retry-After": str(retry_after)})
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "admitted": dict(self.admitted),
+            "rejected": {f"{route_class}:{reason}": count for (route_class, reason), count in self.rejected.items()},
+        }
+
+admission = AdmissionControl(ADMISSION_MAX_CONCURRENCY, ADMISSION_MAX_QUEUE, ADMISSION_QUEUE_TIMEOUT)
+
+def route_class(method: str, path: str) -> str:
+    # Decided before routing, so from the path rather than the route template
+    if path in REPORT_ROUTES:
+        return "report"
+    if path in BULK_ROUTES:
+        return "bulk"
+    return "read" if method in ("GET", "HEAD", "OPTIONS") else "write"
+
+def rate_limit_key(request: Request, request_class: str) -> str:
+    client_address = request.client.host if request.client else "unknown"
+    return f"{request_class}:{client_address}"
+
+class AdmissionMiddleware:
+    """Rate limits the client, then holds one of the worker's request slots until the whole response is sent"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not holds_request_slot(scope):
+            await self.app(scope, receive, send)
+            return
+        request_class = route_class(scope["method"], scope["path"])
+        try:
+            rate, _ = RATE_LIMITS.get(request_class, (0, 0))
+            if rate > 0:
+                retry_after = await rate_limiter.take(rate_limit_key(Request(scope), request_class), request_class)
+                if retry_after:
+                    admission.reject(request_class, "rate_limited", retry_after)
+            await admission.acquire(request_class)
+        except HTTPException as e:
+            await ORJSONResponse({"detail": e.detail}, status_code=e.status_code, headers=e.headers)(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            admission.release()
+
+# Students are read through the Motor cursor in batches of this size, and
+# paginated reads never return more than STUDENT_PAGE_MAX documents at once.
+STUDENT_BATCH_SIZE = 500
+STUDENT_PAGE_MAX = 1000
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+# Student fields matched by GET /api/students/search
+SEARCHABLE_NAME_FIELDS = ("first_and_last_name", "mother_name", "father_name")
+SEARCHABLE_PHONE_FIELDS = ("mother_phone", "father_phone")
+SEARCHABLE_FIELDS = SEARCHABLE_NAME_FIELDS + SEARCHABLE_PHONE_FIELDS
+SEARCH_LIMIT_MAX = 100
+
+# Bulk imports are validated and written in chunks of this many rows, and at
+# most BULK_MAX_REPORTED_ERRORS per-row errors are returned to the client.
+BULK_CHUNK_SIZE = 1000
+BULK_MAX_REPORTED_ERRORS = 1000
+BATCH_MAX_OPERATIONS = 1000
+
+# GET /api/sync pages, and how long deletions are remembered for it. A sync
+# token older than SYNC_TOMBSTONE_DAYS can miss deletions and is refused.
+SYNC_PAGE_DEFAULT = 500
+SYNC_PAGE_MAX = 2000
+SYNC_TOMBSTONE_DAYS = env_int('SYNC_TOMBSTONE_DAYS', 30)
+# Each worker takes sequence numbers from the tenant's counter in blocks of
+# SYNC_BLOCK_SIZE and, every SYNC_FLUSH_INTERVAL seconds, publishes the lowest
+# number it may still commit and gives back the ones it has not used. A worker
+# that stops publishing for SYNC_LEASE_SECONDS is presumed dead and skipped.
+SYNC_BLOCK_SIZE = env_int('SYNC_BLOCK_SIZE', 100)
+SYNC_FLUSH_INTERVAL = float(os.environ.get('SYNC_FLUSH_INTERVAL', '1'))
+SYNC_LEASE_SECONDS = 30
+
+# Class and app settings are served from memory for at most this many seconds,
+# and only while their collection version is unchanged
+SETTINGS_CACHE_TTL = float(os.environ.get('SETTINGS_CACHE_TTL', '30'))
+
+# Responses smaller than this are not compressed
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))
+
+# How often each worker re-reads the collection version counters written by
+# the other workers, i.e. the longest a 304 can lag behind another worker's write
+VERSION_SYNC_INTERVAL = float(os.environ.get('VERSION_SYNC_INTERVAL', '1'))
+
+# Set DEBUG=1 to verify at startup that the hot queries are served by an index
+DEBUG = os.environ.get('DEBUG', '').lower() in ('1', 'true', 'yes')
+
+# Requests slower than PROFILE_SLOW_REQUEST_MS get the event loop stacks
+# sampled during them written to PROFILE_DIR in folded (flamegraph) format.
+PROFILE_SLOW_REQUEST_MS = env_int('PROFILE_SLOW_REQUEST_MS', None)
+PROFILE_DIR = Path(os.environ.get('PROFILE_DIR', ROOT_DIR / 'profiles'))
+PROFILE_INTERVAL_MS = env_int('PROFILE_INTERVAL_MS', 5)
+
+class StackSampler:
+    """Samples the event loop thread's stack from a background thread.
+
+    Samples are kept in a bounded ring buffer. Requests interleave on the
+    loop, so the stacks dumped for a slow request are everything the loop
+    ran during it, which is what made it slow.
+    """
+
+    def __init__(self, interval_ms: int, max_samples: int = 60000):
+        self.interval = interval_ms / 1000
+        self.samples: deque = deque(maxlen=max_samples)
+        self._thread_id: Optional[int] = None
+        self._stop = threading.Event()
+
+    def start(self):
+        self._thread_id = threading.get_ident()
+        self._stop.clear()
+        threading.Thread(target=self._run, name="stack-sampler", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.samples.append((time.perf_counter(), ";".join(reversed(stack))))
+
+    def folded(self, started: float, finished: float) -> str:
+        counts: Dict[str, int] = defaultdict(int)
+        for at, stack in list(self.samples):
+            if started <= at <= finished:
+                counts[stack] += 1
+        return "".join(f"{stack} {count}\n" for stack, count in counts.items())
+
+stack_sampler = StackSampler(PROFILE_INTERVAL_MS) if PROFILE_SLOW_REQUEST_MS is not None else None
+
+def dump_slow_request_profile(method: str, route: str, started: float, finished: float):
+    stacks = stack_sampler.folded(started, finished)
+    if not stacks:
+        return
+    PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+    name = re.sub(r"[^\w.-]+", "_", f"{method}{route}").strip("_")
+    path = PROFILE_DIR / f"{int(time.time() * 1000)}-{name}.folded"
+    path.write_text(stacks)
+    logger.warning(f"Slow request {method} {route} took {(finished - started) * 1000:.0f}ms, stacks in {path}")
+
+request_durations: Dict[Tuple[str, str], Histogram] = defaultdict(Histogram)
+request_responses: Dict[Tuple[str, str, int], int] = defaultdict(int)
+
+class RequestMetricsMiddleware:
+    """Records a latency histogram per method and route template, until the body is sent"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+        started = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            finished = time.perf_counter()
+            # The route template keeps the number of series bounded
+            route = getattr(scope.get("route"), "path", "unmatched")
+            key = (scope["method"], route)
+            request_durations[key].observe((finished - started) * 1000)
+            request_responses[key + (status,)] += 1
+            if stack_sampler and (finished - started) * 1000 >= PROFILE_SLOW_REQUEST_MS:
+                asyncio.get_running_loop().run_in_executor(
+                    None, dump_slow_request_profile, scope["method"], route, started, finished
+                )
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global client, db, report_pool
+    client = create_mongo_client()
+    db = client[os.environ['DB_NAME']]
+    await prepare_database()
+    await warm_up()
+    change_feed = asyncio.create_task(run_change_feed())
+    audit_log.start()
+    sync_sequence.start()
+    if stack_sampler:
+        stack_sampler.start()
+    yield
+    if stack_sampler:
+        stack_sampler.stop()
+    change_feed.cancel()
+    await sync_sequence.stop()
+    await audit_log.stop()
+    if report_pool:
+        report_pool.shutdown(wait=False, cancel_futures=True)
+        report_pool = None
+    for tenant_client in tenant_clients.values():
+        tenant_client.close()
+    tenant_clients.clear()
+    tenants.clear()
+    client.close()
 
 # Create the main app without a prefix
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
-# Create a router with the /api prefix
-api_router = APIRouter(prefix="/api")
+# Create a router with the /api prefix; every route is tenant scoped and audited
+api_router = APIRouter(prefix="/api", dependencies=[Depends(tenant_scope), Depends(audit_actor)])
 
 # Define Models with father_name field
 class Student(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    tenant_id: str = DEFAULT_TENANT
     first_and_last_name: str
     class_name: str
     mother_name: str = ""
@@ -35,6 +873,7 @@ class Student(BaseModel):
     father_phone: str = ""
     allergies: str = ""
     comments: str = ""
+    updated_seq: int = 0
 
 class StudentCreate(BaseModel):
     first_and_last_name: str
@@ -56,11 +895,43 @@ class StudentUpdate(BaseModel):
     allergies: Optional[str] = None
     comments: Optional[str] = None
 
+class StudentBatchOperation(BaseModel):
+    op: Literal["update", "delete", "move"]
+    id: str
+    # Fields to set for "update", target class for "move"
+    update: Optional[StudentUpdate] = None
+    class_name: Optional[str] = None
+
+class StudentBatch(BaseModel):
+    operations: List[StudentBatchOperation] = Field(..., min_length=1, max_length=BATCH_MAX_OPERATIONS)
+    # Apply all operations or none; needs a replica set
+    transaction: bool = False
+
+class StudentBatchResult(BaseModel):
+    index: int
+    id: str
+    status: Literal["ok", "not_found", "invalid", "error"]
+    error: Optional[str] = None
+
+class StudentSummary(BaseModel):
+    id: str
+    first_and_last_name: str
+
+# Read paths fetch exactly the response fields from Mongo and encode them
+# straight to JSON, without building a Pydantic model per document.
+STUDENT_FIELDS = list(Student.model_fields)
+STUDENT_PROJECTION = {"_id": 0, **{field: 1 for field in STUDENT_FIELDS}}
+
+# Named sparse fieldsets accepted by the fields= query parameter
+STUDENT_FIELD_SETS = {"summary": list(StudentSummary.model_fields)}
+
 class ClassSettings(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    tenant_id: str = DEFAULT_TENANT
     class_name: str
     teacher_name: str = "Profesor/a"
     background_color: str = "#3B82F6"
+    updated_seq: int = 0
 
 class ClassSettingsCreate(BaseModel):
     class_name: str
@@ -69,124 +940,1829 @@ class ClassSettingsCreate(BaseModel):
 
 class AppSettings(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    tenant_id: str = DEFAULT_TENANT
     school_name: str = "CEIP Josefina Carabias"
     home_image_url: str = ""
 
+class StoredImage(BaseModel):
+    id: str
+    url: str
+    content_type: str
+    variants: List[str]
+
+class DashboardClass(ClassSettings):
+    student_count: int = 0
+
+class Dashboard(BaseModel):
+    settings: AppSettings
+    classes: List[DashboardClass]
+    total_students: int
+
+class SyncDeletion(BaseModel):
+    collection: Literal["students"]
+    id: str
+    class_name: Optional[str] = None
+    updated_seq: int
+
+class SyncPage(BaseModel):
+    students: List[Student]
+    classes: List[ClassSettings]
+    deleted: List[SyncDeletion]
+    # Pass as since= on the next call; has_more asks for it right away
+    token: str
+    has_more: bool
+
+class SingleFlight:
+    """Share one in-flight load among concurrent identical reads.
+
+    The first caller for a key starts the load as a task and later callers
+    await that same task, so a burst of identical requests costs one Mongo
+    query. The task is shielded, so a caller that disconnects does not cancel
+    it for the others. Each flight is tagged with the collections it reads;
+    forget() detaches the flights of a collection that was just written, so
+    reads arriving after a write never join a load that started before it.
+    """
+
+    def __init__(self):
+        self.leaders = 0
+        self.coalesced = 0
+        self._flights: Dict[Any, Tuple[asyncio.Task, Tuple[str, ...]]] = {}
+
+    async def do(self, key: Any, loader: Callable[[], Awaitable[Any]], tags: Tuple[str, ...] = ()) -> Any:
+        flight = self._flights.get(key)
+        if flight is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(loader())
+            self._flights[key] = (task, tags)
+            task.add_done_callback(lambda _: self._finish(key, task))
+        else:
+            self.coalesced += 1
+            task = flight[0]
+        return await asyncio.shield(task)
+
+    def _finish(self, key: Any, task: asyncio.Task):
+        flight = self._flights.get(key)
+        if flight is not None and flight[0] is task:
+            del self._flights[key]
+        if not task.cancelled():
+            # Mark the exception retrieved when every caller has gone away
+            task.exception()
+
+    def forget(self, *tags: str):
+        for key, (_, flight_tags) in list(self._flights.items()):
+            if any(tag in flight_tags for tag in tags):
+                del self._flights[key]
+
+    def stats(self) -> dict:
+        return {"leaders": self.leaders, "coalesced": self.coalesced, "in_flight": len(self._flights)}
+
+single_flight = SingleFlight()
+
+class TTLCache:
+    """Async-safe in-process cache of small, read-mostly JSON documents.
+
+    Values are stored already serialized, together with their ETag, so a hit
+    costs neither a Mongo round trip nor a Pydantic validation. Keys are
+    scoped to the current tenant. Each key caches one collection, and an
+    entry is only served while that collection's version is the one it was
+    loaded at, so a write in another worker retires it within
+    VERSION_SYNC_INTERVAL instead of the TTL.
+    """
+
+    def __init__(self, ttl: float, collections: Dict[str, str]):
+        self.ttl = ttl
+        self.collections = collections
+        self.hits = 0
+        self.misses = 0
+        self._entries: Dict[str, Tuple[float, int, bytes, str]] = {}
+        self._generation = 0
+
+    async def get_or_load(self, key: str, loader: Callable[[], Awaitable[Any]]) -> Tuple[bytes, str]:
+        version, = await collection_versions.current(self.collections[key])
+        key = tenant_key(key)
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.monotonic() and entry[1] == version:
+            self.hits += 1
+            return entry[2], entry[3]
+
+        # Only one request per key and version goes to Mongo, the others share its result
+        self.misses += 1
+        return await single_flight.do(
+            ("cache", key, version), lambda: self._load(key, version, loader), ("cache", f"cache:{key}")
+        )
+
+    async def _load(self, key: str, version: int, loader: Callable[[], Awaitable[Any]]) -> Tuple[bytes, str]:
+        generation = self._generation
+        body = orjson.dumps(await loader())
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        # Do not store a value loaded concurrently with an invalidation
+        if generation == self._generation:
+            self._entries[key] = (time.monotonic() + self.ttl, version, body, etag)
+        return body, etag
+
+    def invalidate(self, key: Optional[str] = None):
+        self._generation += 1
+        if key is None:
+            self._entries.clear()
+            single_flight.forget("cache")
+        else:
+            key = tenant_key(key)
+            self._entries.pop(key, None)
+            single_flight.forget(f"cache:{key}")
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+settings_cache = TTLCache(SETTINGS_CACHE_TTL, {"classes": "class_settings", "settings": "app_settings"})
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+class CollectionVersions:
+    """Per-collection write counters used to build strong ETags.
+
+    Write routes bump the counter of the collections they change, in Mongo
+    so every worker sees it. Reads use the in-process copy, refreshed at
+    most every VERSION_SYNC_INTERVAL seconds, so an unchanged list can be
+    answered with 304 without querying the collection itself. Counters are
+    kept per tenant, as "<tenant>:<collection>".
+    """
+
+    def __init__(self, sync_interval: float):
+        self.sync_interval = sync_interval
+        self.versions: Dict[str, int] = defaultdict(int)
+        self.local_bumps: Dict[str, int] = defaultdict(int)
+        self._synced_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def bump(self, *collections: str):
+        names = [tenant_key(collection) for collection in collections]
+        single_flight.forget(*names)
+        for name in names:
+            self.local_bumps[name] += 1
+            counter = await db.collection_versions.find_one_and_update(
+                {"_id": name},
+                {"$inc": {"version": 1}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+            self.versions[name] = max(self.versions[name], counter["version"])
+
+    async def current(self, *collections: str) -> Tuple[int, ...]:
+        await self.sync()
+        return tuple(self.versions[tenant_key(collection)] for collection in collections)
+
+    async def sync(self):
+        if time.monotonic() - self._synced_at > self.sync_interval:
+            async with self._lock:
+                if time.monotonic() - self._synced_at > self.sync_interval:
+                    async for counter in db.collection_versions.find():
+                        self.versions[counter["_id"]] = max(self.versions[counter["_id"]], counter["version"])
+                    self._synced_at = time.monotonic()
+
+collection_versions = CollectionVersions(VERSION_SYNC_INTERVAL)
+
+class SequenceBlock:
+    """Sequence numbers of one tenant that this worker took from the counter"""
+
+    def __init__(self):
+        # Unused numbers are next .. end - 1
+        self.next = 0
+        self.end = 0
+        # First number of every allocation whose write has not finished yet
+        self.in_flight: Dict[object, int] = {}
+        # Highest counter value seen; every number handed out later is above it
+        self.last_seen = 0
+        # The counter document holds a lease of this worker
+        self.leased = False
+        self.lock = asyncio.Lock()
+
+    def floor(self) -> Optional[int]:
+        """Lowest number this worker may still commit, None when it holds none"""
+        numbers = list(self.in_flight.values())
+        if self.next < self.end:
+            numbers.append(self.next)
+        return min(numbers) if numbers else None
+
+class SyncSequence:
+    """Per-tenant change sequence behind GET /api/sync.
+
+    Every student and class write stamps the documents it changes with an
+    updated_seq taken from here. Numbers are handed out before the write
+    commits, so each worker keeps a lease in the tenant's counter document
+    with the lowest number it may still commit: watermark() never passes a
+    leased number, and a sync can never step over a write that lands later
+    with a lower number.
+
+    Numbers come from local blocks, so most writes make no round trip for
+    them and the counter document, which every write of a school would
+    otherwise update, sees one update per worker and interval.
+    """
+
+    def __init__(self, block_size: int, flush_interval: float):
+        self.worker = uuid.uuid4().hex
+        self.block_size = block_size
+        self.flush_interval = flush_interval
+        self.blocks: Dict[str, SequenceBlock] = defaultdict(SequenceBlock)
+        self.refills = 0
+        self._task: Optional[asyncio.Task] = None
+
+    @asynccontextmanager
+    async def allocate(self, count: int = 1):
+        """Yield the first of count new sequence numbers, leased until the block exits"""
+        block = self.blocks[current_tenant.get()]
+        allocation = object()
+        if block.end - block.next < count:
+            # Until the counter answers, the new numbers are only known to be above the last value seen
+            block.in_flight[allocation] = block.last_seen + 1
+            try:
+                async with block.lock:
+                    if block.end - block.next < count:
+                        await self._refill(block, count)
+            except BaseException:
+                del block.in_flight[allocation]
+                raise
+        first = block.in_flight[allocation] = block.next
+        block.next += count
+        try:
+            yield first
+        finally:
+            del block.in_flight[allocation]
+
+    async def _refill(self, block: SequenceBlock, count: int):
+        size = max(count, self.block_size)
+        # The lease is written with the numbers, at a floor below all of them
+        counter = await db.sync_sequences.find_one_and_update(
+            {"_id": current_tenant.get()},
+            {"$inc": {"seq": size}, "$set": {f"leases.{self.worker}": {"floor": block.floor(), "at": time.time()}}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        self.refills += 1
+        block.leased = True
+        block.last_seen = max(block.last_seen, counter["seq"])
+        block.next, block.end = counter["seq"] - size + 1, counter["seq"] + 1
+
+    async def watermark(self) -> int:
+        """Highest sequence number below which every write has committed"""
+        tenant_id = current_tenant.get()
+        counter = await db.sync_sequences.find_one({"_id": tenant_id})
+        if counter is None:
+            return 0
+        expired_before = time.time() - SYNC_LEASE_SECONDS
+        floors = []
+        for worker, lease in counter.get("leases", {}).items():
+            if worker == self.worker:
+                # This worker's own numbers are known here better than in its last published lease
+                continue
+            if lease["at"] >= expired_before:
+                floors.append(lease["floor"])
+            else:
+                await db.sync_sequences.update_one(
+                    {"_id": tenant_id, f"leases.{worker}.at": {"$lt": expired_before}}, {"$unset": {f"leases.{worker}": ""}}
+                )
+                logger.warning(f"Dropped the sync sequence lease of unresponsive worker {worker} of tenant {tenant_id}")
+        block = self.blocks.get(tenant_id)
+        if block is not None:
+            block.last_seen = max(block.last_seen, counter["seq"])
+            if block.floor() is not None:
+                floors.append(block.floor())
+        return min(min(floors) - 1, counter["seq"]) if floors else counter["seq"]
+
+    async def flush(self):
+        """Publish the lowest number this worker may still commit, per tenant, and give back unused numbers"""
+        for tenant_id, block in list(self.blocks.items()):
+            if not block.leased:
+                continue
+            async with block.lock:
+                # Unused numbers would hold back the writes of every other worker, so blocks last one interval
+                block.next = block.end
+                floor = block.floor()
+                if floor is None:
+                    update = {"$unset": {f"leases.{self.worker}": ""}}
+                else:
+                    update = {"$set": {f"leases.{self.worker}": {"floor": floor, "at": time.time()}}}
+                await db.sync_sequences.update_one({"_id": tenant_id}, update)
+                block.leased = floor is not None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except PyMongoError as e:
+                logger.warning(f"Could not publish sync sequence leases: {e}")
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Give back every lease; called on shutdown once requests have finished"""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        try:
+            await self.flush()
+        except PyMongoError as e:
+            logger.warning(f"Could not release sync sequence leases: {e}")
+
+sync_sequence = SyncSequence(SYNC_BLOCK_SIZE, SYNC_FLUSH_INTERVAL)
+
+# Change feed
+# Per-document deltas are pushed to GET /api/events subscribers. On a replica
+# set they come from a Mongo change stream, so every worker sees every write.
+# A standalone mongod has no change streams: then each worker publishes its
+# own writes and polls the collection version counters, sending a "resync"
+# for a collection when another worker changed it. The stream publishes a
+# deleted student from the tombstone written with the deletion, and tells a
+# moved student's old class from the pre-image, where the server keeps them.
+CHANGE_POLL_INTERVAL = float(os.environ.get('CHANGE_POLL_INTERVAL', '1'))
+CHANGE_QUEUE_SIZE = 1000
+CHANGE_KEEPALIVE_SECONDS = 15
+WATCHED_COLLECTIONS = ("students", "class_settings")
+
+class ChangeSubscriber:
+    def __init__(self, tenant_id: str, class_name: Optional[str]):
+        self.tenant_id = tenant_id
+        self.class_name = class_name
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=CHANGE_QUEUE_SIZE)
+        # Set when the client fell too far behind and must reload everything
+        self.overflowed = False
+
+    def wants(self, event: dict) -> bool:
+        # Events without a tenant are resyncs that could concern any tenant
+        if event.get("tenant_id", self.tenant_id) != self.tenant_id:
+            return False
+        if self.class_name is None or event["collection"] != "students" or event["op"] == "resync":
+            return True
+        if event.get("class_name") == self.class_name:
+            return True
+        # Students moved to another class are sent to their old class too, so it can drop them.
+        # A move seen by a change stream without pre-images does not say which class that was.
+        return event.get("class_changed", False) and event.get("previous_class_name", self.class_name) == self.class_name
+
+class ChangeHub:
+    """Fans change events out to the subscribers of this worker"""
+
+    def __init__(self):
+        self.subscribers: set = set()
+        self.uses_change_stream = False
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self, tenant_id: str, class_name: Optional[str]) -> ChangeSubscriber:
+        subscriber = ChangeSubscriber(tenant_id, class_name)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: ChangeSubscriber):
+        self.subscribers.discard(subscriber)
+
+    def publish(self, event: dict):
+        self.published += 1
+        for subscriber in list(self.subscribers):
+            if not subscriber.wants(event):
+                continue
+            try:
+                subscriber.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                subscriber.overflowed = True
+                self.dropped += 1
+
+    def publish_local(self, event: dict):
+        """Publish a write made by this worker, unless the change stream already delivers it"""
+        if not self.uses_change_stream:
+            self.publish(event)
+
+    def stats(self) -> dict:
+        return {
+            "source": "change_stream" if self.uses_change_stream else "polling",
+            "subscribers": len(self.subscribers),
+            "published": self.published,
+            "dropped": self.dropped,
+        }
+
+change_hub = ChangeHub()
+
+def student_change(
+    op: str, student: dict, class_changed: bool = False, previous_class_name: Optional[str] = None
+) -> dict:
+    event = {
+        "collection": "students",
+        "op": op,
+        "tenant_id": student.get("tenant_id"),
+        "id": student["id"],
+        "class_name": student.get("class_name"),
+    }
+    if op == "upsert":
+        event["document"] = {field: student[field] for field in STUDENT_FIELDS if field in student}
+    if class_changed:
+        event["class_changed"] = True
+        if previous_class_name is not None:
+            event["previous_class_name"] = previous_class_name
+    return event
+
+def class_settings_change(op: str, class_settings: dict) -> dict:
+    event = {"collection": "class_settings", "op": op, "tenant_id": class_settings.get("tenant_id"), "id": class_settings.get("id")}
+    if op == "upsert":
+        event["document"] = {field: class_settings[field] for field in ClassSettings.model_fields if field in class_settings}
+    return event
+
+def resync_change(collection: str, tenant_id: Optional[str] = None) -> dict:
+    event = {"collection": collection, "op": "resync"}
+    if tenant_id is not None:
+        event["tenant_id"] = tenant_id
+    return event
+
+def change_stream_event(change: dict) -> Optional[dict]:
+    collection = change["ns"]["coll"]
+    operation = change["operationType"]
+    if collection == "tombstones":
+        # Deleted students are published from their tombstone, which names the tenant and class
+        return student_change("delete", change["fullDocument"])
+    if operation in ("insert", "update", "replace") and change.get("fullDocument"):
+        document = change["fullDocument"]
+        if collection == "class_settings":
+            return class_settings_change("upsert", document)
+        updated_fields = change.get("updateDescription", {}).get("updatedFields", {})
+        previous = change.get("fullDocumentBeforeChange") or {}
+        return student_change(
+            "upsert", document, operation == "replace" or "class_name" in updated_fields, previous.get("class_name")
+        )
+    if operation == "delete" and collection == "students":
+        return None
+    if operation == "delete" and change.get("fullDocumentBeforeChange"):
+        return class_settings_change("delete", change["fullDocumentBeforeChange"])
+    # Deletes only carry the Mongo _id unless pre-images are enabled on the collection.
+    # Dedicated databases hold a single tenant; a delete in the shared one could be any
+    # tenant's and is not worth a resync of every school.
+    database_tenants = {database: tenant_id for tenant_id, database in TENANT_DATABASES.items()}
+    tenant_id = database_tenants.get(change["ns"]["db"])
+    if operation == "delete" and tenant_id is None:
+        return None
+    return resync_change(collection, tenant_id)
+
+async def enable_pre_images(database):
+    """Have change events carry the document before an update or delete (MongoDB 6.0+)"""
+    for collection in WATCHED_COLLECTIONS:
+        try:
+            await database.command("collMod", collection, changeStreamPreAndPostImages={"enabled": True})
+        except PyMongoError as e:
+            logger.info(f"Change stream pre-images unavailable for {database.name}.{collection}: {e}")
+            return
+
+async def watch_change_stream():
+    # One cluster-wide stream covers the shared database and the dedicated tenant databases
+    databases = [db.name] + list(TENANT_DATABASES.values())
+    pipeline = [{"$match": {
+        "ns.db": {"$in": databases},
+        "$or": [{"ns.coll": {"$in": list(WATCHED_COLLECTIONS)}}, {"ns.coll": "tombstones", "operationType": "insert"}],
+    }}]
+    for database in databases:
+        await enable_pre_images(client[database])
+    resume_token = None
+    while True:
+        try:
+            async with client.watch(
+                pipeline,
+                full_document="updateLookup",
+                full_document_before_change="whenAvailable",
+                resume_after=resume_token,
+            ) as stream:
+                change_hub.uses_change_stream = True
+                async for change in stream:
+                    resume_token = stream.resume_token
+                    event = change_stream_event(change)
+                    if event:
+                        change_hub.publish(event)
+        except PyMongoError as e:
+            if isinstance(e, OperationFailure) and not change_hub.uses_change_stream:
+                raise
+            # The stream was invalidated or lost its connection: clients reload
+            logger.warning(f"Change stream interrupted ({e}), restarting it")
+            resume_token = None
+            for collection in WATCHED_COLLECTIONS:
+                change_hub.publish(resync_change(collection))
+            await asyncio.sleep(1)
+
+async def poll_collection_versions():
+    await collection_versions.sync()
+    last_versions = dict(collection_versions.versions)
+    last_local = dict(collection_versions.local_bumps)
+    while True:
+        await asyncio.sleep(CHANGE_POLL_INTERVAL)
+        await collection_versions.sync()
+        for key, version in list(collection_versions.versions.items()):
+            tenant_id, _, name = key.rpartition(":")
+            if name not in WATCHED_COLLECTIONS:
+                continue
+            # More writes than this worker made itself: another worker changed the collection
+            bumps = collection_versions.local_bumps[key] - last_local.get(key, 0)
+            if version - last_versions.get(key, 0) > bumps:
+                change_hub.publish(resync_change(name, tenant_id))
+        last_versions = dict(collection_versions.versions)
+        last_local = dict(collection_versions.local_bumps)
+
+async def run_change_feed():
+    try:
+        await watch_change_stream()
+    except OperationFailure as e:
+        logger.info(f"Change streams unavailable ({e.code}), polling collection versions instead")
+    change_hub.uses_change_stream = False
+    await poll_collection_versions()
+
+async def collection_etag(request: Request, *collections: str) -> str:
+    """Strong ETag for a read of the given collections, distinct per tenant, URL and representation"""
+    versions = await collection_versions.current(*collections)
+    variant = f"{current_tenant.get()}|{request.url.path}?{request.url.query}|{request.headers.get('accept', '')}"
+    version_tag = ".".join(f"{name}{version}" for name, version in zip(collections, versions))
+    return f'"{version_tag}-{hashlib.sha1(variant.encode()).hexdigest()[:16]}"'
+
+def etag_headers(etag: str) -> dict:
+    return {"ETag": etag, "Cache-Control": "no-cache", "Vary": TENANT_HEADER}
+
+async def cached_json_response(request: Request, key: str, loader: Callable[[], Awaitable[Any]]) -> Response:
+    body, etag = await settings_cache.get_or_load(key, loader)
+    headers = etag_headers(etag)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+async def find_one_and_set(
+    collection, query: dict, update_data: dict, stages: Sequence[dict] = ()
+) -> Tuple[Optional[dict], Optional[dict]]:
+    """Apply a $set and return the document before and after it in a single atomic round trip.
+
+    Every partial-update route goes through here so it never has to read the
+    document back with a second query. The previous version is returned for
+    the audit log; the updated one is the previous with the $set applied.
+    Extra pipeline stages run after the $set in the same update, for fields
+    derived from values the caller does not have. Returns (None, None) when
+    nothing matched.
+    """
+    update = {"$set": update_data}
+    if stages:
+        update = [{"$set": {field: {"$literal": value} for field, value in update_data.items()}}, *stages]
+    previous = await collection.find_one_and_update(
+        query,
+        update,
+        projection={"_id": 0},
+        return_document=ReturnDocument.BEFORE,
+    )
+    if previous is None:
+        return None, None
+    return previous, {**previous, **update_data}
+
+# Fields stored alongside each student that are derived from its own data
+def student_derived_fields(data: dict) -> dict:
+    derived = {}
+    if "first_and_last_name" in data:
+        derived["first_and_last_name_lower"] = data["first_and_last_name"].lower()
+    return derived
+
+def normalize_search_text(text: str) -> str:
+    """Lowercase, strip accents and collapse everything but letters and digits to single spaces"""
+    decomposed = unicodedata.normalize("NFKD", text)
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[\W_]+", " ", stripped.lower()).split())
+
+def normalize_phone(phone: str) -> str:
+    return re.sub(r"\D", "", phone)
+
+def field_search_tokens(field: str, value: Optional[str]) -> List[str]:
+    if field in SEARCHABLE_PHONE_FIELDS:
+        phone = normalize_phone(value or "")
+        return [phone] if phone else []
+    return sorted(set(normalize_search_text(value or "").split()))
+
+def student_search_fields(student: dict) -> dict:
+    """Precomputed search fields; needs every searchable field of the student"""
+    field_tokens = {field: field_search_tokens(field, student.get(field)) for field in SEARCHABLE_FIELDS}
+    return {
+        "search_name": normalize_search_text(student.get("first_and_last_name") or ""),
+        "search_field_tokens": field_tokens,
+        "search_tokens": sorted({token for tokens in field_tokens.values() for token in tokens}),
+    }
+
+def search_field_stages(update_data: dict) -> List[dict]:
+    """Pipeline stages refreshing the search fields after a partial update.
+
+    Tokens are kept per searchable field, so the union is rebuilt by the
+    server from the stored ones without reading the student first.
+    """
+    changed = {
+        f"search_field_tokens.{field}": {"$literal": field_search_tokens(field, update_data[field])}
+        for field in SEARCHABLE_FIELDS if field in update_data
+    }
+    if not changed:
+        return []
+    if "first_and_last_name" in update_data:
+        changed["search_name"] = {"$literal": normalize_search_text(update_data["first_and_last_name"] or "")}
+    union = [{"$ifNull": [f"$search_field_tokens.{field}", []]} for field in SEARCHABLE_FIELDS]
+    return [{"$set": changed}, {"$set": {"search_tokens": {"$setUnion": union}}}]
+
+def student_document(student: Student) -> dict:
+    student_dict = student.dict()
+    return {**student_dict, **student_derived_fields(student_dict), **student_search_fields(student_dict)}
+
+CLASS_SETTINGS_PROJECTION = {"_id": 0, **{field: 1 for field in ClassSettings.model_fields}}
+APP_SETTINGS_PROJECTION = {"_id": 0, **{field: 1 for field in AppSettings.model_fields}}
+
 # Routes for Students
 @api_router.post("/students", response_model=Student)
-async def create_student(student: StudentCreate):
-    student_dict = student.dict()
-    student_obj = Student(**student_dict)
-    await db.students.insert_one(student_obj.dict())
+async def create_student(student: StudentCreate, tenant: Tenant = Depends(tenant_scope)):
+    async with sync_sequence.allocate() as seq:
+        student_obj = Student(**student.dict(), tenant_id=tenant.id, updated_seq=seq)
+        await tenant.db.students.insert_one(student_document(student_obj))
+    await collection_versions.bump("students")
+    change_hub.publish_local(student_change("upsert", student_obj.dict()))
+    await audit_log.record("create", "students", student_obj.id, after=student_obj.dict())
     return student_obj
 
-@api_router.get("/students", response_model=List[Student])
-async def get_all_students():
-    students = await db.students.find().to_list(1000)
-    return [Student(**student) for student in students]
+def student_projection(fields: Optional[str]) -> dict:
+    """Mongo projection for a fields= parameter: a named fieldset or a comma-separated list"""
+    if not fields:
+        return STUDENT_PROJECTION
+    requested = STUDENT_FIELD_SETS.get(fields) or [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in STUDENT_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown student fields: {', '.join(unknown)}")
+    # id is always returned: it identifies the student and is the pagination cursor
+    return {"_id": 0, "id": 1, **{field: 1 for field in requested}}
+
+async def iter_students(tenant: Tenant, query: dict, projection: dict = STUDENT_PROJECTION):
+    """Yield a tenant's student documents one by one, ordered by id, as the Motor cursor produces them"""
+    cursor = tenant.db.students.find(tenant.scope(query), projection).sort("id", 1).batch_size(STUDENT_BATCH_SIZE)
+    async for student in cursor:
+        yield student
+
+async def stream_students_ndjson(tenant: Tenant, query: dict, projection: dict = STUDENT_PROJECTION):
+    async for student in iter_students(tenant, query, projection):
+        yield orjson.dumps(student) + b"\n"
 
-@api_router.get("/students/class/{class_name}", response_model=List[Student])
-async def get_students_by_class(class_name: str):
-    students = await db.students.find({"class_name": class_name}).to_list(1000)
-    # Sort alphabetically by first_and_last_name
-    sorted_students = sorted([Student(**student) for student in students], 
-                           key=lambda x: x.first_and_last_name.lower())
-    return sorted_students
+async def stream_students_json_array(tenant: Tenant, query: dict, projection: dict = STUDENT_PROJECTION):
+    yield b"["
+    first = True
+    async for student in iter_students(tenant, query, projection):
+        yield orjson.dumps(student) if first else b"," + orjson.dumps(student)
+        first = False
+    yield b"]"
+
+@api_router.get("/students", response_model=Union[List[Student], List[StudentSummary]])
+async def get_all_students(
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=STUDENT_PAGE_MAX),
+    after: Optional[str] = None,
+    stream: bool = False,
+    fields: Optional[str] = None,
+    tenant: Tenant = Depends(tenant_scope),
+):
+    # Keyset pagination on id: "after" is the id of the last student of the previous page
+    query = {"id": {"$gt": after}} if after else {}
+    projection = student_projection(fields)
+    etag = await collection_etag(request, "students")
+    headers = etag_headers(etag)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    if stream or NDJSON_MEDIA_TYPE in request.headers.get("accept", ""):
+        return StreamingResponse(
+            stream_students_ndjson(tenant, query, projection), media_type=NDJSON_MEDIA_TYPE, headers=headers
+        )
+
+    if limit is None:
+        # Unpaginated: stream the whole roster as a JSON array without buffering it
+        return StreamingResponse(
+            stream_students_json_array(tenant, query, projection), media_type="application/json", headers=headers
+        )
+
+    students = await tenant.db.students.find(tenant.scope(query), projection).sort("id", 1).limit(limit).to_list(limit)
+    if len(students) == limit:
+        headers["X-Next-Cursor"] = students[-1]["id"]
+    return ORJSONResponse(students, headers=headers)
+
+class LineDecoder:
+    """Decodes the lines of an uploaded file.
+
+    With no declared charset lines are read as UTF-8, unless a line that is
+    not UTF-8 comes before any non-ASCII UTF-8 line: then the file is taken
+    for windows-1252, the encoding of CSV files saved by Excel in Spanish.
+    A line that cannot be decoded is returned as its UnicodeDecodeError.
+    """
+
+    def __init__(self, encoding: Optional[str]):
+        self.encoding = encoding or "utf-8"
+        self.detect = encoding is None
+        self.first_line = True
+
+    def decode(self, line: bytes) -> Union[str, UnicodeDecodeError]:
+        if self.first_line:
+            self.first_line = False
+            if line.startswith(codecs.BOM_UTF8) and self.encoding.replace("_", "-").lower() in ("utf-8", "utf8"):
+                line = line[len(codecs.BOM_UTF8):]
+                self.detect = False
+        try:
+            text = line.decode(self.encoding)
+        except UnicodeDecodeError as e:
+            if not self.detect:
+                return e
+            self.detect = False
+            self.encoding = "cp1252"
+            return self.decode(line)
+        if self.detect and not text.isascii():
+            self.detect = False
+        return text.rstrip("\r")
+
+def request_charset(request: Request) -> Optional[str]:
+    match = re.search(r"charset=\"?([\w.:-]+)", request.headers.get("content-type", ""), re.IGNORECASE)
+    if not match:
+        return None
+    try:
+        codec = codecs.lookup(match.group(1))
+    except LookupError:
+        raise HTTPException(status_code=400, detail=f"Unknown charset {match.group(1)}")
+    # Lines are split on the newline byte, which only works for ASCII-compatible encodings
+    if "a\n".encode(codec.name) != b"a\n":
+        raise HTTPException(status_code=415, detail="Use an ASCII-compatible charset such as UTF-8 or windows-1252")
+    return codec.name
+
+async def iter_request_lines(request: Request):
+    """Yield the decoded lines of a request body as it is received, or a UnicodeDecodeError for a line that is not text"""
+    decoder = LineDecoder(request_charset(request))
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        lines = buffer.split(b"\n")
+        buffer = lines.pop()
+        for line in lines:
+            yield decoder.decode(line)
+    if buffer:
+        yield decoder.decode(buffer)
+
+async def iter_csv_rows(lines):
+    """Yield CSV records as dicts keyed by the header row, and undecodable lines as errors"""
+    header = None
+    pending = ""
+    async for line in lines:
+        if isinstance(line, ValueError):
+            pending = ""
+            yield line
+            continue
+        if not pending and not line.strip():
+            continue
+        pending = pending + "\n" + line if pending else line
+        # An odd number of quotes means a quoted field continues on the next line
+        if pending.count('"') % 2:
+            continue
+        record = next(csv.reader([pending]))
+        pending = ""
+        if header is None:
+            header = [column.strip() for column in record]
+        else:
+            yield dict(zip(header, record))
+
+async def iter_ndjson_rows(lines):
+    async for line in lines:
+        if isinstance(line, ValueError):
+            yield line
+        elif line.strip():
+            try:
+                yield orjson.loads(line)
+            except ValueError as e:
+                # Malformed lines are yielded as errors so the import can go on
+                yield e
+
+class BulkImportReport:
+    def __init__(self, tenant: Tenant):
+        self.tenant = tenant
+        self.inserted = 0
+        self.failed = 0
+        self.errors: List[dict] = []
+
+    def add_error(self, row: int, error: str):
+        self.failed += 1
+        if len(self.errors) < BULK_MAX_REPORTED_ERRORS:
+            self.errors.append({"row": row, "error": error})
+
+    async def write_chunk(self, chunk: List[Tuple[int, dict]]):
+        if not chunk:
+            return
+        async with sync_sequence.allocate(len(chunk)) as first_seq:
+            for offset, (_, doc) in enumerate(chunk):
+                doc["updated_seq"] = first_seq + offset
+            try:
+                result = await self.tenant.db.students.bulk_write([InsertOne(doc) for _, doc in chunk], ordered=False)
+                self.inserted += result.inserted_count
+            except BulkWriteError as e:
+                self.inserted += e.details.get("nInserted", 0)
+                for write_error in e.details.get("writeErrors", []):
+                    self.add_error(chunk[write_error["index"]][0], write_error.get("errmsg", "Write error"))
+
+@api_router.post("/students/bulk")
+async def import_students(
+    request: Request,
+    format: Optional[str] = Query(None, pattern="^(csv|ndjson)$"),
+    tenant: Tenant = Depends(tenant_scope),
+):
+    if format is None:
+        format = "csv" if "csv" in request.headers.get("content-type", "") else "ndjson"
+    lines = iter_request_lines(request)
+    rows = iter_csv_rows(lines) if format == "csv" else iter_ndjson_rows(lines)
+
+    report = BulkImportReport(tenant)
+    chunk: List[Tuple[int, dict]] = []
+    row_number = 0
+    async for row in rows:
+        row_number += 1
+        if isinstance(row, ValueError):
+            report.add_error(row_number, f"Invalid {format} row: {row}")
+            continue
+        try:
+            student = Student(**StudentCreate(**row).dict(), tenant_id=tenant.id)
+        except (ValidationError, TypeError) as e:
+            report.add_error(row_number, str(e))
+            continue
+        chunk.append((row_number, student_document(student)))
+        if len(chunk) >= BULK_CHUNK_SIZE:
+            await report.write_chunk(chunk)
+            chunk = []
+    await report.write_chunk(chunk)
+    if report.inserted:
+        await collection_versions.bump("students")
+        change_hub.publish_local(resync_change("students", tenant.id))
+        await audit_log.record("import", "students", details={"format": format, "inserted": report.inserted, "failed": report.failed})
+
+    return {"inserted": report.inserted, "failed": report.failed, "errors": report.errors}
+
+async def stream_students_csv(tenant: Tenant, query: dict):
+    # Exports can be imported into another school, so they leave the tenant and sync state out
+    columns = [field for field in STUDENT_FIELDS if field not in ("tenant_id", "updated_seq")]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    async for student in iter_students(tenant, query):
+        writer.writerow([student.get(column, "") for column in columns])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+@api_router.get("/students/export")
+async def export_students(
+    request: Request,
+    format: str = Query("ndjson", pattern="^(csv|ndjson)$"),
+    class_name: Optional[str] = None,
+    tenant: Tenant = Depends(tenant_scope),
+):
+    query = {"class_name": class_name} if class_name else {}
+    etag = await collection_etag(request, "students")
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=etag_headers(etag))
+    headers = {**etag_headers(etag), "Content-Disposition": f'attachment; filename="students.{format}"'}
+    if format == "csv":
+        return StreamingResponse(stream_students_csv(tenant, query), media_type="text/csv; charset=utf-8", headers=headers)
+    return StreamingResponse(stream_students_ndjson(tenant, query), media_type=NDJSON_MEDIA_TYPE, headers=headers)
+
+@api_router.get("/students/class/{class_name}", response_model=Union[List[Student], List[StudentSummary]])
+async def get_students_by_class(
+    request: Request,
+    class_name: str,
+    fields: Optional[str] = None,
+    tenant: Tenant = Depends(tenant_scope),
+):
+    projection = student_projection(fields)
+    etag = await collection_etag(request, "students")
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=etag_headers(etag))
+
+    async def load_students():
+        # Served already sorted alphabetically by the (tenant_id, class_name, first_and_last_name_lower) index
+        students = await tenant.db.students.find(tenant.scope({"class_name": class_name}), projection).sort(
+            "first_and_last_name_lower", ASCENDING
+        ).to_list(1000)
+        return orjson.dumps(students)
+
+    # A class opened on many tablets at once is read from Mongo only once per version of the collection
+    version, = await collection_versions.current("students")
+    body = await single_flight.do(
+        ("students/class", tenant.id, class_name, fields, version), load_students, (tenant_key("students"),)
+    )
+    return Response(content=body, media_type="application/json", headers=etag_headers(etag))
+
+def search_score(student: dict, query: str, query_tokens: List[str]) -> int:
+    name = student.get("search_name", "")
+    if name == query:
+        return 4
+    if name.startswith(query):
+        return 3
+    name_tokens = name.split()
+    if all(any(token.startswith(q) for token in name_tokens) for q in query_tokens):
+        return 2
+    if all(any(token.startswith(q) for token in student.get("search_tokens", [])) for q in query_tokens):
+        return 1
+    return 0
+
+@api_router.get("/students/search", response_model=List[Student])
+async def search_students(
+    request: Request,
+    q: str = Query(..., min_length=1),
+    limit: int = Query(20, ge=1, le=SEARCH_LIMIT_MAX),
+    class_name: Optional[str] = None,
+    tenant: Tenant = Depends(tenant_scope),
+):
+    etag = await collection_etag(request, "students")
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=etag_headers(etag))
+
+    # Phone numbers are matched on their digits, whatever the separators
+    query = normalize_phone(q) if re.fullmatch(r"[\d\s+().-]+", q) else normalize_search_text(q)
+    if not query:
+        return []
+    query_tokens = query.split()
+    scope = tenant.scope({"class_name": class_name} if class_name else {})
+    projection = {**STUDENT_PROJECTION, "search_name": 1, "search_tokens": 1}
+
+    # Best matches first, each from its own index range scan: the whole name, then names starting with the query
+    candidates = await tenant.db.students.find({"search_name": query, **scope}, projection).to_list(limit)
+    if len(candidates) < limit:
+        name_prefix_filter = {"search_name": {"$regex": "^" + re.escape(query), "$ne": query}, **scope}
+        missing = limit - len(candidates)
+        candidates += await tenant.db.students.find(name_prefix_filter, projection).sort(
+            "search_name", ASCENDING
+        ).limit(missing).to_list(missing)
+
+    # Then every query token a prefix of a stored token of any name
+    if len(candidates) < limit:
+        seen = [student["id"] for student in candidates]
+        prefix_filter = {
+            "$and": [{"search_tokens": {"$regex": "^" + re.escape(token)}} for token in query_tokens],
+            "id": {"$nin": seen},
+            **scope,
+        }
+        candidates += await tenant.db.students.find(prefix_filter, projection).limit(SEARCH_LIMIT_MAX).to_list(
+            SEARCH_LIMIT_MAX
+        )
+
+    candidates.sort(key=lambda s: (-search_score(s, query, query_tokens), s.get("search_name", "")))
+    return ORJSONResponse([
+        {field: value for field, value in student.items() if field in STUDENT_PROJECTION}
+        for student in candidates[:limit]
+    ], headers=etag_headers(etag))
 
 @api_router.get("/students/{student_id}", response_model=Student)
-async def get_student(student_id: str):
-    student = await db.students.find_one({"id": student_id})
+async def get_student(student_id: str, tenant: Tenant = Depends(tenant_scope)):
+    student = await tenant.db.students.find_one(tenant.scope({"id": student_id}), STUDENT_PROJECTION)
     if student is None:
         raise HTTPException(status_code=404, detail="Student not found")
-    return Student(**student)
+    return ORJSONResponse(student)
 
 @api_router.put("/students/{student_id}", response_model=Student)
-async def update_student(student_id: str, student_update: StudentUpdate):
+async def update_student(student_id: str, student_update: StudentUpdate, tenant: Tenant = Depends(tenant_scope)):
     update_data = {k: v for k, v in student_update.dict().items() if v is not None}
     if not update_data:
         raise HTTPException(status_code=400, detail="No update data provided")
     
-    result = await db.students.update_one({"id": student_id}, {"$set": update_data})
-    if result.matched_count == 0:
+    update_data.update(student_derived_fields(update_data))
+    async with sync_sequence.allocate() as seq:
+        previous_student, updated_student = await find_one_and_set(
+            tenant.db.students, tenant.scope({"id": student_id}), {**update_data, "updated_seq": seq},
+            search_field_stages(update_data),
+        )
+    if updated_student is None:
         raise HTTPException(status_code=404, detail="Student not found")
-    
-    updated_student = await db.students.find_one({"id": student_id})
+    await collection_versions.bump("students")
+    change_hub.publish_local(
+        student_change("upsert", updated_student, "class_name" in update_data, previous_student.get("class_name"))
+    )
+    await audit_log.record("update", "students", student_id, previous_student, updated_student)
     return Student(**updated_student)
 
 @api_router.delete("/students/{student_id}")
-async def delete_student(student_id: str):
-    result = await db.students.delete_one({"id": student_id})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Student not found")
+async def delete_student(student_id: str, tenant: Tenant = Depends(tenant_scope)):
+    async with sync_sequence.allocate() as seq:
+        deleted_student = await tenant.db.students.find_one_and_delete(tenant.scope({"id": student_id}), STUDENT_PROJECTION)
+        if deleted_student is None:
+            raise HTTPException(status_code=404, detail="Student not found")
+        await tenant.db.tombstones.insert_one(student_tombstone(deleted_student, seq))
+    await collection_versions.bump("students")
+    change_hub.publish_local(student_change("delete", deleted_student))
+    await audit_log.record("delete", "students", student_id, before=deleted_student)
     return {"message": "Student deleted successfully"}
 
+def student_tombstone(student: dict, seq: int) -> dict:
+    """Record of a deleted student, so GET /api/sync can tell offline clients to drop it"""
+    return {
+        "tenant_id": student["tenant_id"],
+        "collection": "students",
+        "id": student["id"],
+        "class_name": student.get("class_name"),
+        "updated_seq": seq,
+        "deleted_at": datetime.now(timezone.utc),
+    }
+
+def batch_update_data(operation: StudentBatchOperation) -> dict:
+    if operation.op == "move":
+        return {"class_name": operation.class_name} if operation.class_name else {}
+    if operation.op == "update" and operation.update:
+        return {k: v for k, v in operation.update.dict().items() if v is not None}
+    return {}
+
+@api_router.post("/students/batch", response_model=List[StudentBatchResult])
+async def batch_students(batch: StudentBatch, tenant: Tenant = Depends(tenant_scope)):
+    results = [
+        {"index": index, "id": operation.id, "status": "ok", "error": None}
+        for index, operation in enumerate(batch.operations)
+    ]
+    # The current students, to detect missing ids and recompute derived fields
+    current = {
+        student["id"]: student
+        async for student in tenant.db.students.find(
+            tenant.scope({"id": {"$in": list({operation.id for operation in batch.operations})}}), STUDENT_PROJECTION
+        )
+    }
+    original = dict(current)
+
+    # Operations on the same student are merged into one write, since an
+    # unordered bulk_write does not guarantee the order they would run in
+    writes: Dict[str, dict] = {}
+    for index, operation in enumerate(batch.operations):
+        student = current.get(operation.id)
+        if student is None:
+            results[index]["status"] = "not_found"
+            continue
+        write = writes.setdefault(operation.id, {"set": {}, "indexes": [], "class_changed": False})
+        if operation.op == "delete":
+            write.update(delete=True, student=student)
+            del current[operation.id]
+        else:
+            update_data = batch_update_data(operation)
+            if not update_data:
+                results[index].update(status="invalid", error="No update data provided")
+                continue
+            student = current[operation.id] = {**student, **update_data}
+            write["set"].update(update_data)
+            write["student"] = student
+            write["class_changed"] = write["class_changed"] or "class_name" in update_data
+        write["indexes"].append(index)
+
+    writes = {student_id: write for student_id, write in writes.items() if write["indexes"]}
+    if writes:
+        async with sync_sequence.allocate(len(writes)) as first_seq:
+            requests = []
+            request_results = []
+            tombstones = []
+            changes = []
+            audits = []
+            for seq, (student_id, write) in enumerate(writes.items(), first_seq):
+                write["student"]["updated_seq"] = seq
+                if write.get("delete"):
+                    requests.append(DeleteOne(tenant.scope({"id": student_id})))
+                    tombstones.append(student_tombstone(write["student"], seq))
+                    changes.append(student_change("delete", write["student"]))
+                    audits.append(("delete", student_id, original[student_id], None))
+                else:
+                    update_data = {
+                        **write["set"],
+                        **student_derived_fields(write["set"]),
+                        **student_search_fields(write["student"]),
+                        "updated_seq": seq,
+                    }
+                    requests.append(UpdateOne(tenant.scope({"id": student_id}), {"$set": update_data}))
+                    changes.append(student_change(
+                        "upsert", write["student"], write["class_changed"], original[student_id].get("class_name")
+                    ))
+                    audits.append(("update", student_id, original[student_id], write["student"]))
+                request_results.append(write["indexes"])
+
+            failed = set()
+            try:
+                if batch.transaction:
+                    async with await tenant.db.client.start_session() as session:
+                        async with session.start_transaction():
+                            await tenant.db.students.bulk_write(requests, ordered=False, session=session)
+                            if tombstones:
+                                await tenant.db.tombstones.insert_many(tombstones, session=session)
+                else:
+                    await tenant.db.students.bulk_write(requests, ordered=False)
+                    if tombstones:
+                        await tenant.db.tombstones.insert_many(tombstones)
+            except BulkWriteError as e:
+                if batch.transaction:
+                    failed = set(range(len(requests)))
+                    for indexes in request_results:
+                        for index in indexes:
+                            results[index].update(status="error", error="Transaction aborted")
+                for write_error in e.details.get("writeErrors", []):
+                    failed.add(write_error["index"])
+                    for index in request_results[write_error["index"]]:
+                        results[index].update(status="error", error=write_error.get("errmsg", "Write error"))
+                # Deletions that went through still need their tombstones
+                delete_indexes = [i for i, request in enumerate(requests) if isinstance(request, DeleteOne)]
+                tombstones = [tombstone for i, tombstone in zip(delete_indexes, tombstones) if i not in failed]
+                if tombstones and not batch.transaction:
+                    await tenant.db.tombstones.insert_many(tombstones)
+                changes = []
+            except OperationFailure as e:
+                if batch.transaction:
+                    raise HTTPException(status_code=400, detail=f"Transaction failed: {e}")
+                raise
+        await collection_versions.bump("students")
+        if changes and len(changes) == len(requests):
+            for change in changes:
+                change_hub.publish_local(change)
+        else:
+            change_hub.publish_local(resync_change("students", tenant.id))
+        for i, (action, student_id, before, after) in enumerate(audits):
+            if i not in failed:
+                await audit_log.record(action, "students", student_id, before, after)
+
+    return results
+
 # Routes for Class Settings
+# Default classes with correct colors, seeded once per tenant
+DEFAULT_CLASSES = [
+    {"class_name": "INFANTIL 3 AÑOS", "teacher_name": "Profesor/a", "background_color": "#3B82F6"},
+    {"class_name": "INFANTIL 4 AÑOS", "teacher_name": "Profesor/a", "background_color": "#3B82F6"},
+    {"class_name": "INFANTIL 5 AÑOS", "teacher_name": "Profesor/a", "background_color": "#3B82F6"},
+    {"class_name": "1º DE PRIMARIA", "teacher_name": "Profesor/a", "background_color": "#F97316"},
+    {"class_name": "2º DE PRIMARIA", "teacher_name": "Profesor/a", "background_color": "#F97316"},
+    {"class_name": "3º DE PRIMARIA", "teacher_name": "Profesor/a", "background_color": "#F97316"},
+    {"class_name": "4º DE PRIMARIA", "teacher_name": "Profesor/a", "background_color": "#84CC16"},
+    {"class_name": "5º DE PRIMARIA", "teacher_name": "Profesor/a", "background_color": "#84CC16"},
+    {"class_name": "6º DE PRIMARIA", "teacher_name": "Profesor/a", "background_color": "#84CC16"}
+]
+
+async def load_class_settings():
+    tenant = get_tenant()
+    return await tenant.db.class_settings.find(tenant.scope(), CLASS_SETTINGS_PROJECTION).to_list(1000)
+
 @api_router.get("/classes", response_model=List[ClassSettings])
-async def get_class_settings():
-    classes = await db.class_settings.find().to_list(1000)
-    if not classes:
-        # Initialize default classes with correct colors
-        default_classes = [
-            {"class_name": "INFANTIL 3 AÑOS", "teacher_name": "Profesor/a", "background_color": "#3B82F6"},
-            {"class_name": "INFANTIL 4 AÑOS", "teacher_name": "Profesor/a", "background_color": "#3B82F6"},
-            {"class_name": "INFANTIL 5 AÑOS", "teacher_name": "Profesor/a", "background_color": "#3B82F6"},
-            {"class_name": "1º DE PRIMARIA", "teacher_name": "Profesor/a", "background_color": "#F97316"},
-            {"class_name": "2º DE PRIMARIA", "teacher_name": "Profesor/a", "background_color": "#F97316"},
-            {"class_name": "3º DE PRIMARIA", "teacher_name": "Profesor/a", "background_color": "#F97316"},
-            {"class_name": "4º DE PRIMARIA", "teacher_name": "Profesor/a", "background_color": "#84CC16"},
-            {"class_name": "5º DE PRIMARIA", "teacher_name": "Profesor/a", "background_color": "#84CC16"},
-            {"class_name": "6º DE PRIMARIA", "teacher_name": "Profesor/a", "background_color": "#84CC16"}
-        ]
-        
-        for class_data in default_classes:
-            class_obj = ClassSettings(**class_data)
-            await db.class_settings.insert_one(class_obj.dict())
-            
-        classes = await db.class_settings.find().to_list(1000)
-    
-    return [ClassSettings(**class_setting) for class_setting in classes]
+async def get_class_settings(request: Request):
+    return await cached_json_response(request, "classes", load_class_settings)
 
 @api_router.put("/classes/{class_id}", response_model=ClassSettings)
-async def update_class_settings(class_id: str, class_update: ClassSettingsCreate):
-    result = await db.class_settings.update_one(
-        {"id": class_id}, 
-        {"$set": class_update.dict()}
-    )
-    if result.matched_count == 0:
+async def update_class_settings(class_id: str, class_update: ClassSettingsCreate, tenant: Tenant = Depends(tenant_scope)):
+    async with sync_sequence.allocate() as seq:
+        try:
+            previous_class, updated_class = await find_one_and_set(
+                tenant.db.class_settings, tenant.scope({"id": class_id}), {**class_update.dict(), "updated_seq": seq}
+            )
+        except DuplicateKeyError:
+            raise HTTPException(status_code=409, detail=f"A class named {class_update.class_name} already exists")
+    if updated_class is None:
         raise HTTPException(status_code=404, detail="Class not found")
-    
-    updated_class = await db.class_settings.find_one({"id": class_id})
+    settings_cache.invalidate("classes")
+    await collection_versions.bump("class_settings")
+    change_hub.publish_local(class_settings_change("upsert", updated_class))
+    await audit_log.record("update", "class_settings", class_id, previous_class, updated_class)
     return ClassSettings(**updated_class)
 
 # Route to reset class colors
 @api_router.post("/classes/reset-colors")
-async def reset_class_colors():
-    # Delete existing classes
-    await db.class_settings.delete_many({})
-    # Let the get_class_settings endpoint recreate them with new colors
+async def reset_class_colors(tenant: Tenant = Depends(tenant_scope)):
+    # Restore the default colors in place, recreating any missing default class
+    async with sync_sequence.allocate(len(DEFAULT_CLASSES)) as first_seq:
+        await tenant.db.class_settings.bulk_write(
+            [
+                UpdateOne(
+                    tenant.scope({"class_name": class_data["class_name"]}),
+                    {
+                        "$set": {"background_color": class_data["background_color"], "updated_seq": seq},
+                        "$setOnInsert": {
+                            k: v
+                            for k, v in ClassSettings(**class_data, tenant_id=tenant.id).dict().items()
+                            if k not in ("background_color", "updated_seq")
+                        },
+                    },
+                    upsert=True,
+                )
+                for seq, class_data in enumerate(DEFAULT_CLASSES, first_seq)
+            ],
+            ordered=False,
+        )
+    settings_cache.invalidate("classes")
+    await collection_versions.bump("class_settings")
+    change_hub.publish_local(resync_change("class_settings", tenant.id))
+    await audit_log.record("reset_colors", "class_settings")
     return {"message": "Class colors reset successfully"}
 
+# Image store
+# Uploaded images are stored once per content hash under IMAGE_STORE_DIR,
+# together with variants resized to IMAGE_VARIANT_WIDTHS at upload time, and
+# served with long-lived cache headers since their URL never changes content.
+IMAGE_STORE_DIR = Path(os.environ.get('IMAGE_STORE_DIR', ROOT_DIR / 'images'))
+IMAGE_MAX_BYTES = env_int('IMAGE_MAX_BYTES', 10 * 1024 * 1024)
+IMAGE_VARIANT_WIDTHS = (480, 1024)
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+IMAGE_CHUNK_SIZE = 64 * 1024
+DATA_URL_RE = re.compile(r"data:(image/[\w.+-]+);base64,(.*)", re.DOTALL)
+# Only raster formats are stored: an SVG could carry scripts that run on our origin
+IMAGE_FORMATS = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp", "GIF": "image/gif"}
+IMAGE_FORMATS_ERROR = "Only JPEG, PNG, WebP and GIF images can be uploaded"
+
+image_executor = ThreadPoolExecutor(max_workers=env_int('IMAGE_WORKERS', 2), thread_name_prefix="images")
+# Image metadata never changes once stored, so it is cached without expiry
+image_metadata: Dict[str, dict] = {}
+
+def image_path(digest: str, variant: str = "original") -> Path:
+    return IMAGE_STORE_DIR / digest[:2] / f"{digest}-{variant}"
+
+def write_file_atomically(path: Path, data: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+    temporary.write_bytes(data)
+    os.replace(temporary, path)
+
+def sniff_image_format(data: bytes) -> Optional[str]:
+    """Format of an image from its signature, for when Pillow is not installed"""
+    if data.startswith(b"\xff\xd8\xff"):
+        return "JPEG"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "PNG"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "WEBP"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "GIF"
+    return None
+
+def write_image_files(digest: str, data: bytes) -> dict:
+    """Store an image and its resized variants; runs in image_executor.
+
+    The content type is the format Pillow decodes, whatever the client
+    claimed, and anything else is rejected before it is written.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        logger.warning("Pillow is not installed, storing images without resized variants")
+        image_format = sniff_image_format(data)
+        if image_format is None:
+            raise HTTPException(status_code=415, detail=IMAGE_FORMATS_ERROR)
+        write_file_atomically(image_path(digest), data)
+        return {"original": {"content_type": IMAGE_FORMATS[image_format], "size": len(data)}}
+    try:
+        image = Image.open(io.BytesIO(data), formats=list(IMAGE_FORMATS))
+        image.load()
+    except Image.DecompressionBombError:
+        raise HTTPException(status_code=413, detail=f"Images are limited to {Image.MAX_IMAGE_PIXELS} pixels")
+    except (OSError, SyntaxError, ValueError):
+        # Not an image Pillow can decode, or a truncated one
+        raise HTTPException(status_code=415, detail=IMAGE_FORMATS_ERROR)
+    with image:
+        variants = {"original": {"content_type": IMAGE_FORMATS[image.format], "size": len(data)}}
+        write_file_atomically(image_path(digest), data)
+        variant_format = image.format if image.format in ("JPEG", "PNG", "WEBP") else "PNG"
+        try:
+            for width in IMAGE_VARIANT_WIDTHS:
+                if image.width <= width:
+                    continue
+                resized = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+                if variant_format == "JPEG" and resized.mode != "RGB":
+                    resized = resized.convert("RGB")
+                buffer = io.BytesIO()
+                resized.save(buffer, format=variant_format, quality=85)
+                variant = f"w{width}"
+                write_file_atomically(image_path(digest, variant), buffer.getvalue())
+                variants[variant] = {"content_type": IMAGE_FORMATS[variant_format], "size": buffer.tell()}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not create resized variants of image {digest}: {e}")
+    return variants
+
+def stored_image(metadata: dict) -> dict:
+    return {
+        "id": metadata["_id"],
+        "url": f"/api/images/{metadata['_id']}",
+        "content_type": metadata["variants"]["original"]["content_type"],
+        "variants": list(metadata["variants"]),
+    }
+
+async def store_image(data: bytes) -> dict:
+    if len(data) > IMAGE_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"Images are limited to {IMAGE_MAX_BYTES} bytes")
+    digest = hashlib.sha256(data).hexdigest()
+    metadata = await db.images.find_one({"_id": digest})
+    if metadata is None:
+        variants = await asyncio.get_running_loop().run_in_executor(
+            image_executor, write_image_files, digest, data
+        )
+        metadata = {"_id": digest, "variants": variants, "created_at": datetime.now(timezone.utc)}
+        await db.images.update_one({"_id": digest}, {"$setOnInsert": metadata}, upsert=True)
+    return stored_image(metadata)
+
+async def offload_data_url(url: str) -> str:
+    """Replace an inline data: URL by the URL of the same image in the store"""
+    match = DATA_URL_RE.fullmatch(url)
+    if not match:
+        return url
+    try:
+        data = base64.b64decode(match.group(2), validate=False)
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid image data URL")
+    return (await store_image(data))["url"]
+
+def parse_byte_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    """First and last byte of a single "bytes=" range, or None to send the whole file"""
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first == "":
+        start, end = max(0, size - int(last)), size - 1
+    else:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    if start > end or start >= size:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+def iter_file_range(path: Path, start: int, end: int):
+    with open(path, "rb") as file:
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = file.read(min(IMAGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+@api_router.post("/images", response_model=StoredImage)
+async def upload_image(file: UploadFile):
+    data = await file.read(IMAGE_MAX_BYTES + 1)
+    stored = await store_image(data)
+    await audit_log.record("upload", "images", stored["id"], details={"filename": file.filename})
+    return stored
+
+@api_router.get("/images/{digest}")
+async def get_image(request: Request, digest: str, variant: str = "original"):
+    metadata = image_metadata.get(digest)
+    if metadata is None:
+        metadata = await db.images.find_one({"_id": digest})
+        if metadata is None:
+            raise HTTPException(status_code=404, detail="Image not found")
+        image_metadata[digest] = metadata
+    if variant not in metadata["variants"]:
+        raise HTTPException(status_code=404, detail="Image variant not found")
+
+    info = metadata["variants"][variant]
+    etag = f'"{digest}-{variant}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": IMAGE_CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
+        "X-Content-Type-Options": "nosniff",
+    }
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    size = info["size"]
+    byte_range = parse_byte_range(request.headers["range"], size) if "range" in request.headers else None
+    start, end = byte_range or (0, size - 1)
+    headers["Content-Length"] = str(end - start + 1)
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return StreamingResponse(
+        iter_file_range(image_path(digest, variant), start, end),
+        status_code=206 if byte_range else 200,
+        # Images stored before formats were checked may be anything; never let a browser render those
+        media_type=info["content_type"] if info["content_type"] in IMAGE_FORMATS.values() else "application/octet-stream",
+        headers=headers,
+    )
+
 # Routes for App Settings
-@api_router.get("/settings", response_model=AppSettings)
-async def get_app_settings():
-    settings = await db.app_settings.find_one()
+async def load_app_settings():
+    tenant = get_tenant()
+    settings = await tenant.db.app_settings.find_one(tenant.scope(), APP_SETTINGS_PROJECTION)
     if not settings:
-        # Initialize default settings
-        default_settings = AppSettings()
-        await db.app_settings.insert_one(default_settings.dict())
-        return default_settings
-    return AppSettings(**settings)
+        # Initialize default settings; the upsert keeps concurrent first reads to one document
+        settings = await tenant.db.app_settings.find_one_and_update(
+            tenant.scope(),
+            {"$setOnInsert": AppSettings(tenant_id=tenant.id).dict()},
+            projection=APP_SETTINGS_PROJECTION,
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    return settings
+
+@api_router.get("/settings", response_model=AppSettings)
+async def get_app_settings(request: Request):
+    return await cached_json_response(request, "settings", load_app_settings)
 
 @api_router.put("/settings", response_model=AppSettings)
-async def update_app_settings(settings_update: AppSettings):
-    # Delete existing settings and insert new ones
-    await db.app_settings.delete_many({})
-    await db.app_settings.insert_one(settings_update.dict())
-    return settings_update
+async def update_app_settings(settings_update: AppSettings, tenant: Tenant = Depends(tenant_scope)):
+    # Keep settings small: inline images are moved to the image store
+    settings_update.home_image_url = await offload_data_url(settings_update.home_image_url)
+    # Replace the tenant's settings in place, keeping the id of the stored document
+    settings = settings_update.dict(exclude={"id", "tenant_id"})
+    previous_settings = await tenant.db.app_settings.find_one_and_update(
+        tenant.scope(),
+        {"$set": settings, "$setOnInsert": {"id": settings_update.id}},
+        projection=APP_SETTINGS_PROJECTION,
+        upsert=True,
+        return_document=ReturnDocument.BEFORE,
+    )
+    updated_settings = {"id": settings_update.id, "tenant_id": tenant.id, **(previous_settings or {}), **settings}
+    settings_cache.invalidate("settings")
+    await collection_versions.bump("app_settings")
+    await audit_log.record("update", "app_settings", updated_settings["id"], previous_settings, updated_settings)
+    return AppSettings(**updated_settings)
+
+# Reports
+# Printable class rosters with allergies and parent phones. Each class is
+# rendered in a process pool, so building a large PDF never blocks the event
+# loop. Every uvicorn worker has its own pool of REPORT_WORKERS processes,
+# started on the first report. Reports are cached per tenant, format and
+# class for the current collection versions, and the whole-school report
+# streams out one class at a time while the following classes render.
+REPORT_WORKERS = env_int('REPORT_WORKERS', 2)
+REPORT_CACHE_MAX_BYTES = env_int('REPORT_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+REPORT_MEDIA_TYPES = {"pdf": "application/pdf", "csv": "text/csv; charset=utf-8"}
+REPORT_PROJECTION = {"_id": 0, **{field: 1 for field in reports.ROSTER_FIELDS}}
+
+report_pool = None
+
+def get_report_pool():
+    global report_pool
+    if report_pool is None:
+        # Imported here, process pools add noticeably to a worker's import time
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        # Spawned, not forked: a fork would copy locks held by Motor's threads
+        report_pool = ProcessPoolExecutor(REPORT_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return report_pool
+
+class ReportCache:
+    """Rendered reports, least recently used evicted first, bounded by total size"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.render_ms = Histogram()
+        self._entries: "OrderedDict[tuple, bytes]" = OrderedDict()
+
+    def get(self, key: tuple) -> Optional[bytes]:
+        body = self._entries.get(key)
+        if body is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return body
+
+    def put(self, key: tuple, body: bytes):
+        if len(body) > self.max_bytes:
+            return
+        self.size += len(body) - len(self._entries.pop(key, b""))
+        self._entries[key] = body
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "render": self.render_ms.stats(),
+        }
+
+report_cache = ReportCache(REPORT_CACHE_MAX_BYTES)
+
+async def report_classes(tenant: Tenant, class_name: Optional[str]) -> List[dict]:
+    body, _ = await settings_cache.get_or_load("classes", load_class_settings)
+    classes = orjson.loads(body)
+    # Students in a class without settings still have to be on the printed lists
+    known = {class_settings["class_name"] for class_settings in classes}
+    for name in sorted(await tenant.db.students.distinct("class_name", tenant.scope())):
+        if name not in known:
+            classes.append({"class_name": name, "teacher_name": "", "background_color": None})
+    if class_name is not None:
+        classes = [class_settings for class_settings in classes if class_settings["class_name"] == class_name]
+        if not classes:
+            raise HTTPException(status_code=404, detail="Class not found")
+    return classes
+
+async def render_class_report(tenant: Tenant, format: str, school_name: str, class_settings: dict):
+    students = await tenant.db.students.find(
+        tenant.scope({"class_name": class_settings["class_name"]}), REPORT_PROJECTION
+    ).sort("first_and_last_name_lower", ASCENDING).to_list(None)
+    started = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    if format == "csv":
+        rendered = await loop.run_in_executor(get_report_pool(), reports.render_csv_section, class_settings, students)
+    else:
+        rendered = await loop.run_in_executor(
+            get_report_pool(), reports.render_pdf_pages, school_name, class_settings, students
+        )
+    report_cache.render_ms.observe((time.perf_counter() - started) * 1000)
+    return rendered
+
+async def render_roster(tenant: Tenant, format: str, classes: List[dict]):
+    """Yield a roster report class by class, rendering up to REPORT_WORKERS classes ahead"""
+    settings = orjson.loads((await settings_cache.get_or_load("settings", load_app_settings))[0])
+    document = reports.PdfDocument() if format == "pdf" else None
+    pending = deque()
+    try:
+        yield document.start() if document else reports.csv_header()
+        for class_settings in classes:
+            pending.append(asyncio.create_task(
+                render_class_report(tenant, format, settings["school_name"], class_settings)
+            ))
+            if len(pending) > REPORT_WORKERS:
+                rendered = await pending.popleft()
+                yield b"".join(map(document.add_page, rendered)) if document else rendered
+        while pending:
+            rendered = await pending.popleft()
+            yield b"".join(map(document.add_page, rendered)) if document else rendered
+        if document:
+            yield document.finish()
+    finally:
+        # The client went away before the end
+        for task in pending:
+            task.cancel()
+
+async def cache_report(chunks, key: tuple):
+    """Pass a streamed report through and cache it once it is complete, unless it outgrows the cache"""
+    body = []
+    size = 0
+    async for chunk in chunks:
+        yield chunk
+        if body is None:
+            continue
+        size += len(chunk)
+        if size > report_cache.max_bytes:
+            body = None
+        else:
+            body.append(chunk)
+    if body is not None:
+        report_cache.put(key, b"".join(body))
+
+@api_router.get("/reports/roster")
+async def get_roster_report(
+    request: Request,
+    format: str = Query("pdf", pattern="^(pdf|csv)$"),
+    class_name: Optional[str] = None,
+    tenant: Tenant = Depends(tenant_scope),
+):
+    collections = ("students", "class_settings", "app_settings")
+    etag = await collection_etag(request, *collections)
+    filename = normalize_search_text(class_name or "colegio").replace(" ", "_") or "clase"
+    headers = {
+        **etag_headers(etag),
+        "Content-Disposition": f'attachment; filename="listado_{filename}.{format}"',
+    }
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    key = (tenant.id, format, class_name, await collection_versions.current(*collections))
+    body = report_cache.get(key)
+    if body is not None:
+        return Response(body, media_type=REPORT_MEDIA_TYPES[format], headers=headers)
+
+    classes = await report_classes(tenant, class_name)
+    if class_name is not None:
+        # One class is small: render it whole, once for concurrent requests
+        async def render():
+            body = b"".join([chunk async for chunk in render_roster(tenant, format, classes)])
+            report_cache.put(key, body)
+            return body
+        body = await single_flight.do(("report",) + key, render)
+        return Response(body, media_type=REPORT_MEDIA_TYPES[format], headers=headers)
+    return StreamingResponse(
+        cache_report(render_roster(tenant, format, classes), key), media_type=REPORT_MEDIA_TYPES[format], headers=headers
+    )
+
+# Offline sync
+# Tablets keep a local copy of the roster and, on reconnect, fetch only what
+# changed since their last token: changed students and classes plus the
+# deleted students, in updated_seq order and bounded pages.
+def sync_token(seq: int, issued_at: int) -> str:
+    return f"{seq}.{issued_at}"
+
+def parse_sync_token(token: Optional[str]) -> Tuple[int, int]:
+    if not token:
+        return 0, int(time.time())
+    try:
+        seq, issued_at = (int(part) for part in token.split("."))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid sync token")
+    # Older tokens may have missed deletions whose tombstones have expired since
+    if time.time() - issued_at > SYNC_TOMBSTONE_DAYS * 86400:
+        raise HTTPException(status_code=410, detail="Sync token expired, sync again without since")
+    return seq, issued_at
+
+@api_router.get("/sync", response_model=SyncPage)
+async def sync_changes(
+    since: Optional[str] = None,
+    limit: int = Query(SYNC_PAGE_DEFAULT, ge=1, le=SYNC_PAGE_MAX),
+    tenant: Tenant = Depends(tenant_scope),
+):
+    since_seq, issued_at = parse_sync_token(since)
+    watermark = await sync_sequence.watermark()
+    window = tenant.scope({"updated_seq": {"$gt": since_seq, "$lte": watermark}})
+
+    async def changed(collection, projection):
+        cursor = collection.find(window, projection).sort("updated_seq", ASCENDING).limit(limit + 1)
+        return await cursor.to_list(limit + 1)
+
+    students, classes, deleted = await asyncio.gather(
+        changed(tenant.db.students, STUDENT_PROJECTION),
+        changed(tenant.db.class_settings, CLASS_SETTINGS_PROJECTION),
+        changed(tenant.db.tombstones, {"_id": 0, **{field: 1 for field in SyncDeletion.model_fields}}),
+    )
+    # Every change has its own sequence number, so the page ends at the limit-th lowest one
+    changes = sorted(
+        [(doc["updated_seq"], "students", doc) for doc in students]
+        + [(doc["updated_seq"], "classes", doc) for doc in classes]
+        + [(doc["updated_seq"], "deleted", doc) for doc in deleted],
+        key=lambda change: change[0],
+    )
+    has_more = len(changes) > limit
+    page = {"students": [], "classes": [], "deleted": []}
+    for _, kind, doc in changes[:limit]:
+        page[kind].append(doc)
+    if has_more:
+        # The next page continues from here; keep the original issue time for expiry
+        token = sync_token(changes[limit - 1][0], issued_at)
+    else:
+        token = sync_token(watermark, int(time.time()))
+    return ORJSONResponse({**page, "token": token, "has_more": has_more})
+
+async def stream_changes(request: Request, subscriber: ChangeSubscriber):
+    try:
+        yield b"retry: 3000\n\n"
+        while True:
+            if subscriber.overflowed:
+                subscriber.overflowed = False
+                while not subscriber.queue.empty():
+                    subscriber.queue.get_nowait()
+                for collection in WATCHED_COLLECTIONS:
+                    event = resync_change(collection, subscriber.tenant_id)
+                    yield b"event: change\ndata: " + orjson.dumps(event) + b"\n\n"
+            try:
+                event = await asyncio.wait_for(subscriber.queue.get(), CHANGE_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                if await request.is_disconnected():
+                    break
+                yield b": keepalive\n\n"
+                continue
+            yield b"event: change\ndata: " + orjson.dumps(event) + b"\n\n"
+    finally:
+        change_hub.unsubscribe(subscriber)
+
+# Server-sent events with per-document deltas, optionally for one class only
+@api_router.get("/events")
+async def get_events(request: Request, class_name: Optional[str] = None, tenant: Tenant = Depends(tenant_scope)):
+    subscriber = change_hub.subscribe(tenant.id, class_name)
+    return StreamingResponse(
+        stream_changes(request, subscriber),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# Everything the main screen needs in one call
+@api_router.get("/dashboard", response_model=Dashboard)
+async def get_dashboard(request: Request, tenant: Tenant = Depends(tenant_scope)):
+    etag = await collection_etag(request, "students", "class_settings", "app_settings")
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=etag_headers(etag))
+    settings_body, _ = await settings_cache.get_or_load("settings", load_app_settings)
+    classes_body, _ = await settings_cache.get_or_load("classes", load_class_settings)
+    # One $group over the (tenant_id, class_name, ...) index instead of loading the roster
+    counts = {
+        group["_id"]: group["count"]
+        async for group in tenant.db.students.aggregate([
+            {"$match": tenant.scope()},
+            {"$group": {"_id": "$class_name", "count": {"$sum": 1}}},
+        ])
+    }
+    classes = orjson.loads(classes_body)
+    for class_settings in classes:
+        class_settings["student_count"] = counts.get(class_settings["class_name"], 0)
+    return ORJSONResponse({
+        "settings": orjson.loads(settings_body),
+        "classes": classes,
+        "total_students": sum(counts.values()),
+    }, headers=etag_headers(etag))
+
+# Runtime counters for the in-process caches
+@api_router.get("/stats")
+async def get_stats(tenant: Tenant = Depends(tenant_scope)):
+    return {
+        "settings_cache": settings_cache.stats(),
+        "single_flight": single_flight.stats(),
+        "mongo_pool": pool_monitor.stats(),
+        "change_feed": change_hub.stats(),
+        "audit_log": audit_log.stats(),
+        "reports": report_cache.stats(),
+        "admission": admission.stats(),
+        "tenant": {"id": tenant.id, **tenant.stats()},
+    }
+
+def prometheus_histogram(lines: List[str], name: str, labels: str, histogram: Histogram):
+    with histogram._lock:
+        counts, total, count = list(histogram.counts), histogram.sum, histogram.count
+    cumulative = 0
+    for bound, bucket_count in zip(Histogram.BUCKETS_MS + ("+Inf",), counts):
+        cumulative += bucket_count
+        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+    lines.append(f"{name}_sum{{{labels}}} {total}")
+    lines.append(f"{name}_count{{{labels}}} {count}")
+
+def prometheus_label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+# Prometheus text exposition of the request, Mongo and cache metrics
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    lines = ["# TYPE http_request_duration_ms histogram"]
+    for (method, route), histogram in list(request_durations.items()):
+        labels = f'method="{method}",route="{prometheus_label(route)}"'
+        prometheus_histogram(lines, "http_request_duration_ms", labels, histogram)
+    lines.append("# TYPE http_responses_total counter")
+    for (method, route, status), count in list(request_responses.items()):
+        lines.append(f'http_responses_total{{method="{method}",route="{prometheus_label(route)}",status="{status}"}} {count}')
+
+    lines.append("# TYPE mongo_command_duration_ms histogram")
+    for (collection, command), histogram in list(command_monitor.durations.items()):
+        labels = f'collection="{prometheus_label(collection)}",command="{command}"'
+        prometheus_histogram(lines, "mongo_command_duration_ms", labels, histogram)
+    lines.append("# TYPE mongo_command_documents_total counter")
+    for (collection, command), count in list(command_monitor.documents.items()):
+        lines.append(f'mongo_command_documents_total{{collection="{prometheus_label(collection)}",command="{command}"}} {count}')
+    lines.append("# TYPE mongo_command_failures_total counter")
+    for (collection, command), count in list(command_monitor.failures.items()):
+        lines.append(f'mongo_command_failures_total{{collection="{prometheus_label(collection)}",command="{command}"}} {count}')
+
+    lines.append("# TYPE mongo_pool_checkout_wait_ms histogram")
+    prometheus_histogram(lines, "mongo_pool_checkout_wait_ms", 'pool="default"', pool_monitor.wait_ms)
+    lines += [
+        "# TYPE mongo_pool_failed_checkouts_total counter",
+        f"mongo_pool_failed_checkouts_total {pool_monitor.failed_checkouts}",
+        "# TYPE mongo_pool_open_connections gauge",
+        f"mongo_pool_open_connections {pool_monitor.open_connections}",
+        "# TYPE mongo_pool_checked_out_connections gauge",
+        f"mongo_pool_checked_out_connections {pool_monitor.checked_out}",
+        "# TYPE settings_cache_hits_total counter",
+        f"settings_cache_hits_total {settings_cache.hits}",
+        "# TYPE settings_cache_misses_total counter",
+        f"settings_cache_misses_total {settings_cache.misses}",
+        "# TYPE single_flight_coalesced_total counter",
+        f"single_flight_coalesced_total {single_flight.coalesced}",
+        "# TYPE single_flight_loads_total counter",
+        f"single_flight_loads_total {single_flight.leaders}",
+        "# TYPE tenant_requests_in_flight gauge",
+        *(f'tenant_requests_in_flight{{tenant="{tenant_id}"}} {tenant.in_flight}' for tenant_id, tenant in list(tenants.items())),
+        "# TYPE tenant_requests_rejected_total counter",
+        *(f'tenant_requests_rejected_total{{tenant="{tenant_id}"}} {tenant.rejected}' for tenant_id, tenant in list(tenants.items())),
+        "# TYPE audit_queue_depth gauge",
+        f"audit_queue_depth {audit_log.queue.qsize()}",
+        "# TYPE audit_records_total counter",
+        f'audit_records_total{{result="enqueued"}} {audit_log.enqueued}',
+        f'audit_records_total{{result="written"}} {audit_log.written}',
+        f'audit_records_total{{result="failed"}} {audit_log.failed}',
+        f'audit_records_total{{result="dropped"}} {audit_log.dropped}',
+        "# TYPE audit_backpressure_waits_total counter",
+        f"audit_backpressure_waits_total {audit_log.backpressure_waits}",
+        "# TYPE audit_flush_duration_ms histogram",
+    ]
+    prometheus_histogram(lines, "audit_flush_duration_ms", 'queue="audit_log"', audit_log.flush_ms)
+    lines += [
+        "# TYPE report_cache_hits_total counter",
+        f"report_cache_hits_total {report_cache.hits}",
+        "# TYPE report_cache_misses_total counter",
+        f"report_cache_misses_total {report_cache.misses}",
+        "# TYPE report_render_duration_ms histogram",
+    ]
+    prometheus_histogram(lines, "report_render_duration_ms", 'pool="reports"', report_cache.render_ms)
+    lines += [
+        "# TYPE admission_requests_in_flight gauge",
+        f"admission_requests_in_flight {admission.in_flight}",
+        "# TYPE admission_requests_waiting gauge",
+        f"admission_requests_waiting {admission.waiting}",
+        "# TYPE admission_requests_admitted_total counter",
+        *(f'admission_requests_admitted_total{{route_class="{name}"}} {count}' for name, count in list(admission.admitted.items())),
+        "# TYPE admission_requests_rejected_total counter",
+        *(
+            f'admission_requests_rejected_total{{route_class="{name}",reason="{reason}"}} {count}'
+            for (name, reason), count in list(admission.rejected.items())
+        ),
+    ]
+    if isinstance(rate_limiter, MongoTokenBucketLimiter):
+        lines += ["# TYPE rate_limit_fallbacks_total counter", f"rate_limit_fallbacks_total {rate_limiter.fallbacks}"]
+    return Response("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
 
 # Include the router in the main app
 app.include_router(api_router)
 
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(TenantBudgetMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -194,14 +2770,253 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+UNCOMPRESSED_PATHS = ("/api/images/", "/api/events")
+
+class CompressionMiddleware:
+    """Brotli when brotli-asgi is installed (falling back to gzip for clients without br), else gzip.
+
+    Stored images are already compressed and must keep byte ranges valid, and
+    server-sent events must not wait in the compressor's buffer, so both
+    bypass compression.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        try:
+            from brotli_asgi import BrotliMiddleware
+            self.compressed_app = BrotliMiddleware(app, minimum_size=COMPRESSION_MIN_SIZE, gzip_fallback=True)
+        except ImportError:
+            from starlette.middleware.gzip import GZipMiddleware
+            self.compressed_app = GZipMiddleware(app, minimum_size=COMPRESSION_MIN_SIZE)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith(UNCOMPRESSED_PATHS):
+            await self.app(scope, receive, send)
+        else:
+            await self.compressed_app(scope, receive, send)
+
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(RequestMetricsMiddleware)
 
 # Configure logging
 logging.basicConfig(
-    level=logging.INFO,
+    level=logging.DEBUG if DEBUG else logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+async def backfill_student_defaults():
+    """Store default values for fields added to Student after documents were written"""
+    for field, info in Student.model_fields.items():
+        if info.default_factory is None and not info.is_required():
+            result = await db.students.update_many({field: {"$exists": False}}, {"$set": {field: info.default}})
+            if result.modified_count:
+                logger.info(f"Backfilled {field} on {result.modified_count} students")
+
+async def backfill_student_derived_fields():
+    """Add derived fields to students stored before they were introduced"""
+    cursor = db.students.find(
+        {"$or": [{"first_and_last_name_lower": {"$exists": False}}, {"search_field_tokens": {"$exists": False}}]},
+        {field: 1 for field in ("_id", "id") + SEARCHABLE_FIELDS},
+    )
+    updates = [
+        UpdateOne(
+            {"_id": student["_id"]},
+            {
+                "$set": {**student_derived_fields(student), **student_search_fields(student)},
+                "$unset": {"search_text": ""},
+            },
+        )
+        async for student in cursor
+    ]
+    if updates:
+        await db.students.bulk_write(updates, ordered=False)
+        logger.info(f"Backfilled derived fields on {len(updates)} students")
+
+async def offload_settings_images():
+    """Move inline data: URL images stored in the settings to the image store"""
+    async for settings in db.app_settings.find({"home_image_url": {"$regex": "^data:"}}, {"home_image_url": 1}):
+        try:
+            url = await offload_data_url(settings["home_image_url"])
+        except HTTPException as e:
+            logger.warning(f"Left the inline home image of settings {settings['_id']} in place: {e.detail}")
+            continue
+        await db.app_settings.update_one({"_id": settings["_id"]}, {"$set": {"home_image_url": url}})
+        logger.info(f"Moved the inline home image to {url}")
+
+async def assign_default_tenant():
+    """Move documents written before tenants existed to the default tenant"""
+    for collection in ("students", "class_settings", "app_settings"):
+        result = await db[collection].update_many(
+            {"tenant_id": {"$exists": False}}, {"$set": {"tenant_id": DEFAULT_TENANT}}
+        )
+        if result.modified_count:
+            logger.info(f"Assigned {result.modified_count} {collection} documents to tenant {DEFAULT_TENANT}")
+
+async def backfill_updated_seq():
+    """Number documents written before updated_seq existed, so a first sync returns them"""
+    for collection in ("students", "class_settings"):
+        missing = defaultdict(list)
+        async for document in db[collection].find({"updated_seq": {"$exists": False}}, {"_id": 1, "tenant_id": 1}):
+            missing[document["tenant_id"]].append(document["_id"])
+        for tenant_id, ids in missing.items():
+            token = current_tenant.set(tenant_id)
+            try:
+                async with sync_sequence.allocate(len(ids)) as first_seq:
+                    await db[collection].bulk_write(
+                        [UpdateOne({"_id": _id}, {"$set": {"updated_seq": seq}}) for seq, _id in enumerate(ids, first_seq)],
+                        ordered=False,
+                    )
+            finally:
+                current_tenant.reset(token)
+            logger.info(f"Numbered {len(ids)} {collection} of tenant {tenant_id} for sync")
+
+async def remove_duplicate_classes():
+    """Drop duplicate classes left behind by concurrent lazy seeding, keeping the oldest"""
+    duplicates = db.class_settings.aggregate([
+        {"$group": {
+            "_id": {"tenant_id": "$tenant_id", "class_name": "$class_name"},
+            "ids": {"$push": "$_id"},
+            "count": {"$sum": 1},
+        }},
+        {"$match": {"count": {"$gt": 1}}},
+    ])
+    async for duplicate in duplicates:
+        extra_ids = sorted(duplicate["ids"])[1:]
+        await db.class_settings.delete_many({"_id": {"$in": extra_ids}})
+        logger.warning(f"Removed {len(extra_ids)} duplicate classes named {duplicate['_id']['class_name']} "
+                       f"of tenant {duplicate['_id']['tenant_id']}")
+
+async def seed_default_classes(tenant: Tenant):
+    """Create the default classes of a tenant that has none.
+
+    Upserts keyed on the unique (tenant_id, class_name) make this safe when
+    several workers see a new tenant at the same time.
+    """
+    if await tenant.db.class_settings.count_documents(tenant.scope(), limit=1):
+        return
+    async with sync_sequence.allocate(len(DEFAULT_CLASSES)) as first_seq:
+        try:
+            await tenant.db.class_settings.bulk_write(
+                [
+                    UpdateOne(
+                        tenant.scope({"class_name": class_data["class_name"]}),
+                        {"$setOnInsert": ClassSettings(**class_data, tenant_id=tenant.id, updated_seq=seq).dict()},
+                        upsert=True,
+                    )
+                    for seq, class_data in enumerate(DEFAULT_CLASSES, first_seq)
+                ],
+                ordered=False,
+            )
+        except BulkWriteError as e:
+            # Another worker upserted the same class first
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+    await collection_versions.bump("class_settings")
+    logger.info(f"Seeded default classes of tenant {tenant.id}")
+
+# Single-school indexes, replaced by the tenant-prefixed ones below
+LEGACY_INDEXES = {
+    "students": ("id_1", "class_name_1_first_and_last_name_lower_1", "search_tokens_1"),
+    "class_settings": ("id_1", "class_name_1"),
+    "app_settings": ("id_1",),
+}
+
+async def ensure_indexes(database):
+    for collection, names in LEGACY_INDEXES.items():
+        existing = await database[collection].index_information()
+        for name in names:
+            if name in existing:
+                await database[collection].drop_index(name)
+                logger.info(f"Dropped legacy index {collection}.{name}")
+    await database.students.create_index([("tenant_id", ASCENDING), ("id", ASCENDING)], unique=True)
+    await database.students.create_index(
+        [("tenant_id", ASCENDING), ("class_name", ASCENDING), ("first_and_last_name_lower", ASCENDING)]
+    )
+    await database.students.create_index([("tenant_id", ASCENDING), ("search_tokens", ASCENDING)])
+    await database.students.create_index([("tenant_id", ASCENDING), ("search_name", ASCENDING)])
+    await database.class_settings.create_index([("tenant_id", ASCENDING), ("id", ASCENDING)], unique=True)
+    await database.class_settings.create_index([("tenant_id", ASCENDING), ("class_name", ASCENDING)], unique=True)
+    await database.app_settings.create_index("tenant_id", unique=True)
+    # GET /api/sync reads each source in updated_seq order
+    await database.students.create_index([("tenant_id", ASCENDING), ("updated_seq", ASCENDING)])
+    await database.class_settings.create_index([("tenant_id", ASCENDING), ("updated_seq", ASCENDING)])
+    await database.tombstones.create_index([("tenant_id", ASCENDING), ("updated_seq", ASCENDING)])
+    await database.tombstones.create_index("deleted_at", expireAfterSeconds=SYNC_TOMBSTONE_DAYS * 86400)
+    # A document's history, newest first, and a school's recent activity
+    await database.audit_log.create_index([("tenant_id", ASCENDING), ("document_id", ASCENDING), ("at", DESCENDING)])
+    await database.audit_log.create_index([("tenant_id", ASCENDING), ("at", DESCENDING)])
+
+def plan_stages(plan: dict):
+    """Yield every stage name of an explain() winning plan"""
+    yield plan.get("stage")
+    for child in plan.get("inputStages", []) + [plan.get("inputStage")]:
+        if child:
+            yield from plan_stages(child)
+
+async def check_query_plans():
+    """Log a warning for every hot route query that is not served by an index"""
+    tenant = {"tenant_id": DEFAULT_TENANT}
+    hot_queries = {
+        "get/update/delete_student": db.students.find({**tenant, "id": ""}),
+        "get_students_by_class": db.students.find({**tenant, "class_name": ""}).sort("first_and_last_name_lower", ASCENDING),
+        "update_class_settings": db.class_settings.find({**tenant, "id": ""}),
+    }
+    for route, cursor in hot_queries.items():
+        explain = await cursor.explain()
+        winning_plan = explain.get("queryPlanner", {}).get("winningPlan", {})
+        # Servers using the slot-based engine nest the classic plan under "queryPlan"
+        stages = set(plan_stages(winning_plan.get("queryPlan", winning_plan)))
+        if "COLLSCAN" in stages:
+            logger.warning(f"Query plan for {route} falls back to COLLSCAN: {sorted(s for s in stages if s)}")
+        else:
+            logger.debug(f"Query plan for {route} uses an index: {sorted(s for s in stages if s)}")
+
+async def prepare_tenant(tenant: Tenant):
+    """Index a dedicated tenant database and seed the default classes of a new tenant"""
+    token = current_tenant.set(tenant.id)
+    try:
+        if tenant.db is not db:
+            try:
+                await ensure_indexes(tenant.db)
+            except OperationFailure as e:
+                logger.error(f"Could not create indexes for tenant {tenant.id}: {e}")
+        await seed_default_classes(tenant)
+    finally:
+        current_tenant.reset(token)
+
+async def prepare_database():
+    # Fail fast if Mongo is unreachable, and open the first pooled connection
+    await client.admin.command("ping")
+    await assign_default_tenant()
+    await backfill_updated_seq()
+    await remove_duplicate_classes()
+    try:
+        await ensure_indexes(db)
+        if RATE_LIMIT_BACKEND == "mongo":
+            await db.rate_limits.create_index("expires_at", expireAfterSeconds=0)
+    except OperationFailure as e:
+        logger.error(f"Could not create indexes: {e}")
+    for tenant_id in sorted(SERVED_TENANTS):
+        await prepare_tenant(get_tenant(tenant_id))
+    await backfill_student_defaults()
+    await backfill_student_derived_fields()
+    await offload_settings_images()
+    if DEBUG:
+        await check_query_plans()
+
+async def warm_up():
+    """Open the minimum pool and load the cached lists before the worker accepts traffic.
+
+    Uvicorn only starts serving once the lifespan startup returns, so the
+    first requests of a freshly scaled-out worker neither wait on TCP/TLS
+    handshakes to Mongo nor on a cold settings cache.
+    """
+    started = time.perf_counter()
+    connections = max(1, env_int('MONGO_MIN_POOL_SIZE', 10))
+    # Concurrent commands each check out their own connection
+    await asyncio.gather(*(client.admin.command("ping") for _ in range(connections)))
+    await settings_cache.get_or_load("classes", load_class_settings)
+    await settings_cache.get_or_load("settings", load_app_settings)
+    logger.info(f"Warmed {connections} Mongo connections and the settings cache in "
+                f"{(time.perf_counter() - started) * 1000:.0f} ms")
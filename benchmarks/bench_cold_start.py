@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Cold start of a scaled-out worker: time from process spawn to first response
+Starts backend/cli.py with one worker against MONGO_URL, polls GET /api/classes
+until it answers, then times the first GET /api/students/class/{class_name}.
+Repeats --runs times and exits non-zero if the median time to the first
+response exceeds --budget-ms.
+
+Usage:
+  MONGO_URL=mongodb://localhost:27017 python benchmarks/bench_cold_start.py
+  python benchmarks/bench_cold_start.py --runs 10 --budget-ms 2000
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR))
+
+from load_test import percentile  # noqa: E402
+import server  # noqa: E402
+
+CLI = BENCH_DIR.parent / "backend" / "cli.py"
+
+
+def cold_start(port):
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, str(CLI), "--port", str(port), "--workers", "1", "--log-level", "warning"]
+    )
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=30) as http:
+            while True:
+                if process.poll() is not None:
+                    raise RuntimeError(f"server exited with {process.returncode}")
+                try:
+                    if http.get("/api/classes").status_code == 200:
+                        break
+                except httpx.TransportError:
+                    time.sleep(0.01)
+            ready = time.perf_counter()
+            class_name = server.DEFAULT_CLASSES[0]["class_name"]
+            response = http.get(f"/api/students/class/{class_name}")
+            response.raise_for_status()
+            first_read = time.perf_counter()
+    finally:
+        process.terminate()
+        process.wait()
+    return (ready - started) * 1000, (first_read - ready) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=3000, help="budget for spawn to first response")
+    parser.add_argument("--port", type=int, default=8767)
+    args = parser.parse_args()
+
+    ready_ms, first_read_ms = [], []
+    for run in range(args.runs):
+        ready, first_read = cold_start(args.port)
+        ready_ms.append(ready)
+        first_read_ms.append(first_read)
+        print(f"run {run + 1}: first response after {ready:.0f} ms, first class read {first_read:.1f} ms")
+
+    median = statistics.median(ready_ms)
+    print(f"\nspawn to first response: median {median:.0f} ms, max {max(ready_ms):.0f} ms "
+          f"(budget {args.budget_ms:.0f} ms)")
+    print(f"first class read: median {statistics.median(first_read_ms):.1f} ms, "
+          f"p99 {percentile(first_read_ms, 99):.1f} ms")
+    if median > args.budget_ms:
+        sys.exit(f"cold start over budget by {median - args.budget_ms:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
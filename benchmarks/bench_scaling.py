@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Throughput scaling of the student read endpoints across worker processes
+Seeds a roster in the BENCH_DB_NAME database of MONGO_URL, then starts
+backend/cli.py with 1, 2, 4 ... up to --max-workers workers and drives a
+read-only mix of GET /students/{id}, /students/class/{class_name},
+/students?limit and /students/search against each. Load is generated from
+several client processes so the client is not the bottleneck. Reports RPS,
+p50/p99 and the speedup over one worker.
+
+Usage:
+  MONGO_URL=mongodb://localhost:27017 python benchmarks/bench_scaling.py --students 50000
+  python benchmarks/bench_scaling.py --max-workers 8 --duration 20 --client-processes 4
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR))
+
+from load_test import DB_NAME, FIRST_NAMES, percentile, seed  # noqa: E402
+import server  # noqa: E402
+
+CLI = BENCH_DIR.parent / "backend" / "cli.py"
+
+
+def read_operations(ids, classes):
+    return [
+        lambda http: http.get(f"/api/students/{random.choice(ids)}"),
+        lambda http: http.get(f"/api/students/class/{random.choice(classes)}"),
+        lambda http: http.get("/api/students", params={"limit": 100, "after": random.choice(ids)}),
+        lambda http: http.get("/api/students/search", params={"q": random.choice(FIRST_NAMES)[:3]}),
+    ]
+
+
+async def drive(port, ids, classes, concurrency, duration):
+    operations = read_operations(ids, classes)
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def user(http):
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                ok = (await random.choice(operations)(http)).status_code < 400
+            except httpx.HTTPError:
+                ok = False
+            latencies.append((time.perf_counter() - started) * 1000)
+            errors += not ok
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=60, limits=limits) as http:
+        await asyncio.gather(*(user(http) for _ in range(concurrency)))
+    return latencies, errors
+
+
+def client_process(arguments):
+    port, ids, classes, concurrency, duration, client_seed = arguments
+    random.seed(client_seed)
+    return asyncio.run(drive(port, ids, classes, concurrency, duration))
+
+
+def wait_until_ready(port, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with {process.returncode}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/api/classes", timeout=2).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("server did not become ready")
+
+
+def measure(args, workers, ids, classes):
+    process = subprocess.Popen(
+        [sys.executable, str(CLI), "--port", str(args.port), "--workers", str(workers), "--log-level", "warning"]
+    )
+    try:
+        wait_until_ready(args.port, process)
+        per_client = max(1, args.concurrency // args.client_processes)
+        with multiprocessing.Pool(args.client_processes) as pool:
+            # Warm up every worker's connection pool before measuring
+            pool.map(client_process, [(args.port, ids, classes, per_client, 2, n) for n in range(args.client_processes)])
+            started = time.perf_counter()
+            runs = pool.map(client_process, [
+                (args.port, ids, classes, per_client, args.duration, args.seed + n)
+                for n in range(args.client_processes)
+            ])
+            elapsed = time.perf_counter() - started
+    finally:
+        process.terminate()
+        process.wait()
+    latencies = [sample for samples, _ in runs for sample in samples]
+    return {
+        "workers": workers,
+        "requests": len(latencies),
+        "errors": sum(errors for _, errors in runs),
+        "rps": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50),
+        "p99_ms": percentile(latencies, 99),
+    }
+
+
+async def prepare(students):
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    mongo = AsyncIOMotorClient(os.environ["MONGO_URL"])
+    try:
+        ids = await seed(mongo[DB_NAME], students)
+    finally:
+        mongo.close()
+    return ids
+
+
+def main():
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--students", type=int, default=10000, help="roster size to seed")
+    parser.add_argument("--max-workers", type=int, default=cores, help="largest worker count to measure")
+    parser.add_argument("--concurrency", type=int, default=64, help="concurrent connections in total")
+    parser.add_argument("--client-processes", type=int, default=max(1, cores // 2), help="load generator processes")
+    parser.add_argument("--duration", type=float, default=15, help="seconds of load per worker count")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    ids = asyncio.run(prepare(args.students))
+    classes = [class_settings["class_name"] for class_settings in server.DEFAULT_CLASSES]
+
+    worker_counts = []
+    workers = 1
+    while workers < args.max_workers:
+        worker_counts.append(workers)
+        workers *= 2
+    worker_counts.append(args.max_workers)
+
+    print(f"{args.students} students, {args.concurrency} connections from {args.client_processes} "
+          f"client processes, {cores} cores")
+    print(f"{'workers':>8}{'reqs':>9}{'err':>6}{'rps':>10}{'p50':>9}{'p99':>9}{'speedup':>9}{'eff':>7}")
+    baseline = None
+    for workers in worker_counts:
+        result = measure(args, workers, ids, classes)
+        baseline = baseline or result["rps"]
+        speedup = result["rps"] / baseline
+        print(f"{workers:>8}{result['requests']:>9}{result['errors']:>6}{result['rps']:>10.1f}"
+              f"{result['p50_ms']:>9.2f}{result['p99_ms']:>9.2f}{speedup:>8.2f}x{speedup / workers:>7.0%}")
+
+
+if __name__ == "__main__":
+    main()
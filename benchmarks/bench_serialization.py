@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Student list serialization microbenchmark
+Compares the previous read path (a Pydantic Student per document, then
+FastAPI's response_model validation and JSON encoding) with the projected
+documents encoded straight to JSON by orjson.
+
+Usage: python benchmarks/bench_serialization.py [students] [rounds]
+"""
+
+import json
+import os
+import statistics
+import sys
+import time
+import uuid
+from pathlib import Path
+from typing import List
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "bench_serialization")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+from server import DEFAULT_TENANT, STUDENT_FIELDS, Student
+
+students_adapter = TypeAdapter(List[Student])
+
+
+def make_students(count):
+    return [
+        {
+            "id": str(uuid.uuid4()),
+            "tenant_id": DEFAULT_TENANT,
+            "first_and_last_name": f"Alumno Número {i}",
+            "class_name": "3º DE PRIMARIA",
+            "mother_name": "María García",
+            "mother_phone": "612 345 678",
+            "father_name": "José López",
+            "father_phone": "698 765 432",
+            "allergies": "Frutos secos" if i % 7 == 0 else "",
+            "comments": "Recoger a las 14:00" if i % 5 == 0 else "",
+            "updated_seq": i + 1,
+        }
+        for i in range(count)
+    ]
+
+
+def before(documents):
+    # What the routes did: one model per document, then FastAPI validated
+    # the response_model again and encoded it with the standard library.
+    models = [Student(**document) for document in documents]
+    validated = students_adapter.validate_python(models, from_attributes=True)
+    return json.dumps(jsonable_encoder(validated)).encode("utf-8")
+
+
+def after(documents):
+    return orjson.dumps(documents)
+
+
+def timed(function, documents, rounds):
+    samples = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        function(documents)
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+def main(count, rounds):
+    documents = make_students(count)
+    assert list(documents[0]) == STUDENT_FIELDS
+    assert orjson.loads(before(documents)) == orjson.loads(after(documents))
+
+    print(f"Serializing {count} students, {rounds} rounds")
+    print(f"{'path':<30}{'median ms':>12}{'min ms':>10}")
+    results = {}
+    for name, function in (("pydantic + response_model", before), ("projection + orjson", after)):
+        samples = timed(function, documents, rounds)
+        results[name] = statistics.median(samples)
+        print(f"{name:<30}{results[name]:>12.2f}{min(samples):>10.2f}")
+    print(f"speedup: {results['pydantic + response_model'] / results['projection + orjson']:.1f}x")
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 10000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 20,
+    )
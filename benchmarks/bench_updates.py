@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Update latency benchmark: update_one + find_one vs find_one_and_update
+Runs both write patterns used by update_student against a local mongod and
+reports p50/p99 latencies for each. It then adds the GET /api/sync sequence
+number to every update, once leased per write in the tenant's counter
+document (a pipeline update before the write and a $pull after it) and once
+taken from a block of SYNC_BLOCK_SIZE numbers, and reports latencies and the
+throughput of CONCURRENT_WRITERS writers of one school.
+
+Usage: MONGO_URL=mongodb://localhost:27017 python benchmarks/bench_updates.py [iterations]
+"""
+
+import asyncio
+import os
+import statistics
+import sys
+import time
+import uuid
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+
+MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
+DB_NAME = os.environ.get("BENCH_DB_NAME", "bench_updates")
+STUDENTS = 1000
+SYNC_BLOCK_SIZE = 100
+CONCURRENT_WRITERS = 50
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def two_roundtrips(collection, student_id, update_data):
+    await collection.update_one({"id": student_id}, {"$set": update_data})
+    return await collection.find_one({"id": student_id}, {"_id": 0})
+
+
+async def single_roundtrip(collection, student_id, update_data):
+    return await collection.find_one_and_update(
+        {"id": student_id},
+        {"$set": update_data},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+async def leased_per_write(collection, student_id, update_data):
+    counters = collection.database.sync_sequences
+    lease = uuid.uuid4().hex
+    counter = await counters.find_one_and_update(
+        {"_id": "bench"},
+        [{"$set": {
+            "seq": {"$add": [{"$ifNull": ["$seq", 0]}, 1]},
+            "pending": {"$concatArrays": [
+                {"$ifNull": ["$pending", []]},
+                [{"id": lease, "first": {"$add": [{"$ifNull": ["$seq", 0]}, 1]}, "at": time.time()}],
+            ]},
+        }}],
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    document = await single_roundtrip(collection, student_id, {**update_data, "updated_seq": counter["seq"]})
+    await counters.update_one({"_id": "bench"}, {"$pull": {"pending": {"id": lease}}})
+    return document
+
+
+class Block:
+    next = end = 0
+
+
+block = Block()
+
+
+async def from_block(collection, student_id, update_data):
+    if block.next == block.end:
+        counter = await collection.database.sync_sequences.find_one_and_update(
+            {"_id": "bench"},
+            {"$inc": {"seq": SYNC_BLOCK_SIZE}, "$set": {"leases.bench": {"floor": block.next, "at": time.time()}}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        block.next, block.end = counter["seq"] - SYNC_BLOCK_SIZE + 1, counter["seq"] + 1
+    seq = block.next
+    block.next += 1
+    return await single_roundtrip(collection, student_id, {**update_data, "updated_seq": seq})
+
+
+async def throughput(collection, ids, update, iterations):
+    async def writer(offset):
+        for i in range(offset, iterations, CONCURRENT_WRITERS):
+            await update(collection, ids[i % len(ids)], {"comments": f"update {i}"})
+
+    started = time.perf_counter()
+    await asyncio.gather(*(writer(offset) for offset in range(CONCURRENT_WRITERS)))
+    return iterations / (time.perf_counter() - started)
+
+
+async def measure(collection, ids, update, iterations):
+    samples = []
+    for i in range(iterations):
+        started = time.perf_counter()
+        await update(collection, ids[i % len(ids)], {"comments": f"update {i}"})
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+async def main(iterations):
+    client = AsyncIOMotorClient(MONGO_URL)
+    collection = client[DB_NAME].students
+    await collection.drop()
+    await collection.create_index("id", unique=True)
+    ids = [str(uuid.uuid4()) for _ in range(STUDENTS)]
+    await collection.insert_many(
+        [{"id": student_id, "first_and_last_name": f"Student {i}", "class_name": "1º DE PRIMARIA"}
+         for i, student_id in enumerate(ids)]
+    )
+
+    # Warm up the connection pool and the server caches
+    await measure(collection, ids, single_roundtrip, 100)
+
+    print(f"{'pattern':<30}{'p50 ms':>10}{'p99 ms':>10}{'mean ms':>10}{'writes/s':>12}")
+    for name, update in (("update_one + find_one", two_roundtrips),
+                         ("find_one_and_update", single_roundtrip),
+                         ("+ seq leased per write", leased_per_write),
+                         ("+ seq from a block", from_block)):
+        samples = await measure(collection, ids, update, iterations)
+        rate = await throughput(collection, ids, update, iterations)
+        print(f"{name:<30}{percentile(samples, 50):>10.3f}{percentile(samples, 99):>10.3f}"
+              f"{statistics.mean(samples):>10.3f}{rate:>12.0f}")
+
+    await client.drop_database(DB_NAME)
+    client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000))
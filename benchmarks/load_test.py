@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+"""
+Load test for the student tracking API
+Seeds a roster of the requested size, drives a concurrent mixed workload
+across the /api routes and reports RPS, p50/p95/p99 latencies and memory.
+Every run is saved as a JSON baseline and compared with the previous run of
+the same configuration.
+
+The app runs in-process (optionally against mongomock instead of a local
+mongod) or under uvicorn workers against MONGO_URL.
+
+Usage:
+  MONGO_URL=mongodb://localhost:27017 python benchmarks/load_test.py --students 50000
+  BENCH_DB_NAME=bench_load_500k python benchmarks/load_test.py --uvicorn --students 500000
+  python benchmarks/load_test.py --mongomock --students 1000 --duration 10
+  python benchmarks/load_test.py --uvicorn --workers 4 --students 500000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from collections import defaultdict
+from datetime import datetime, timezone
+from pathlib import Path
+
+import httpx
+
+BENCH_DIR = Path(__file__).resolve().parent
+BACKEND_DIR = BENCH_DIR.parent / "backend"
+BASELINE_DIR = BENCH_DIR / "baselines"
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+# seed() empties the students collection: never point it at the app's own DB_NAME
+DB_NAME = os.environ.get("BENCH_DB_NAME", "bench_load")
+os.environ["DB_NAME"] = DB_NAME
+# Every simulated user comes from one address; measure the server, not its per-client rate limits
+os.environ.setdefault("RATE_LIMIT_WRITE_PER_SECOND", "0")
+os.environ.setdefault("RATE_LIMIT_BULK_PER_SECOND", "0")
+os.environ.setdefault("RATE_LIMIT_REPORT_PER_SECOND", "0")
+# Uploaded images go to a scratch directory rather than the app's image store
+os.environ.setdefault("IMAGE_STORE_DIR", tempfile.mkdtemp(prefix="bench_images_"))
+sys.path.insert(0, str(BACKEND_DIR))
+
+import server  # noqa: E402
+
+SEED_BATCH_SIZE = 5000
+FIRST_NAMES = ["Lucía", "Hugo", "Martina", "Mateo", "Sofía", "Leo", "Julia", "Daniel", "Álvaro", "Noa"]
+LAST_NAMES = ["García", "Rodríguez", "González", "Fernández", "López", "Martínez", "Sánchez", "Pérez"]
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))] if ordered else 0.0
+
+
+def fake_student(i):
+    return {
+        "first_and_last_name": f"{random.choice(FIRST_NAMES)} {random.choice(LAST_NAMES)} {i}",
+        "class_name": random.choice(server.DEFAULT_CLASSES)["class_name"],
+        "mother_name": f"{random.choice(FIRST_NAMES)} {random.choice(LAST_NAMES)}",
+        "mother_phone": f"6{random.randint(10000000, 99999999)}",
+        "father_name": f"{random.choice(FIRST_NAMES)} {random.choice(LAST_NAMES)}",
+        "father_phone": f"6{random.randint(10000000, 99999999)}",
+        "allergies": "Frutos secos" if i % 9 == 0 else "",
+        "comments": "",
+    }
+
+
+def png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def random_png(size=32):
+    """A small image of one random color, so every upload is a new digest"""
+    row = b"\x00" + bytes(random.randrange(256) for _ in range(3)) * size
+    return b"\x89PNG\r\n\x1a\n" + b"".join([
+        png_chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)),
+        png_chunk(b"IDAT", zlib.compress(row * size)),
+        png_chunk(b"IEND", b""),
+    ])
+
+
+async def seed(db, students):
+    await db.students.delete_many({})
+    ids = []
+    for start in range(0, students, SEED_BATCH_SIZE):
+        batch = [
+            server.student_document(server.Student(**fake_student(i)))
+            for i in range(start, min(students, start + SEED_BATCH_SIZE))
+        ]
+        await db.students.insert_many(batch, ordered=False)
+        ids += [document["id"] for document in batch]
+    return ids
+
+
+class Workload:
+    """Weighted mix of requests across the API routes"""
+
+    def __init__(self, ids, classes, students, event_streams=True):
+        self.ids = ids
+        self.classes = classes
+        self.created = []
+        self.images = []
+        self.sync_token = None
+        # Full roster reads and exports are only worth a few percent of traffic
+        roster_weight = 2 if students <= 50000 else 0
+        # httpx's ASGI transport waits for the whole body, which an event stream never finishes
+        events_weight = 1 if event_streams else 0
+        self.operations = [
+            (20, "GET /students/class/{class_name}", self.students_by_class),
+            (15, "GET /students/{id}", self.student),
+            (10, "GET /students?limit", self.students_page),
+            (roster_weight, "GET /students", self.all_students),
+            (roster_weight, "GET /students/export", self.export),
+            (10, "GET /students/search", self.search),
+            (3, "GET /students/search (no match)", self.search_no_match),
+            (5, "GET /sync", self.sync),
+            (2, "GET /reports/roster?class_name", self.class_report),
+            (roster_weight // 2, "GET /reports/roster", self.school_report),
+            (3, "GET /images/{digest}", self.image),
+            (events_weight, "GET /events", self.events),
+            (15, "GET /classes", self.classes_list),
+            (10, "GET /settings", self.settings),
+            (5, "GET /dashboard", self.dashboard),
+            (1, "GET /stats", self.stats),
+            (5, "PUT /students/{id}", self.update_student),
+            (3, "POST /students", self.create_student),
+            (2, "DELETE /students/{id}", self.delete_student),
+            (2, "POST /students/batch", self.batch),
+            (1, "POST /students/bulk", self.bulk_import),
+            (1, "PUT /classes/{id}", self.update_class),
+            (1, "POST /classes/reset-colors", self.reset_colors),
+            (1, "POST /images", self.upload_image),
+            (1, "PUT /settings", self.update_settings),
+        ]
+        self.operations = [operation for operation in self.operations if operation[0]]
+        self.weights = [weight for weight, _, _ in self.operations]
+
+    def pick(self):
+        _, name, operation = random.choices(self.operations, weights=self.weights)[0]
+        return name, operation
+
+    def students_by_class(self, http):
+        return http.get(f"/api/students/class/{random.choice(self.classes)['class_name']}")
+
+    def student(self, http):
+        return http.get(f"/api/students/{random.choice(self.ids)}")
+
+    def students_page(self, http):
+        return http.get("/api/students", params={"limit": 100, "after": random.choice(self.ids)})
+
+    def all_students(self, http):
+        return http.get("/api/students")
+
+    def export(self, http):
+        return http.get("/api/students/export", params={"format": "csv"})
+
+    def search(self, http):
+        return http.get("/api/students/search", params={"q": random.choice(FIRST_NAMES)[:3]})
+
+    def search_no_match(self, http):
+        # Goes through every search pass without filling the page
+        return http.get("/api/students/search", params={"q": f"zx{random.randint(0, 999)}"})
+
+    async def sync(self, http):
+        params = {"since": self.sync_token} if self.sync_token else {}
+        response = await http.get("/api/sync", params=params)
+        if response.status_code == 200:
+            self.sync_token = response.json()["token"]
+        return response
+
+    def class_report(self, http):
+        return http.get("/api/reports/roster", params={"class_name": random.choice(self.classes)["class_name"]})
+
+    def school_report(self, http):
+        return http.get("/api/reports/roster", params={"format": "csv"})
+
+    async def upload_image(self, http):
+        response = await http.post("/api/images", files={"file": ("bench.png", random_png(), "image/png")})
+        if response.status_code == 200:
+            self.images.append(response.json()["id"])
+        return response
+
+    def image(self, http):
+        if not self.images:
+            return self.upload_image(http)
+        return http.get(f"/api/images/{random.choice(self.images)}")
+
+    async def events(self, http):
+        # Time to the first bytes of the stream: subscribing, not the hours it stays open
+        params = {"class_name": random.choice(self.classes)["class_name"]}
+        async with http.stream("GET", "/api/events", params=params) as response:
+            async for _ in response.aiter_raw():
+                break
+        return response
+
+    def classes_list(self, http):
+        return http.get("/api/classes")
+
+    def settings(self, http):
+        return http.get("/api/settings")
+
+    def dashboard(self, http):
+        return http.get("/api/dashboard")
+
+    def stats(self, http):
+        return http.get("/api/stats")
+
+    def update_student(self, http):
+        return http.put(f"/api/students/{random.choice(self.ids)}", json={"comments": f"bench {time.time()}"})
+
+    async def create_student(self, http):
+        response = await http.post("/api/students", json=fake_student(random.randint(0, 10 ** 9)))
+        if response.status_code == 200:
+            self.created.append(response.json()["id"])
+        return response
+
+    def delete_student(self, http):
+        if not self.created:
+            return self.create_student(http)
+        return http.delete(f"/api/students/{self.created.pop()}")
+
+    def bulk_import(self, http):
+        rows = "".join(json.dumps(fake_student(random.randint(0, 10 ** 9))) + "\n" for _ in range(50))
+        return http.post("/api/students/bulk", content=rows, headers={"content-type": "application/x-ndjson"})
+
+    def batch(self, http):
+        operations = [
+            {"op": "move", "id": student_id, "class_name": random.choice(self.classes)["class_name"]}
+            if n % 2 else {"op": "update", "id": student_id, "update": {"comments": f"bench {time.time()}"}}
+            for n, student_id in enumerate(random.sample(self.ids, min(10, len(self.ids))))
+        ]
+        return http.post("/api/students/batch", json={"operations": operations})
+
+    def reset_colors(self, http):
+        return http.post("/api/classes/reset-colors")
+
+    def update_class(self, http):
+        class_settings = random.choice(self.classes)
+        return http.put(f"/api/classes/{class_settings['id']}", json={
+            "class_name": class_settings["class_name"],
+            "teacher_name": f"Profesor/a {random.randint(1, 99)}",
+            "background_color": class_settings["background_color"],
+        })
+
+    def update_settings(self, http):
+        return http.put("/api/settings", json={"school_name": "CEIP Josefina Carabias"})
+
+
+async def drive(http, workload, concurrency, duration):
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    deadline = time.perf_counter() + duration
+
+    async def user():
+        while time.perf_counter() < deadline:
+            name, operation = workload.pick()
+            started = time.perf_counter()
+            try:
+                response = await operation(http)
+                ok = response.status_code < 400
+            except httpx.HTTPError:
+                ok = False
+            latencies[name].append((time.perf_counter() - started) * 1000)
+            if not ok:
+                errors[name] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - started
+
+
+def summarize(latencies, errors, elapsed):
+    routes = {}
+    for name, samples in sorted(latencies.items()):
+        routes[name] = {
+            "requests": len(samples),
+            "errors": errors.get(name, 0),
+            "rps": round(len(samples) / elapsed, 1),
+            "p50_ms": round(percentile(samples, 50), 2),
+            "p95_ms": round(percentile(samples, 95), 2),
+            "p99_ms": round(percentile(samples, 99), 2),
+            "mean_ms": round(statistics.mean(samples), 2),
+        }
+    all_samples = [sample for samples in latencies.values() for sample in samples]
+    total = {
+        "requests": len(all_samples),
+        "errors": sum(errors.values()),
+        "rps": round(len(all_samples) / elapsed, 1),
+        "p50_ms": round(percentile(all_samples, 50), 2),
+        "p95_ms": round(percentile(all_samples, 95), 2),
+        "p99_ms": round(percentile(all_samples, 99), 2),
+    }
+    return routes, total
+
+
+def process_rss_mb(pid):
+    try:
+        for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_report(result, previous):
+    print(f"\n{result['label']}: {result['students']} students, {result['concurrency']} concurrent clients, "
+          f"{result['elapsed_s']}s, commit {result['commit']}")
+    print(f"{'route':<36}{'reqs':>8}{'err':>6}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for name, route in list(result["routes"].items()) + [("TOTAL", result["total"])]:
+        print(f"{name:<36}{route['requests']:>8}{route['errors']:>6}{route['rps']:>9.1f}"
+              f"{route['p50_ms']:>9.2f}{route['p95_ms']:>9.2f}{route['p99_ms']:>9.2f}")
+    print(f"memory: {json.dumps(result['memory_mb'])}")
+
+    if previous:
+        print(f"\nCompared with {previous['commit']} ({previous['timestamp']}):")
+        for metric in ("rps", "p50_ms", "p95_ms", "p99_ms"):
+            before, after = previous["total"][metric], result["total"][metric]
+            change = (after - before) / before * 100 if before else 0.0
+            print(f"  {metric:<8}{before:>10}{after:>10}  {change:+.1f}%")
+
+
+def save_baseline(result):
+    directory = BASELINE_DIR / result["label"]
+    directory.mkdir(parents=True, exist_ok=True)
+    previous_runs = sorted(directory.glob("*.json"))
+    previous = json.loads(previous_runs[-1].read_text()) if previous_runs else None
+    path = directory / f"{result['timestamp'].replace(':', '')}-{result['commit']}.json"
+    path.write_text(json.dumps(result, indent=2, ensure_ascii=False))
+    return previous, path
+
+
+async def run_in_process(args):
+    if args.mongomock:
+        from mongomock_motor import AsyncMongoMockClient
+        server.create_mongo_client = lambda **options: AsyncMongoMockClient()
+
+    async with server.lifespan(server.app):
+        ids = await seed(server.db, args.students)
+        classes = await server.db.class_settings.find({}, {"_id": 0}).to_list(None)
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as http:
+            latencies, errors, elapsed = await drive(
+                http, Workload(ids, classes, args.students, event_streams=False), args.concurrency, args.duration
+            )
+    memory = {"peak_rss": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+    return latencies, errors, elapsed, memory
+
+
+async def run_under_uvicorn(args):
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    mongo = AsyncIOMotorClient(os.environ["MONGO_URL"])
+    db = mongo[DB_NAME]
+    ids = await seed(db, args.students)
+
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--port", str(args.port),
+         "--workers", str(args.workers), "--log-level", "warning"],
+        cwd=BACKEND_DIR,
+    )
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}", timeout=60,
+                                     limits=httpx.Limits(max_connections=args.concurrency)) as http:
+            for _ in range(100):
+                try:
+                    if (await http.get("/api/classes")).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.2)
+            classes = (await http.get("/api/classes")).json()
+            latencies, errors, elapsed = await drive(
+                http, Workload(ids, classes, args.students), args.concurrency, args.duration
+            )
+        memory = {"server_rss": process_rss_mb(process.pid)}
+    finally:
+        process.terminate()
+        process.wait()
+        mongo.close()
+    return latencies, errors, elapsed, memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--students", type=int, default=1000, help="roster size to seed, e.g. 1000/50000/500000")
+    parser.add_argument("--concurrency", type=int, default=50, help="concurrent clients")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of load")
+    parser.add_argument("--mongomock", action="store_true", help="run in-process against mongomock")
+    parser.add_argument("--uvicorn", action="store_true", help="run the app under uvicorn instead of in-process")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--seed", type=int, default=42, help="random seed for the workload")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    if args.uvicorn:
+        latencies, errors, elapsed, memory = asyncio.run(run_under_uvicorn(args))
+        label = f"uvicorn-{args.workers}w-{args.students}"
+    else:
+        latencies, errors, elapsed, memory = asyncio.run(run_in_process(args))
+        label = f"{'mongomock' if args.mongomock else 'inprocess'}-{args.students}"
+
+    routes, total = summarize(latencies, errors, elapsed)
+    result = {
+        "label": label,
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "students": args.students,
+        "concurrency": args.concurrency,
+        "elapsed_s": round(elapsed, 2),
+        "total": total,
+        "routes": routes,
+        "memory_mb": memory,
+    }
+    previous, path = save_baseline(result)
+    print_report(result, previous)
+    print(f"\nSaved {path.relative_to(BENCH_DIR.parent)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import os
+import sys
+from pathlib import Path
+
+import anyio
+import httpx
+import pytest
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_db")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def api():
+    """An HTTP client for the app, backed by a fresh in-memory mongomock database"""
+    from mongomock_motor import AsyncMongoMockClient
+
+    mongo = AsyncMongoMockClient()
+    server.client = mongo
+    server.db = mongo[os.environ["DB_NAME"]]
+    # Process-wide state from earlier tests would refer to the previous database
+    server.tenants.clear()
+    server.single_flight = server.SingleFlight()
+    server.collection_versions = server.CollectionVersions(server.VERSION_SYNC_INTERVAL)
+    server.sync_sequence = server.SyncSequence(server.SYNC_BLOCK_SIZE, server.SYNC_FLUSH_INTERVAL)
+    server.settings_cache = server.TTLCache(server.SETTINGS_CACHE_TTL, server.settings_cache.collections)
+    server.audit_log = server.AuditLog(server.AUDIT_QUEUE_SIZE, server.AUDIT_BATCH_SIZE, server.AUDIT_FLUSH_INTERVAL)
+    server.rate_limiter = server.TokenBucketLimiter(server.RATE_LIMITS)
+    server.admission = server.AdmissionControl(
+        server.ADMISSION_MAX_CONCURRENCY, server.ADMISSION_MAX_QUEUE, server.ADMISSION_QUEUE_TIMEOUT
+    )
+    await server.prepare_database()
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://test") as http:
+        yield http
+
+
+@pytest.fixture
+def asgi_call():
+    """Run one GET through an ASGI app; returns (message type, probe()) for every message it sends"""
+
+    async def call(app, path, probe, query_string=b""):
+        messages = []
+        requested = []
+        scope = {
+            "type": "http",
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "root_path": "",
+            "query_string": query_string,
+            "headers": [],
+            "client": ("127.0.0.1", 50000),
+            "server": ("test", 80),
+        }
+
+        async def receive():
+            if requested:
+                # The client stays connected
+                await anyio.sleep_forever()
+            requested.append(True)
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            messages.append((message["type"], probe()))
+
+        await app(scope, receive, send)
+        return messages
+
+    return call
@@ -0,0 +1,32 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_client_headers_do_not_open_new_buckets(api, monkeypatch):
+    server.rate_limiter = server.TokenBucketLimiter({**server.RATE_LIMITS, "write": (0.01, 2)})
+    monkeypatch.setattr(server, "SERVED_TENANTS", server.SERVED_TENANTS | {"otro"})
+    student = {"first_and_last_name": "Ana", "class_name": "1A"}
+
+    statuses = [(await api.post("/api/students", json=student, headers={"X-User": "ana"})).status_code for _ in range(3)]
+    assert statuses == [200, 200, 429]
+    assert (await api.post("/api/students", json=student, headers={"X-User": "leo"})).status_code == 429
+    assert (await api.post("/api/students", json=student, headers={"X-Tenant-ID": "otro"})).status_code == 429
+
+
+async def test_reports_do_not_spend_the_bulk_budget(api):
+    assert server.route_class("GET", "/api/reports/roster") == "report"
+    student = (await api.post("/api/students", json={"first_and_last_name": "Ana", "class_name": "1A"})).json()
+
+    batch = {"operations": [{"op": "move", "id": student["id"], "class_name": "2A"}]}
+    assert (await api.post("/api/students/batch", json=batch)).status_code == 200
+    assert (await api.post("/api/classes/reset-colors")).status_code == 200
+    # httpx sends every test request from 127.0.0.1
+    report_request = server.Request({"type": "http", "headers": [], "client": ("127.0.0.1", 123)})
+    for _ in range(3):
+        assert not await server.rate_limiter.take(server.rate_limit_key(report_request, "report"), "report")
+    body = b'{"first_and_last_name": "Leo", "class_name": "1A"}\n'
+    response = await api.post("/api/students/bulk", content=body, headers={"content-type": "application/x-ndjson"})
+    assert response.status_code == 200
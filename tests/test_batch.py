@@ -0,0 +1,107 @@
+import pytest
+from pymongo.errors import BulkWriteError
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def create(api, name, class_name="1A"):
+    return (await api.post("/api/students", json={"first_and_last_name": name, "class_name": class_name})).json()["id"]
+
+
+def drain(queue):
+    return [queue.get_nowait() for _ in range(queue.qsize())]
+
+
+async def test_operations_on_one_student_are_merged_into_one_write(api):
+    student_id = await create(api, "Ana")
+    batch = {"operations": [
+        {"op": "update", "id": student_id, "update": {"first_and_last_name": "Ana Pérez"}},
+        {"op": "move", "id": student_id, "class_name": "2A"},
+        {"op": "update", "id": student_id, "update": {"allergies": "Gluten"}},
+    ]}
+    response = await api.post("/api/students/batch", json=batch)
+    assert [result["status"] for result in response.json()] == ["ok", "ok", "ok"]
+
+    stored = await server.db.students.find_one({"id": student_id})
+    assert (stored["first_and_last_name"], stored["class_name"], stored["allergies"]) == ("Ana Pérez", "2A", "Gluten")
+    assert stored["first_and_last_name_lower"] == "ana pérez"
+    assert sorted(stored["search_tokens"]) == ["ana", "perez"]
+    changes = (await api.get("/api/sync")).json()["students"]
+    assert [student["updated_seq"] for student in changes] == [stored["updated_seq"]]
+
+
+async def test_missing_students_and_empty_operations_are_reported(api):
+    student_id = await create(api, "Ana")
+    batch = {"operations": [
+        {"op": "delete", "id": "missing"},
+        {"op": "update", "id": student_id, "update": {}},
+        {"op": "move", "id": student_id},
+        {"op": "update", "id": student_id, "update": {"comments": "Autobús"}},
+    ]}
+    results = (await api.post("/api/students/batch", json=batch)).json()
+    assert [(result["status"], result["error"]) for result in results] == [
+        ("not_found", None),
+        ("invalid", "No update data provided"),
+        ("invalid", "No update data provided"),
+        ("ok", None),
+    ]
+    assert (await server.db.students.find_one({"id": student_id}))["comments"] == "Autobús"
+
+
+async def test_deletions_that_went_through_get_tombstones_after_a_partial_failure(api, monkeypatch):
+    deleted, failing, also_deleted = [await create(api, name) for name in ("Ana", "Leo", "Noa")]
+    collection = type(server.db.students)
+    bulk_write = collection.bulk_write
+
+    async def bulk_write_failing_the_second(self, requests, **kwargs):
+        await bulk_write(self, [request for index, request in enumerate(requests) if index != 1], **kwargs)
+        raise BulkWriteError({"writeErrors": [{"index": 1, "errmsg": "Document failed validation"}]})
+
+    monkeypatch.setattr(collection, "bulk_write", bulk_write_failing_the_second)
+    subscriber = server.change_hub.subscribe("default", "1A")
+    drain(server.audit_log.queue)
+    batch = {"operations": [
+        {"op": "delete", "id": deleted},
+        {"op": "move", "id": failing, "class_name": "2A"},
+        {"op": "delete", "id": also_deleted},
+    ]}
+    try:
+        results = (await api.post("/api/students/batch", json=batch)).json()
+        events = drain(subscriber.queue)
+    finally:
+        server.change_hub.unsubscribe(subscriber)
+
+    assert [(result["status"], result["error"]) for result in results] == [
+        ("ok", None), ("error", "Document failed validation"), ("ok", None),
+    ]
+    tombstones = await server.db.tombstones.find().to_list(None)
+    assert sorted(tombstone["id"] for tombstone in tombstones) == sorted([deleted, also_deleted])
+    assert (await server.db.students.find_one({"id": failing}))["class_name"] == "1A"
+    # Which writes made it is not known per student, so clients reload
+    assert [event["op"] for event in events] == ["resync"]
+    audited = drain(server.audit_log.queue)
+    assert sorted((entry["action"], entry["document_id"]) for entry in audited) == sorted(
+        [("delete", deleted), ("delete", also_deleted)]
+    )
+
+
+async def test_batch_is_audited_and_published_per_student(api):
+    moved, deleted = await create(api, "Ana"), await create(api, "Leo")
+    subscriber = server.change_hub.subscribe("default", "1A")
+    drain(server.audit_log.queue)
+    batch = {"operations": [{"op": "move", "id": moved, "class_name": "2A"}, {"op": "delete", "id": deleted}]}
+    try:
+        await api.post("/api/students/batch", json=batch, headers={"X-User": "eva"})
+        events = drain(subscriber.queue)
+    finally:
+        server.change_hub.unsubscribe(subscriber)
+
+    assert [(event["op"], event["id"]) for event in events] == [("upsert", moved), ("delete", deleted)]
+    assert (events[0]["class_name"], events[0]["previous_class_name"]) == ("2A", "1A")
+    audited = drain(server.audit_log.queue)
+    assert [(entry["action"], entry["document_id"], entry["actor"]["user"]) for entry in audited] == [
+        ("update", moved, "eva"), ("delete", deleted, "eva"),
+    ]
+    assert (audited[0]["before"], audited[0]["after"]) == ({"class_name": "1A"}, {"class_name": "2A"})
@@ -0,0 +1,94 @@
+import codecs
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+class UploadedBody:
+    """Stands in for a Request: the body arrives in the given chunks"""
+
+    def __init__(self, chunks, content_type="text/csv"):
+        self.chunks = chunks
+        self.headers = {"content-type": content_type}
+
+    async def stream(self):
+        for chunk in self.chunks:
+            yield chunk
+
+
+async def parse(parser, chunks, content_type="text/csv"):
+    return [row async for row in parser(server.iter_request_lines(UploadedBody(chunks, content_type)))]
+
+
+async def test_csv_quoted_field_spans_lines_and_chunks():
+    body = 'first_and_last_name,class_name,comments\r\nAna,1º,"line one\r\nline ""two"""\r\nLeo,2º,\r\n'.encode()
+    chunks = [body[i:i + 7] for i in range(0, len(body), 7)]
+    rows = await parse(server.iter_csv_rows, chunks)
+    assert rows == [
+        {"first_and_last_name": "Ana", "class_name": "1º", "comments": 'line one\nline "two"'},
+        {"first_and_last_name": "Leo", "class_name": "2º", "comments": ""},
+    ]
+
+
+async def test_csv_byte_order_mark_is_not_part_of_the_header():
+    rows = await parse(server.iter_csv_rows, [codecs.BOM_UTF8 + "first_and_last_name,class_name\nAna,1º\n".encode()])
+    assert rows == [{"first_and_last_name": "Ana", "class_name": "1º"}]
+
+
+async def test_csv_saved_by_spanish_excel_is_read_as_windows_1252():
+    body = "first_and_last_name,class_name\nNoa,1A\nÁlvaro Núñez,1º DE PRIMARIA\n".encode("cp1252")
+    rows = await parse(server.iter_csv_rows, [body])
+    assert rows[1] == {"first_and_last_name": "Álvaro Núñez", "class_name": "1º DE PRIMARIA"}
+
+
+async def test_declared_charset_is_honoured():
+    body = "first_and_last_name,class_name\nÑandú,1º\n".encode("latin-1")
+    rows = await parse(server.iter_csv_rows, [body], "text/csv; charset=ISO-8859-1")
+    assert rows == [{"first_and_last_name": "Ñandú", "class_name": "1º"}]
+
+
+async def test_undecodable_line_of_a_utf8_file_is_a_row_error():
+    body = "first_and_last_name,class_name\nÁlvaro,1º\n".encode() + b"Le\xf3n,2\n" + b"Noa,3\n"
+    rows = await parse(server.iter_csv_rows, [body])
+    assert rows[0] == {"first_and_last_name": "Álvaro", "class_name": "1º"}
+    assert isinstance(rows[1], UnicodeDecodeError)
+    assert rows[2] == {"first_and_last_name": "Noa", "class_name": "3"}
+
+
+async def test_ndjson_bad_lines_are_errors():
+    rows = await parse(server.iter_ndjson_rows, [b'{"a": 1}\n{"a": \n\n[1]\n'], "application/x-ndjson")
+    assert rows[0] == {"a": 1}
+    assert isinstance(rows[1], ValueError)
+    assert rows[2] == [1]
+
+
+async def test_import_reports_bad_rows_and_inserts_the_rest(api):
+    body = (
+        b'{"first_and_last_name": "Ana", "class_name": "1A"}\n'
+        b'{"first_and_last_name": \n'
+        b'{"first_and_last_name": "Le\xf3n", "class_name": "1A"}\n'
+        b'[1]\n'
+    )
+    response = await api.post("/api/students/bulk", content=body, headers={"content-type": "application/x-ndjson; charset=utf-8"})
+    assert response.status_code == 200
+    report = response.json()
+    assert report["inserted"] == 1
+    assert [error["row"] for error in report["errors"]] == [2, 3, 4]
+    assert "codec can't decode" in report["errors"][1]["error"]
+
+
+async def test_import_of_a_windows_1252_csv(api):
+    body = "first_and_last_name,class_name,allergies\nÁlvaro Núñez,1º DE PRIMARIA,Frutos secos\n".encode("cp1252")
+    response = await api.post("/api/students/bulk", content=body, headers={"content-type": "text/csv"})
+    assert response.json() == {"inserted": 1, "failed": 0, "errors": []}
+    students = (await api.get("/api/students", params={"limit": 10})).json()
+    assert students[0]["first_and_last_name"] == "Álvaro Núñez"
+
+
+async def test_import_with_unknown_or_unsupported_charset(api):
+    for charset, status in (("klingon", 400), ("utf-16", 415)):
+        response = await api.post("/api/students/bulk", content=b"", headers={"content-type": f"text/csv; charset={charset}"})
+        assert response.status_code == status
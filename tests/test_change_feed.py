@@ -0,0 +1,47 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+def change(collection, operation, **fields):
+    return {"ns": {"db": "test_db", "coll": collection}, "operationType": operation, **fields}
+
+
+def test_deleted_students_are_published_from_their_tombstone():
+    tombstone = {"tenant_id": "cp-norte", "collection": "students", "id": "s1", "class_name": "2A", "updated_seq": 7}
+    assert server.change_stream_event(change("tombstones", "insert", fullDocument=tombstone)) == {
+        "collection": "students", "op": "delete", "tenant_id": "cp-norte", "id": "s1", "class_name": "2A",
+    }
+    assert server.change_stream_event(change("students", "delete", documentKey={"_id": "x"})) is None
+
+
+def test_delete_of_unknown_tenant_is_not_sent_to_every_school():
+    assert server.change_stream_event(change("class_settings", "delete", documentKey={"_id": "x"})) is None
+
+
+def test_moved_student_goes_to_its_old_and_new_class_only():
+    event = server.change_stream_event(change(
+        "students", "update",
+        fullDocument={"tenant_id": "default", "id": "s1", "class_name": "2A", "first_and_last_name": "Ana"},
+        fullDocumentBeforeChange={"tenant_id": "default", "id": "s1", "class_name": "1A"},
+        updateDescription={"updatedFields": {"class_name": "2A"}},
+    ))
+    wanted_by = [name for name in ("1A", "2A", "3A") if server.ChangeSubscriber("default", name).wants(event)]
+    assert wanted_by == ["1A", "2A"]
+    assert not server.ChangeSubscriber("otro", "1A").wants(event)
+
+
+async def test_route_publishes_the_old_class_of_a_moved_student(api):
+    student = (await api.post("/api/students", json={"first_and_last_name": "Ana", "class_name": "1A"})).json()
+    old_class = server.change_hub.subscribe("default", "1A")
+    other_class = server.change_hub.subscribe("default", "3A")
+    try:
+        await api.put(f"/api/students/{student['id']}", json={"class_name": "2A"})
+        event = old_class.queue.get_nowait()
+        assert (event["class_name"], event["previous_class_name"]) == ("2A", "1A")
+        assert other_class.queue.empty()
+    finally:
+        server.change_hub.unsubscribe(old_class)
+        server.change_hub.unsubscribe(other_class)
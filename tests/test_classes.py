@@ -0,0 +1,17 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_renaming_a_class_to_an_existing_name_is_a_conflict(api):
+    first, second = (await api.get("/api/classes")).json()[:2]
+    response = await api.put(f"/api/classes/{second['id']}", json={**second, "class_name": first["class_name"]})
+    assert response.status_code == 409
+    assert [c["class_name"] for c in (await api.get("/api/classes")).json()][:2] == [first["class_name"], second["class_name"]]
+
+
+async def test_renaming_a_class(api):
+    first = (await api.get("/api/classes")).json()[0]
+    response = await api.put(f"/api/classes/{first['id']}", json={**first, "class_name": "AULA NUEVA"})
+    assert response.status_code == 200
+    assert response.json()["class_name"] == "AULA NUEVA"
@@ -0,0 +1,71 @@
+import base64
+import io
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+def png(width=1200, height=600):
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), "#3B82F6").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def image_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "IMAGE_STORE_DIR", tmp_path)
+    server.image_metadata.clear()
+    return tmp_path
+
+
+async def test_upload_stores_the_image_and_its_variants(api, image_store):
+    data = png()
+    response = await api.post("/api/images", files={"file": ("logo.png", data, "image/png")})
+    assert response.status_code == 200
+    stored = response.json()
+    assert stored["content_type"] == "image/png"
+    assert stored["variants"] == ["original", "w480", "w1024"]
+
+    original = await api.get(stored["url"])
+    assert original.content == data
+    resized = await api.get(stored["url"], params={"variant": "w480"})
+    assert resized.headers["content-type"] == "image/png"
+
+    await server.audit_log.stop()
+    entry = await server.db.audit_log.find_one({"document_id": stored["id"]})
+    assert entry["action"] == "upload"
+
+
+async def test_images_are_served_with_nosniff(api, image_store):
+    stored = (await api.post("/api/images", files={"file": ("logo.png", png(), "image/png")})).json()
+    response = await api.get(stored["url"])
+    assert response.headers["x-content-type-options"] == "nosniff"
+
+
+async def test_type_comes_from_the_decoded_format_not_the_client(api, image_store):
+    stored = (await api.post("/api/images", files={"file": ("logo.svg", png(40, 40), "image/svg+xml")})).json()
+    assert stored["content_type"] == "image/png"
+
+
+async def test_svg_is_rejected(api, image_store):
+    svg = b'<svg xmlns="http://www.w3.org/2000/svg"><script>alert(document.cookie)</script></svg>'
+    response = await api.post("/api/images", files={"file": ("logo.svg", svg, "image/svg+xml")})
+    assert response.status_code == 415
+    assert not list(image_store.rglob("*"))
+
+    data_url = "data:image/svg+xml;base64," + base64.b64encode(svg).decode()
+    response = await api.put("/api/settings", json={"home_image_url": data_url})
+    assert response.status_code == 415
+
+
+async def test_decompression_bomb_is_rejected(api, image_store, monkeypatch):
+    from PIL import Image
+
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+    response = await api.post("/api/images", files={"file": ("bomb.png", png(100, 100), "image/png")})
+    assert response.status_code == 413
@@ -0,0 +1,34 @@
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+# Cumulative `python -X importtime` budget for `import server`, in milliseconds
+IMPORT_BUDGET_MS = float(os.environ.get("IMPORT_BUDGET_MS", "1500"))
+# Installed for other tooling but must never load in a worker
+FORBIDDEN_IMPORTS = ["pandas", "numpy", "boto3", "jq", "PIL", "matplotlib"]
+
+
+def run_python(*args):
+    env = {**os.environ, "MONGO_URL": "mongodb://localhost:27017", "DB_NAME": "import_check"}
+    result = subprocess.run(
+        [sys.executable, *args], cwd=BACKEND_DIR, env=env, capture_output=True, text=True, timeout=60
+    )
+    assert result.returncode == 0, result.stderr[-500:]
+    return result
+
+
+def test_import_stays_within_the_cold_start_budget():
+    timings = []
+    for _ in range(3):
+        # The last line is the server module itself: "import time: self | cumulative | server"
+        last_line = run_python("-X", "importtime", "-c", "import server").stderr.strip().splitlines()[-1]
+        timings.append(int(last_line.split("|")[1]) / 1000)
+    assert statistics.median(timings) <= IMPORT_BUDGET_MS
+
+
+def test_heavy_modules_are_not_imported_at_startup():
+    check = f"import sys, server; print(','.join(m for m in {FORBIDDEN_IMPORTS!r} if m in sys.modules))"
+    assert run_python("-c", check).stdout.strip() == ""
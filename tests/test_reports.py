@@ -0,0 +1,94 @@
+import re
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import reports
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def report_pool(monkeypatch):
+    """Render in threads: the spawned process pool is slow to start for a handful of classes"""
+    pool = ThreadPoolExecutor(2)
+    monkeypatch.setattr(server, "get_report_pool", lambda: pool)
+    monkeypatch.setattr(server, "report_cache", server.ReportCache(server.REPORT_CACHE_MAX_BYTES))
+    yield pool
+    pool.shutdown()
+
+
+def test_csv_has_a_bom_header_and_one_row_per_student():
+    header = reports.csv_header()
+    assert header.startswith(b"\xef\xbb\xbf")
+    assert header.decode("utf-8-sig").splitlines() == [
+        "Clase,Profesor/a,Nombre y Apellidos,Alergias,Nombre de la Madre,Teléfono de la Madre,"
+        "Nombre del Padre,Teléfono del Padre"
+    ]
+    section = reports.render_csv_section(
+        {"class_name": "1A", "teacher_name": "Eva"},
+        [{"first_and_last_name": "Ana, Pérez", "allergies": None}, {"first_and_last_name": "Leo"}],
+    )
+    assert section.decode().splitlines() == ['1A,Eva,"Ana, Pérez",,,,,', "1A,Eva,Leo,,,,,"]
+
+
+def test_pdf_pages_are_split_and_the_cross_references_point_at_their_objects():
+    students = [{"first_and_last_name": f"Alumno {n}", "allergies": "Frutos secos"} for n in range(120)]
+    pages = reports.render_pdf_pages("CEIP", {"class_name": "1A", "background_color": "#ffffff"}, students)
+    assert len(pages) > 1
+    assert b"(Alumno 119) Tj" in zlib.decompress(pages[-1])
+
+    document = reports.PdfDocument()
+    data = document.start() + b"".join(map(document.add_page, pages)) + document.finish()
+    assert data.startswith(b"%PDF-1.4") and data.endswith(b"%%EOF\n")
+    assert b"/Count %d" % len(pages) in data
+    xref = int(re.search(rb"startxref\n(\d+)", data).group(1))
+    offsets = re.findall(rb"(\d{10}) 00000 n ", data[xref:])
+    for object_id, offset in enumerate(offsets, 1):
+        assert data[int(offset):].startswith(b"%d 0 obj" % object_id)
+
+
+def test_empty_class_still_gets_a_page():
+    [page] = reports.render_pdf_pages("CEIP", {"class_name": "1A"}, [])
+    assert b"(Sin alumnos) Tj" in zlib.decompress(page)
+
+
+async def test_school_csv_lists_every_class_in_order_and_is_cached(api, report_pool):
+    classes = [class_settings["class_name"] for class_settings in (await api.get("/api/classes")).json()]
+    for class_name in reversed(classes[:2]):
+        await api.post("/api/students", json={"first_and_last_name": f"Alumno {class_name}", "class_name": class_name})
+
+    response = await api.get("/api/reports/roster", params={"format": "csv"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "text/csv; charset=utf-8"
+    rows = response.content.decode("utf-8-sig").splitlines()[1:]
+    assert [row.split(",")[0] for row in rows] == classes[:2]
+    assert server.report_cache.stats()["entries"] == 1
+
+    again = await api.get("/api/reports/roster", params={"format": "csv"})
+    assert again.content == response.content
+    assert server.report_cache.hits == 1
+    assert (await api.get("/api/reports/roster", params={"format": "csv"}, headers={
+        "If-None-Match": response.headers["etag"],
+    })).status_code == 304
+
+
+async def test_streamed_report_larger_than_the_cache_is_not_buffered(api, report_pool, monkeypatch):
+    server.report_cache.max_bytes = 100
+    kept = []
+    monkeypatch.setattr(server.report_cache, "put", lambda key, body: kept.append(body))
+    response = await api.get("/api/reports/roster", params={"format": "pdf"})
+    assert response.content.startswith(b"%PDF") and len(response.content) > 100
+    assert kept == []
+
+
+async def test_class_report_is_a_single_pdf_and_unknown_classes_are_404(api, report_pool):
+    await api.post("/api/students", json={"first_and_last_name": "Ana", "class_name": "1A"})
+    response = await api.get("/api/reports/roster", params={"class_name": "1A"})
+    assert response.headers["content-type"] == "application/pdf"
+    assert response.headers["content-disposition"] == 'attachment; filename="listado_1a.pdf"'
+    assert response.content.count(b"/Type /Page ") == 1
+
+    assert (await api.get("/api/reports/roster", params={"class_name": "9Z"})).status_code == 404
@@ -0,0 +1,61 @@
+import random
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_exact_name_ranks_first_among_many_prefix_matches(api):
+    names = [f"Anabel {surname} {n}" for n, surname in enumerate(["García", "López", "Ruiz"] * 50)] + ["Ana"]
+    random.Random(7).shuffle(names)
+    await server.db.students.insert_many([
+        server.student_document(server.Student(first_and_last_name=name, class_name="1A")) | {"tenant_id": "default"}
+        for name in names
+    ])
+
+    response = await api.get("/api/students/search", params={"q": "ana", "limit": 5})
+    found = [student["first_and_last_name"] for student in response.json()]
+    assert found == ["Ana"] + sorted(names, key=server.normalize_search_text)[1:5]
+
+
+async def test_token_matches_fill_the_rest_without_substring_matches(api):
+    for name in ("Lucía Ana Pérez", "Mariana Soto", "Ana María"):
+        await server.db.students.insert_one(
+            server.student_document(server.Student(first_and_last_name=name, class_name="1A")) | {"tenant_id": "default"}
+        )
+
+    response = await api.get("/api/students/search", params={"q": "ana"})
+    assert [student["first_and_last_name"] for student in response.json()] == ["Ana María", "Lucía Ana Pérez"]
+
+
+async def test_partial_update_refreshes_search_fields_in_one_write(api, monkeypatch):
+    created = await api.post("/api/students", json={
+        "first_and_last_name": "Ana Pérez", "class_name": "1A", "mother_name": "Rosa", "mother_phone": "600 111 222",
+    })
+    student_id = created.json()["id"]
+    update_calls = []
+    collection = type(server.db.students)
+
+    def counting(name):
+        method = getattr(collection, name)
+
+        def call(self, *args, **kwargs):
+            if self.name == "students":
+                update_calls.append(name)
+            return method(self, *args, **kwargs)
+        return call
+
+    for name in ("find_one_and_update", "update_one", "update_many", "bulk_write"):
+        monkeypatch.setattr(collection, name, counting(name))
+    response = await api.put(f"/api/students/{student_id}", json={"first_and_last_name": "Lucía Gómez"})
+    assert response.status_code == 200
+    assert update_calls == ["find_one_and_update"]
+
+    stored = await server.db.students.find_one({"id": student_id})
+    assert stored["search_name"] == "lucia gomez"
+    assert sorted(stored["search_tokens"]) == ["600111222", "gomez", "lucia", "rosa"]
+    found = await api.get("/api/students/search", params={"q": "gomez"})
+    assert [student["id"] for student in found.json()] == [student_id]
+    assert (await api.get("/api/students/search", params={"q": "perez"})).json() == []
@@ -0,0 +1,28 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_class_list_follows_writes_of_other_workers(api):
+    classes = (await api.get("/api/classes")).json()
+    etag = (await api.get("/api/classes")).headers["etag"]
+
+    # Another worker renames a teacher: it writes the class and bumps the shared version
+    await server.db.class_settings.update_one({"id": classes[0]["id"]}, {"$set": {"teacher_name": "Otra"}})
+    await server.db.collection_versions.update_one(
+        {"_id": "default:class_settings"}, {"$inc": {"version": 1}}, upsert=True
+    )
+    server.collection_versions._synced_at = 0
+
+    response = await api.get("/api/classes", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()[0]["teacher_name"] == "Otra"
+
+
+async def test_settings_are_served_from_memory_while_unchanged(api):
+    await api.get("/api/settings")
+    hits = server.settings_cache.hits
+    await api.get("/api/settings")
+    assert server.settings_cache.hits == hits + 1
@@ -0,0 +1,101 @@
+import asyncio
+
+import orjson
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def create_student(api, name, class_name="1A"):
+    return (await api.post("/api/students", json={"first_and_last_name": name, "class_name": class_name})).json()["id"]
+
+
+async def test_class_read_does_not_join_a_load_of_an_older_version(api):
+    await api.post("/api/students", json={"first_and_last_name": "Ana", "class_name": "1A"})
+    version, = await server.collection_versions.current("students")
+    # A load of the class still in flight, untagged so only its key tells it apart
+    stale = asyncio.get_running_loop().create_future()
+    stale.set_result(b"[]")
+    server.single_flight._flights[("students/class", "default", "1A", None, version)] = (stale, ())
+    assert (await api.get("/api/students/class/1A")).json() == []
+
+    # Another worker writes a student and bumps the shared version
+    await server.db.collection_versions.update_one({"_id": "default:students"}, {"$inc": {"version": 1}})
+    server.collection_versions._synced_at = 0
+    assert [student["first_and_last_name"] for student in (await api.get("/api/students/class/1A")).json()] == ["Ana"]
+
+
+async def test_unchanged_list_is_answered_304_until_a_write(api):
+    await api.post("/api/students", json={"first_and_last_name": "Ana", "class_name": "1A"})
+    first = await api.get("/api/students", params={"limit": 10})
+    etag = first.headers["etag"]
+
+    cached = await api.get("/api/students", params={"limit": 10}, headers={"If-None-Match": f'"other", W/{etag}'})
+    assert cached.status_code == 304
+    assert cached.content == b""
+    assert cached.headers["etag"] == etag
+    # Another URL is another representation
+    assert (await api.get("/api/students", params={"limit": 5}, headers={"If-None-Match": etag})).status_code == 200
+
+    await api.post("/api/students", json={"first_and_last_name": "Leo", "class_name": "1A"})
+    changed = await api.get("/api/students", params={"limit": 10}, headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["etag"] != etag
+    assert sorted(student["first_and_last_name"] for student in changed.json()) == ["Ana", "Leo"]
+
+
+async def test_class_settings_etag_changes_after_an_update(api):
+    classes = await api.get("/api/classes")
+    etag = classes.headers["etag"]
+    assert (await api.get("/api/classes", headers={"If-None-Match": etag})).status_code == 304
+
+    first_class = classes.json()[0]
+    update = {"class_name": first_class["class_name"], "teacher_name": "Eva", "background_color": "#000000"}
+    assert (await api.put(f"/api/classes/{first_class['id']}", json=update)).status_code == 200
+    response = await api.get("/api/classes", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert response.json()[0]["teacher_name"] == "Eva"
+
+
+async def test_keyset_pages_cover_every_student_once(api):
+    ids = sorted([await create_student(api, f"Alumno {n}") for n in range(5)])
+    pages = []
+    params = {"limit": 2}
+    while True:
+        response = await api.get("/api/students", params=params)
+        pages.append([student["id"] for student in response.json()])
+        if "x-next-cursor" not in response.headers:
+            break
+        assert response.headers["x-next-cursor"] == pages[-1][-1]
+        params["after"] = response.headers["x-next-cursor"]
+    assert pages == [ids[0:2], ids[2:4], ids[4:]]
+
+
+async def test_page_ending_on_the_last_student_is_followed_by_an_empty_one(api):
+    ids = sorted([await create_student(api, f"Alumno {n}") for n in range(4)])
+    response = await api.get("/api/students", params={"limit": 2, "after": ids[1]})
+    assert [student["id"] for student in response.json()] == ids[2:]
+    assert response.headers["x-next-cursor"] == ids[3]
+
+    last = await api.get("/api/students", params={"limit": 2, "after": ids[3]})
+    assert last.json() == []
+    assert "x-next-cursor" not in last.headers
+
+
+async def test_roster_streams_as_ndjson_across_cursor_batches(api, monkeypatch):
+    monkeypatch.setattr(server, "STUDENT_BATCH_SIZE", 2)
+    ids = sorted([await create_student(api, f"Alumno {n}") for n in range(5)])
+
+    response = await api.get("/api/students", headers={"Accept": "application/x-ndjson"}, params={"fields": "summary"})
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [orjson.loads(line) for line in response.content.splitlines()]
+    assert [student["id"] for student in lines] == ids
+    assert all(set(student) == {"id", "first_and_last_name"} for student in lines)
+
+    resumed = await api.get("/api/students", params={"stream": "true", "after": ids[2]})
+    assert [orjson.loads(line)["id"] for line in resumed.content.splitlines()] == ids[3:]
+    whole = await api.get("/api/students")
+    assert [student["id"] for student in whole.json()] == ids
@@ -0,0 +1,125 @@
+import time
+
+import anyio
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def sync_all(api, since=None, limit=3):
+    """Follow has_more to the end; returns the pages and the final token"""
+    pages = []
+    while True:
+        params = {"limit": limit, **({"since": since} if since else {})}
+        response = await api.get("/api/sync", params=params)
+        assert response.status_code == 200
+        page = response.json()
+        pages.append(page)
+        since = page["token"]
+        if not page["has_more"]:
+            return pages, since
+
+
+def changes(page):
+    """(updated_seq, kind, id) of every change in a page, in sequence order"""
+    return sorted(
+        (item["updated_seq"], kind, item["id"]) for kind in ("students", "classes", "deleted") for item in page[kind]
+    )
+
+
+async def test_pages_cover_students_classes_and_deletions_once(api):
+    _, token = await sync_all(api)
+    ana = (await api.post("/api/students", json={"first_and_last_name": "Ana", "class_name": "1A"})).json()
+    leo = (await api.post("/api/students", json={"first_and_last_name": "Leo", "class_name": "1A"})).json()
+    await api.put(f"/api/students/{ana['id']}", json={"comments": "Gafas"})
+    classes = (await api.get("/api/classes")).json()
+    renamed = {**classes[0], "teacher_name": "Marta"}
+    await api.put(f"/api/classes/{renamed['id']}", json={
+        field: renamed[field] for field in ("class_name", "teacher_name", "background_color")
+    })
+    await api.delete(f"/api/students/{leo['id']}")
+    noa = (await api.post("/api/students", json={"first_and_last_name": "Noa", "class_name": "2A"})).json()
+
+    pages, _ = await sync_all(api, token, limit=2)
+    assert all(len(changes(page)) <= 2 for page in pages)
+    found = [change for page in pages for change in changes(page)]
+    # Pages follow each other in sequence order, each change once, with its latest version
+    assert [seq for seq, _, _ in found] == sorted({seq for seq, _, _ in found})
+    assert [(kind, item_id) for _, kind, item_id in found] == [
+        ("students", ana["id"]), ("classes", renamed["id"]), ("deleted", leo["id"]), ("students", noa["id"]),
+    ]
+    assert [student["comments"] for page in pages for student in page["students"]] == ["Gafas", ""]
+
+
+async def test_token_at_the_watermark_returns_only_later_writes(api):
+    _, token = await sync_all(api, limit=100)
+    page = (await api.get("/api/sync", params={"since": token})).json()
+    assert (page["students"], page["classes"], page["deleted"], page["has_more"]) == ([], [], [], False)
+    assert page["token"].split(".")[0] == token.split(".")[0]
+
+    ana = (await api.post("/api/students", json={"first_and_last_name": "Ana", "class_name": "1A"})).json()
+    page = (await api.get("/api/sync", params={"since": token})).json()
+    assert [student["id"] for student in page["students"]] == [ana["id"]]
+
+
+async def test_unfinished_write_holds_back_the_watermark(api):
+    async with server.sync_sequence.allocate() as seq:
+        assert await server.sync_sequence.watermark() == seq - 1
+    assert await server.sync_sequence.watermark() >= seq
+
+
+async def test_lease_of_another_worker_holds_back_the_watermark_until_it_expires(api):
+    await api.post("/api/students", json={"first_and_last_name": "Ana", "class_name": "1A"})
+    floor = await server.sync_sequence.watermark()
+    await server.db.sync_sequences.update_one(
+        {"_id": "default"}, {"$set": {"leases.other": {"floor": floor, "at": time.time()}}}
+    )
+    leo = (await api.post("/api/students", json={"first_and_last_name": "Leo", "class_name": "1A"})).json()
+    assert await server.sync_sequence.watermark() == floor - 1
+    page = (await api.get("/api/sync")).json()
+    assert leo["id"] not in [student["id"] for student in page["students"]]
+
+    await server.db.sync_sequences.update_one(
+        {"_id": "default"}, {"$set": {"leases.other.at": time.time() - server.SYNC_LEASE_SECONDS - 1}}
+    )
+    page = (await api.get("/api/sync")).json()
+    assert leo["id"] in [student["id"] for student in page["students"]]
+    counter = await server.db.sync_sequences.find_one({"_id": "default"})
+    assert "other" not in counter["leases"]
+
+
+async def test_numbers_come_from_local_blocks(api):
+    refills = server.sync_sequence.refills
+    for n in range(20):
+        await api.post("/api/students", json={"first_and_last_name": f"Alumno {n}", "class_name": "1A"})
+    assert server.sync_sequence.refills - refills <= 1
+
+    # Once idle, the worker gives back its unused numbers and its lease
+    await server.sync_sequence.flush()
+    counter = await server.db.sync_sequences.find_one({"_id": "default"})
+    assert server.sync_sequence.worker not in counter.get("leases", {})
+    assert await server.sync_sequence.watermark() == counter["seq"]
+
+
+async def test_expired_or_invalid_tokens_are_refused(api):
+    stale = int(time.time()) - (server.SYNC_TOMBSTONE_DAYS + 1) * 86400
+    assert (await api.get("/api/sync", params={"since": f"5.{stale}"})).status_code == 410
+    assert (await api.get("/api/sync", params={"since": "nonsense"})).status_code == 400
+
+
+async def test_concurrent_allocations_never_share_a_number(api):
+    numbers = []
+
+    async def write(count):
+        async with server.sync_sequence.allocate(count) as first:
+            await anyio.sleep(0)
+            numbers.extend(range(first, first + count))
+
+    async with anyio.create_task_group() as tasks:
+        for n in range(300):
+            tasks.start_soon(write, 1 if n % 50 else 120)
+    assert len(numbers) == len(set(numbers)) == 294 + 6 * 120
+    counter = await server.db.sync_sequences.find_one({"_id": "default"})
+    assert max(numbers) <= counter["seq"]
@@ -0,0 +1,64 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+def tenant_in_flight():
+    return server.get_tenant("default").in_flight
+
+
+async def test_streamed_export_holds_its_slots_until_the_body_is_sent(api, asgi_call, monkeypatch):
+    monkeypatch.setattr(server, "STUDENT_BATCH_SIZE", 2)
+    for n in range(5):
+        await api.post("/api/students", json={"first_and_last_name": f"Alumno {n}", "class_name": "1A"})
+
+    def slots_in_flight():
+        return tenant_in_flight(), server.admission.in_flight
+
+    messages = await asgi_call(server.app, "/api/students/export", slots_in_flight, b"format=csv")
+    bodies = [in_flight for kind, in_flight in messages if kind == "http.response.body"]
+    assert len(bodies) > 1
+    assert all(in_flight == (1, 1) for in_flight in bodies)
+    assert slots_in_flight() == (0, 0)
+
+
+async def test_event_streams_do_not_take_a_slot(api, asgi_call):
+    async def endpoint(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+
+    middleware = server.TenantBudgetMiddleware(endpoint)
+    assert await asgi_call(middleware, "/api/events", tenant_in_flight) == [("http.response.start", 0)]
+    assert await asgi_call(middleware, "/api/students", tenant_in_flight) == [("http.response.start", 1)]
+
+
+async def test_full_tenant_is_answered_503(api, monkeypatch):
+    monkeypatch.setattr(server, "TENANT_QUEUE_TIMEOUT", 0.01)
+    tenant = server.get_tenant("default")
+    while not tenant.budget.locked():
+        await tenant.budget.acquire()
+    response = await api.get("/api/classes")
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "1"
+    assert tenant.rejected == 1
+
+
+async def test_invalid_tenant_is_refused_by_the_route(api):
+    response = await api.get("/api/classes", headers={"X-Tenant-ID": "Not Valid!"})
+    assert response.status_code == 400
+
+
+async def test_unknown_tenant_is_refused_without_being_provisioned(api):
+    response = await api.get("/api/classes", headers={"X-Tenant-ID": "escuela-nueva"})
+    assert response.status_code == 404
+    assert "escuela-nueva" not in server.tenants
+    assert await server.db.class_settings.count_documents({"tenant_id": "escuela-nueva"}) == 0
+
+
+async def test_stats_only_show_the_callers_tenant(api, monkeypatch):
+    monkeypatch.setattr(server, "SERVED_TENANTS", server.SERVED_TENANTS | {"cp-norte"})
+    server.get_tenant("cp-norte")
+    stats = (await api.get("/api/stats")).json()
+    assert stats["tenant"]["id"] == "default"
+    assert "cp-norte" not in str(stats)